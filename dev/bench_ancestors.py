@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+'''
+get_nth_parent_hash on a synthetic chain: the randomized DistanceSkipList
+the tracker used to use, against the AncestorIndex it uses now. Measures
+queries from random points and the depth-99 / 90%-of-chain lookups
+generate_transaction and the version vote make from the head, plus memory
+held by each index after the queries (tracemalloc). The skip list builds
+itself during queries, the ancestor index when items are added.
+
+usage: dev/bench_ancestors.py [LENGTHS...]
+'''
+
+import random
+import sys
+import time
+import tracemalloc
+
+import benchutil
+
+from p2pool.util import forest
+
+class Item(object):
+    __slots__ = ['hash', 'previous_hash']
+    def __init__(self, hash, previous_hash):
+        self.hash, self.previous_hash = hash, previous_hash
+
+def per_second(func, queries):
+    start = time.time()
+    for args in queries:
+        func(*args)
+    return len(queries)/(time.time() - start)
+
+def main(lengths):
+    rng = random.Random(0)
+    print('%8s %-16s %12s %14s %14s %10s' % ('length', 'index', 'build', 'random q/s', 'head q/s', 'memory'))
+    for length in lengths:
+        hashes = [rng.getrandbits(256) for i in range(length)]
+        items = [Item(h, hashes[i - 1] if i else None) for i, h in enumerate(hashes)]
+        random_queries = []
+        for i in range(20000):
+            i = rng.randrange(length)
+            random_queries.append((hashes[i], rng.randrange(i + 2)))
+        head_queries = [(hashes[-1], n) for n in [99, length*9//10]]*10000
+        
+        tracker = forest.Tracker(items)
+        results = {}
+        for name, index_type in [('DistanceSkipList', forest.DistanceSkipList), ('AncestorIndex', forest.AncestorIndex)]:
+            # a second index over the same tracker; AncestorIndex is fed the
+            # items the way Tracker.add would have
+            tracemalloc.start()
+            start = time.time()
+            index = index_type(tracker)
+            if isinstance(index, forest.AncestorIndex):
+                for item in items:
+                    index._handle_added(item)
+            build = time.time() - start
+            random_rate, head_rate = per_second(index, random_queries), per_second(index, head_queries)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            results[name] = [index(*args) for args in random_queries[:1000]]
+            print('%8i %-16s %9.1f ms %14.0f %14.0f %7.1f MB' % (length, name, build*1e3, random_rate, head_rate, memory/2**20))
+        assert results['DistanceSkipList'] == results['AncestorIndex']
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [6000, 60000])
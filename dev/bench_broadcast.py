@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+'''
+Time to the last peer for broadcast_share's shares message (the new share
+and its 4 parents, one of them from a peer, so that peer is sent the other
+4): packed, framed and checksummed for every peer the way sendShares used to,
+against one ShareBroadcast shared by all of them.
+
+usage: dev/bench_broadcast.py [PEERS...]
+'''
+
+import random
+import sys
+import time
+
+import benchutil
+
+import p2pool
+
+class FakeTransport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+class FakeNode(object):
+    def __init__(self, net):
+        from p2pool.util import variable
+        self.net = net
+        self.traffic_happened = variable.Event()
+
+def main(peer_counts):
+    p2pool.DEBUG = False
+    from p2pool import data as p2pool_data, networks, p2p
+    net = networks.nets['vertcoin']
+    rng = random.Random(0)
+    tracker = benchutil.make_tracker(net, 5, rng=rng)
+    shares = list(tracker.items.values())
+    for share in shares:
+        share.as_share() # as a share in the tracker would have been already
+
+    def old_send(peer, shares):
+        p2p.fragment(peer.send_shares, shares=[share.as_share() for share in shares])
+
+    def new_send(peer, shares, broadcast):
+        for data in broadcast.get_frames(shares, peer._message_prefix, peer._max_payload_length):
+            peer.sendFrame(data)
+
+    print('%6s %14s %14s' % ('peers', 'per peer', 'serialize once'))
+    for count in peer_counts:
+        peers = []
+        for i in range(count):
+            peer = p2p.Protocol(FakeNode(net), False)
+            peer.transport = FakeTransport()
+            peer.addr = ('10.0.0.%i' % (i,), 9346)
+            peers.append(peer)
+        shares[1].peer_addr = peers[0].addr
+        times = []
+        for name in ['old', 'new']:
+            best = None
+            for j in range(20):
+                start = time.time()
+                broadcast = p2p.ShareBroadcast(shares) if name == 'new' else None
+                for peer in peers:
+                    selected = [share for share in shares if share.peer_addr != peer.addr]
+                    if name == 'old':
+                        old_send(peer, selected)
+                    else:
+                        new_send(peer, selected, broadcast)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times.append(best)
+        assert all(peer.transport.written[0] == peer.transport.written[-1] for peer in peers) # the same bytes either way
+        assert len(peers[0].transport.written[0]) < len(peers[1].transport.written[0])
+        print('%6i %11.3f ms %11.3f ms' % (count, times[0]*1e3, times[1]*1e3))
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [10, 50, 100])
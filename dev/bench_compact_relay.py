@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+'''
+Share relay across NODES in-process nodes on localhost, each connected to
+the two started before it: node 0 mines COUNT shares, one at a time, each
+built on the last, and every node relays what it receives the way
+P2PNode does. Run once with every node speaking protocol 3501 (whole
+shares) and once with 3502 (cmpctshares), reporting p2p bytes sent per
+share across all nodes and how long a share takes to reach every node.
+Blocks have TXS transactions, which sets the length of the merkle branches
+compact shares leave out. PoW is stubbed out, as it costs both the same.
+
+usage: dev/bench_compact_relay.py [NODES [COUNT [TXS]]]
+'''
+
+import random
+import sys
+import time
+
+import benchutil
+
+import p2pool
+
+def main(nodes, count, txs):
+    p2pool.DEBUG = False
+    benchutil.use_dataset()
+    from twisted.internet import defer, reactor
+    from p2pool import data as p2pool_data, networks, node as p2pool_node, p2p
+    from p2pool.bitcoin import data as bitcoin_data
+    from p2pool.util import deferral
+    net = networks.nets['vertcoin']
+    net.PARENT.POW_FUNC = bitcoin_data.PoWCache(lambda header: 0)
+    cls = p2pool_data.PaddingBugfixShare
+    rng = random.Random(0)
+
+    txs = [dict(version=1, tx_ins=[dict(previous_output=dict(hash=rng.getrandbits(256), index=0), script=b'\x00'*100, sequence=None)],
+        tx_outs=[dict(value=rng.getrandbits(40), script=b'\x00'*25)], lock_time=0) for i in range(txs)]
+    known_txs = dict((bitcoin_data.get_txid(tx), tx) for tx in txs)
+    share_info, gentx, other_transaction_hashes, get_share = cls.generate_transaction(
+        tracker=p2pool_data.OkayTracker(net),
+        share_data=dict(previous_share_hash=None, coinbase=b'\x01\x02', nonce=0, address=b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ', subsidy=25*10**8, donation=0, stale_info=None, desired_version=cls.VERSION),
+        block_target=2**240,
+        desired_timestamp=1600001000,
+        desired_target=2**250,
+        ref_merkle_link=dict(branch=[], index=0),
+        desired_other_transaction_hashes_and_fees=[(tx_hash, 0) for tx_hash in known_txs],
+        net=net,
+        known_txs=known_txs,
+    )
+    first = get_share(dict(version=0x20000000, previous_block=rng.getrandbits(256), timestamp=1600001000, bits=share_info['bits'], nonce=0,
+        merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.get_txid(gentx), share_info['segwit_data']['txid_merkle_link'])))
+    def child_of(share):
+        # a share built on share with the same template, as the next one mined on it is
+        share_info = dict(share.share_info, share_data=dict(share.share_data, previous_share_hash=share.hash))
+        return cls(net, None, dict(share.contents, share_info=share_info, min_header=dict(share.min_header, nonce=rng.getrandbits(32))))
+    chain = [first]
+    for i in range(count + 10):
+        chain.append(child_of(chain[-1]))
+    print('%i nodes, %i shares, %i transactions a block, %i bytes a share packed' % (nodes, count, len(txs), len(first.as_share()['contents'])))
+    print('%-10s %14s %14s %14s' % ('', 'bytes/share', 'latency p50', 'latency max'))
+
+    @defer.inlineCallbacks
+    def run(version):
+        p2p.Protocol.VERSION = version
+        sent = [0]
+        arrived = {} # share hash -> number of nodes that have it
+        all_arrived = {} # share hash -> Deferred
+        p2p_nodes = []
+        for i in range(nodes):
+            n = p2pool_node.Node(None, None, chain[:10], [], net)
+            n.cur_share_ver = cls.VERSION
+            def set_best_share(n=n):
+                best = max(n.tracker.heads, key=n.tracker.get_height)
+                if best != n.best_share_var.value:
+                    arrived[best] = arrived.get(best, 0) + 1
+                    if arrived[best] == nodes:
+                        all_arrived.pop(best).callback(None)
+                n.best_share_var.set(best)
+            n.set_best_share = set_best_share
+            p2p_node = p2pool_node.P2PNode(n, port=0, addr_store={}, connect_addrs=set(('127.0.0.1', x.serverfactory.listen_port.getHost().port) for x in p2p_nodes[-2:]),
+                desired_outgoing_conns=0, advertise_ip=False)
+            p2p_node.traffic_happened.watch(lambda name, n: sent.__setitem__(0, sent[0] + n) if name == 'p2p/out' else None)
+            # what P2PNode.start does for relaying, without the bitcoind side
+            p2p.Node.start(p2p_node)
+            p2p_node.shared_share_hashes = set(n.tracker.items)
+            n.best_share_var.changed.watch(p2p_node.broadcast_share)
+            n.p2p_node = p2p_node
+            p2p_nodes.append(p2p_node)
+        while sum(len(p2p_node.peers) for p2p_node in p2p_nodes) < 2*(2*nodes - 3):
+            yield deferral.sleep(.05)
+
+        sent[0] = 0
+        latencies = []
+        origin = p2p_nodes[0].node
+        for share in chain[10:10 + count]:
+            all_arrived[share.hash] = d = defer.Deferred()
+            start = time.time()
+            origin.tracker.add(share)
+            origin.set_best_share()
+            yield d
+            latencies.append(time.time() - start)
+        latencies.sort()
+        print('%-10s %14.0f %11.2f ms %11.2f ms' % ('%i' % (version,), sent[0]/count, latencies[len(latencies)//2]*1e3, latencies[-1]*1e3))
+
+        for p2p_node in p2p_nodes:
+            yield p2p_node.stop()
+
+    @defer.inlineCallbacks
+    def both():
+        try:
+            yield run(3501)
+            yield run(3502)
+        finally:
+            reactor.stop()
+    reactor.callWhenRunning(both)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8, int(sys.argv[2]) if len(sys.argv) > 2 else 50, int(sys.argv[3]) if len(sys.argv) > 3 else 100)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+'''
+Cost of the per-template merkle work (coinbase txid branch and wtxid root)
+for growing transaction sets: the old full rebuild with
+calculate_merkle_link/merkle_hash, against MerkleTree from scratch, from
+the previous template with a few transactions appended, and after a block
+took the front part of the list.
+
+usage: dev/bench_merkle.py [SIZES...]
+'''
+
+import random
+import sys
+import timeit
+
+import benchutil
+
+from p2pool.bitcoin import data as bitcoin_data
+
+def rate(func, seconds=.3):
+    number = 1
+    while True:
+        dt = timeit.timeit(func, number=number)
+        if dt > seconds:
+            return dt/number
+        number *= 2
+
+def main(sizes):
+    rng = random.Random(0)
+    print('%8s %12s %12s %12s %12s %12s' % ('txs', 'old', 'cold', 'cache hit', '+10 txs', 'new block'))
+    for size in sizes:
+        txids = [rng.getrandbits(256) for i in range(size)]
+        wtxids = [rng.getrandbits(256) for i in range(size)]
+        appended = txids + [rng.getrandbits(256) for i in range(10)], wtxids + [rng.getrandbits(256) for i in range(10)]
+        mined = txids[size//3:] + appended[0][size:], wtxids[size//3:] + appended[1][size:]
+
+        def old():
+            return bitcoin_data.calculate_merkle_link([None] + txids, 0), bitcoin_data.merkle_hash([0] + wtxids)
+        base = bitcoin_data.MerkleTree([None] + txids), bitcoin_data.MerkleTree([0] + wtxids)
+        def new(txids, wtxids, base=(None, None)):
+            return bitcoin_data.MerkleTree([None] + txids, base[0]).get_link(0), bitcoin_data.MerkleTree([0] + wtxids, base[1]).get_root()
+        cache = bitcoin_data.MerkleTreeCache()
+        def cached():
+            return cache.get([None] + txids).get_link(0), cache.get([0] + wtxids).get_root()
+        assert new(txids, wtxids) == old() == cached()
+
+        times = [
+            rate(old),
+            rate(lambda: new(txids, wtxids)),
+            rate(cached),
+            rate(lambda: new(appended[0], appended[1], base)),
+            rate(lambda: new(mined[0], mined[1], base)),
+        ]
+        print('%8i %s' % (size, ' '.join('%9.2f ms' % (t*1e3,) for t in times)))
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [1000, 5000, 20000])
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+'''
+Parsing throughput (MB/s) of p2protocol.Protocol.dataReceived for the p2pool
+and bitcoind protocols: a stream of messages is fed in fixed-size chunks, as
+TCP would deliver it, and framed, checksummed and unpacked. Handlers are
+no-ops.
+
+usage: dev/bench_p2protocol.py [STREAM_MB]
+'''
+
+import random
+import sys
+import time
+
+import benchutil
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data
+
+class FakeTransport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+def sink(cls, message_prefix):
+    class Sink(cls):
+        def __init__(self):
+            p2protocol.Protocol.__init__(self, message_prefix, 32000000, ignore_trailing_payload=cls is bitcoin_p2p.Protocol)
+            self.transport = FakeTransport()
+            self.count = 0
+        def packetReceived(self, command, payload2):
+            self.count += 1
+    return Sink
+
+def make_tx(rng):
+    return dict(version=1, tx_ins=[dict(previous_output=dict(hash=rng.getrandbits(256), index=0), script=bytes(107), sequence=None) for i in range(2)],
+        tx_outs=[dict(value=rng.getrandbits(40), script=bytes(25)) for i in range(2)], lock_time=0)
+
+def get_cases(net):
+    rng = random.Random(0)
+    p2pool_sink, bitcoin_sink = sink(p2p.Protocol, net.PREFIX), sink(bitcoin_p2p.Protocol, net.PARENT.P2P_PREFIX)
+    header = dict(version=0x20000000, previous_block=rng.getrandbits(256), merkle_root=rng.getrandbits(256),
+        timestamp=1600000000, bits=bitcoin_data.FloatingInteger(0x1b0404cb), nonce=rng.getrandbits(32))
+    return [
+        ('p2pool shares x1', p2pool_sink, 'shares', dict(shares=[benchutil.make_raw_share(net, rng=rng)])),
+        ('p2pool sharereply x50', p2pool_sink, 'sharereply', dict(id=1, result='good', shares=[benchutil.make_raw_share(net, rng=rng) for i in range(50)])),
+        ('p2pool remember_tx x100', p2pool_sink, 'remember_tx', dict(tx_hashes=[], txs=[make_tx(rng) for i in range(100)])),
+        ('bitcoind inv x500', bitcoin_sink, 'inv', dict(invs=[dict(type='tx', hash=rng.getrandbits(256)) for i in range(500)])),
+        ('bitcoind tx', bitcoin_sink, 'tx', dict(tx=make_tx(rng))),
+        ('bitcoind block x2000', bitcoin_sink, 'block', dict(block=dict(header=header, txs=[make_tx(rng) for i in range(2000)]))),
+    ]
+
+def main(stream_mb):
+    global p2protocol, p2p, bitcoin_p2p
+    benchutil.use_dataset()
+    p2pool.DEBUG = False # otherwise unpack repacks everything as a check
+    from p2pool import networks, p2p
+    from p2pool.bitcoin import p2p as bitcoin_p2p
+    from p2pool.util import p2protocol
+    net = networks.nets['vertcoin']
+
+    cases = get_cases(net)
+    print('%-24s %16s %16s %10s' % ('', '1460 B chunks', '65536 B chunks', 'msgs/s'))
+    for name, cls, command, payload in cases:
+        p = cls()
+        p.sendPacket(command, payload)
+        message = p.transport.written[0]
+        stream = message * max(1, int(stream_mb*2**20//len(message)))
+        results = []
+        for chunk_size in [1460, 65536]:
+            chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+            p = cls()
+            start = time.time()
+            for chunk in chunks:
+                p.dataReceived(chunk)
+            dt = time.time() - start
+            assert p.count == len(stream)//len(message)
+            results.append((len(stream)/dt/1e6, p.count/dt))
+        print('%-24s %11.1f MB/s %11.1f MB/s %10.0f' % (name, results[0][0], results[1][0], results[1][1]))
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 8)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+'''
+Micro-benchmark of pack/unpack for the hot wire types, against the
+file-based read/write path they used to go through.
+
+usage: dev/bench_pack.py [SECONDS_PER_CASE]
+'''
+
+import random
+import sys
+import timeit
+
+import benchutil
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data
+from p2pool.util import pack
+
+def get_cases():
+    benchutil.use_dataset()
+    from p2pool import data as p2pool_data, networks
+    net = networks.nets['vertcoin']
+    share_type = p2pool_data.PaddingBugfixShare.get_dynamic_types(net)['share_type']
+    rng = random.Random(0)
+
+    header = dict(version=0x20000000, previous_block=rng.getrandbits(256), merkle_root=rng.getrandbits(256),
+        timestamp=1600000000, bits=bitcoin_data.FloatingInteger(0x1b0404cb), nonce=rng.getrandbits(32))
+    tx = dict(version=1, tx_ins=[dict(previous_output=dict(hash=rng.getrandbits(256), index=i), script=bytes(107), sequence=None) for i in range(2)],
+        tx_outs=[dict(value=rng.getrandbits(40), script=bytes(25)) for i in range(2)], lock_time=0)
+    segwit_tx = dict(tx, marker=0, flag=1, witness=[[bytes(72), bytes(33)] for tx_in in tx['tx_ins']])
+
+    return [
+        ('block_header_type', bitcoin_data.block_header_type, header),
+        ('tx_type', bitcoin_data.tx_type, tx),
+        ('tx_type (segwit)', bitcoin_data.tx_type, segwit_tx),
+        ('share_type', share_type, share_type.unpack(benchutil.make_raw_share(net)['contents'])),
+    ]
+
+def rate(func, seconds):
+    number = 1
+    while True:
+        dt = timeit.timeit(func, number=number)
+        if dt > seconds:
+            return dt/number
+        number *= 2
+
+def main(seconds):
+    p2pool.DEBUG = False # otherwise unpack repacks everything as a check
+    cases = get_cases()
+    print('%-20s %12s %12s %12s %12s' % ('', 'unpack', 'old unpack', 'pack', 'old pack'))
+    for name, type_, item in cases:
+        data = type_.pack(item)
+        def old_pack():
+            f = pack.BytesIO()
+            type_.write(f, item)
+            return f.getvalue()
+        assert old_pack() == data and type_.read(pack.BytesIO(data)) == type_.unpack(data)
+        times = [
+            rate(lambda: type_.unpack(data), seconds),
+            rate(lambda: type_.read(pack.BytesIO(data)), seconds),
+            rate(lambda: type_.pack(item), seconds),
+            rate(old_pack, seconds),
+        ]
+        print('%-20s %s' % (name, ' '.join('%9.2f us' % (t*1e6,) for t in times)))
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else .2)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+'''
+Headers per second through the batch PoW calls at 1, 4 and 16 threads:
+VerthashDataset.hash_many and, if it's built, ltc_scrypt.getPoWHashes. The
+header-at-a-time POW_FUNC is the baseline.
+
+usage: dev/bench_pow_batch.py [HEADERS]
+'''
+
+import os
+import sys
+import time
+
+import benchutil
+
+def rate(f, headers):
+    start = time.time()
+    f(headers)
+    return len(headers)/(time.time() - start)
+
+def main(count):
+    benchutil.use_dataset()
+    from p2pool.bitcoin import verthash_dataset
+    dataset = verthash_dataset.get_dataset('verthash.dat')
+    headers = [os.urandom(80) for i in range(count)]
+    backends = [('verthash', dataset.hash, dataset.hash_many)]
+    try:
+        import ltc_scrypt
+    except ImportError:
+        print('ltc_scrypt not built, skipping it')
+    else:
+        backends.append(('scrypt', ltc_scrypt.getPoWHash, ltc_scrypt.getPoWHashes))
+    dataset.hash(headers[0]) # maps the dataset
+
+    print('%i headers, %i CPUs' % (count, os.cpu_count()))
+    print('%-10s %12s %12s %12s %12s' % ('', 'one by one', '1 thread', '4 threads', '16 threads'))
+    for name, hash_one, hash_many in backends:
+        assert hash_many(headers[:16], 4) == b''.join(hash_one(header) for header in headers[:16])
+        rates = [rate(lambda headers: [hash_one(header) for header in headers], headers)]
+        rates.extend(rate(lambda headers: hash_many(headers, threads), headers) for threads in [1, 4, 16])
+        print('%-10s' % (name,) + ''.join(' %8.0f h/s' % (r,) for r in rates))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
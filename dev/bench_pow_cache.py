@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+'''
+Verthash over the headers a node sees, each asked for as many times as the
+code paths that hash it: a found share's header in got_response and again
+in BaseShare.__init__, a new best block's in handle_bestblock and then in
+compute_work on every bitcoind_work change while it stays the best. Raw
+POW_FUNC against the network's PoWCache.
+
+usage: dev/bench_pow_cache.py [HEADERS]
+'''
+
+import os
+import sys
+import time
+
+import benchutil
+
+import p2pool
+
+def main(count):
+    p2pool.DEBUG = False
+    benchutil.use_dataset()
+    from p2pool.bitcoin import networks
+    cache = networks.nets['vertcoin'].POW_FUNC
+    pow_func = cache.pow_func
+    headers = []
+    for i in range(count):
+        header = os.urandom(80)
+        headers.extend([header]*(2 if i % 2 else 6)) # share: 2 times; block: 2 + 4 work changes
+    assert all(cache(header) == pow_func(header) for header in headers[:10])
+    cache._results.clear()
+    cache.hits = cache.misses = 0
+
+    times = []
+    for f in [pow_func, cache]:
+        start = time.time()
+        for header in headers:
+            f(header)
+        times.append((time.time() - start)/len(headers))
+    print('%i headers, %i calls' % (count, len(headers)))
+    print('uncached: %8.1f us per call' % (times[0]*1e6,))
+    print('cached:   %8.1f us per call  %r' % (times[1]*1e6, cache.get_stats()))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
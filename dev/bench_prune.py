@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+'''
+One clean_tracker pass over a chain one share short of the tail-trimming
+length, with recent branches off its top: the scans over every head and tail clean_tracker
+used to do, against TrackerPruner. "idle" is a pass with nothing to remove,
+"new share" one after a share on top of the chain (one bottom share to drop),
+"stale heads" one where all the branches have aged out. think() isn't
+included; clean_tracker used to run it twice per pass and now once.
+
+usage: dev/bench_prune.py [BRANCHES...]
+'''
+
+import random
+import sys
+import time
+
+import benchutil
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data
+
+def old_prune(tracker, best_heads, now):
+    for i in range(1000):
+        to_remove = set()
+        for share_hash, tail in tracker.heads.items():
+            if share_hash in best_heads or tracker.items[share_hash].time_seen > now - 300:
+                continue
+            if share_hash not in tracker.verified.items and max(tracker.items[h].time_seen for h in tracker.reverse.get(tail)) > now - 120:
+                continue
+            to_remove.add(share_hash)
+        if not to_remove:
+            break
+        for share_hash in to_remove:
+            if share_hash in tracker.verified.items:
+                tracker.verified.remove(share_hash)
+            tracker.remove(share_hash)
+    for i in range(1000):
+        to_remove = set()
+        for tail, heads in tracker.tails.items():
+            if min(tracker.get_height(head) for head in heads) < 2*tracker.net.CHAIN_LENGTH + 10:
+                continue
+            to_remove.update(tracker.reverse.get(tail, set()))
+        if not to_remove:
+            break
+        for share_hash in to_remove:
+            if share_hash in tracker.verified.items:
+                tracker.verified.remove(share_hash)
+            tracker.remove(share_hash)
+
+def make_share(net, parent, rng):
+    cls = type(parent)
+    contents = benchutil.make_share_contents(net, cls, parent.hash, rng=rng)
+    share_info = contents['share_info']
+    share_info['timestamp'] = parent.timestamp + net.SHARE_PERIOD
+    share_info['absheight'] = parent.absheight + 1
+    share_info['abswork'] = parent.abswork + bitcoin_data.target_to_average_attempts(share_info['bits'].target)
+    return cls(net, None, contents, known_hashes=(rng.getrandbits(256), rng.getrandbits(256), 0, rng.getrandbits(256)))
+
+def make_tracker(net, branches, now):
+    rng = random.Random(0)
+    tracker = benchutil.make_tracker(net, 2*net.CHAIN_LENGTH + 9, rng=rng)
+    best = max(tracker.heads, key=tracker.get_height)
+    chain = list(tracker.get_chain(best, tracker.get_height(best)))[::-1]
+    for share in chain:
+        share.time_seen = now - 3600
+        tracker.verified.add(share)
+    for i in range(branches):
+        parent = chain[-2 - rng.randrange(100)]
+        for j in range(rng.randrange(1, 4)):
+            share = make_share(net, parent, rng)
+            share.time_seen = now - 200
+            tracker.add(share)
+            tracker.verified.add(share)
+            parent = share
+    top = make_share(net, chain[-1], rng)
+    top.time_seen = now
+    for head in tracker.heads:
+        tracker.get_height(head) # so neither side pays for filling the delta caches
+    return tracker, top
+
+def main(branch_counts):
+    p2pool.DEBUG = False
+    from p2pool import networks, node
+    net = networks.nets['vertcoin']
+    now = time.time()
+
+    print('%9s %-8s %12s %12s %12s' % ('branches', 'pruning', 'idle', 'new share', 'stale heads'))
+    for branches in branch_counts:
+        for name in ['old', 'new']:
+            tracker, top = make_tracker(net, branches, now)
+            best_heads = set([max(tracker.verified.heads, key=tracker.verified.get_height)])
+            if name == 'old':
+                prune = lambda now: old_prune(tracker, best_heads, now)
+            else:
+                pruner = node.TrackerPruner(tracker)
+                prune = lambda now: pruner.prune(best_heads, now)
+            times = []
+            for setup, at in [(lambda: None, now), (lambda: (tracker.add(top), tracker.verified.add(top)), now), (lambda: None, now + 300)]:
+                setup()
+                start = time.time()
+                prune(at)
+                times.append(time.time() - start)
+            print('%9i %-8s %9.2f ms %9.2f ms %9.2f ms' % ((branches, name) + tuple(t*1e3 for t in times)))
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [10, 100])
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+'''
+Hash-link cost with the pure Python SHA-256 compression against the
+sha256_midstate extension: check_hash_link alone, prefix_to_hash_link over a
+gentx-sized prefix, and whole shares verified per second (get_hashes: hash
+link, merkle root and PoW).
+
+Build the extension first: cd sha256_midstate && python3 setup.py build_ext --inplace
+
+usage: dev/bench_sha256.py [SHARES]
+'''
+
+import os
+import sys
+import time
+import timeit
+
+import benchutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sha256_midstate'))
+
+import p2pool
+from p2pool.bitcoin import sha256
+
+def rate(func, seconds=.3):
+    number = 1
+    while True:
+        dt = timeit.timeit(func, number=number)
+        if dt > seconds:
+            return dt/number
+        number *= 2
+
+def main(count):
+    if sha256.process is sha256.py_process:
+        print('sha256_midstate extension not found, only the Python version will be measured')
+    p2pool.DEBUG = False
+    benchutil.use_dataset()
+    from p2pool import data as p2pool_data, networks
+    net = networks.nets['vertcoin']
+    # synthetic shares don't meet their PoW target, so load them with dummy
+    # known_hashes and time get_hashes(), which is what verification runs
+    shares = [p2pool_data.load_share(benchutil.make_raw_share(net), net, None, (0, 0, 0, 0)) for i in range(count)]
+    share = shares[0]
+    link_data = share.get_ref_hash(net, share.share_info, share.contents['ref_merkle_link']) + bytes(12)
+    prefix = os.urandom(1000) + share.gentx_before_refhash
+
+    implementations = [('python', sha256.py_process)] + ([('c', sha256.process)] if sha256.process is not sha256.py_process else [])
+    print('%-8s %16s %16s %16s' % ('', 'check_hash_link', 'prefix (1 kB)', 'shares/s'))
+    for name, process in implementations:
+        sha256.process = process
+        try:
+            check = rate(lambda: p2pool_data.check_hash_link(share.hash_link, link_data, share.gentx_before_refhash))
+            link = rate(lambda: p2pool_data.prefix_to_hash_link(prefix, share.gentx_before_refhash))
+            start = time.time()
+            for share_ in shares:
+                share_.get_hashes()
+            dt = time.time() - start
+        finally:
+            sha256.process = implementations[-1][1]
+        print('%-8s %13.2f us %13.2f us %16.1f' % (name, check*1e6, link*1e6, count/dt))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+'''
+Memory held per share: COUNT shares, paying to a pool of 100 addresses,
+loaded from their wire format the way ShareStore and the p2p code load them
+and kept in a list, measured with tracemalloc.
+
+usage: dev/bench_share_memory.py [COUNT]
+'''
+
+import gc
+import random
+import sys
+import tracemalloc
+
+import benchutil
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data
+
+def main(count):
+    p2pool.DEBUG = False
+    from p2pool import data as p2pool_data, networks
+    net = networks.nets['vertcoin']
+    cls = p2pool_data.PaddingBugfixShare
+    rng = random.Random(0)
+    addresses = [bitcoin_data.pubkey_hash_to_address(rng.getrandbits(160), net.PARENT.ADDRESS_VERSION, -1, net.PARENT) for i in range(100)]
+    raw_shares = []
+    for i in range(count):
+        contents = benchutil.make_share_contents(net, cls, rng.getrandbits(256), rng=rng)
+        contents['share_info']['share_data']['address'] = rng.choice(addresses)
+        raw_shares.append(dict(type=cls.VERSION, contents=cls.get_dynamic_types(net)['share_type'].pack(contents)))
+    known_hashes = [(rng.getrandbits(256), rng.getrandbits(256), 0, rng.getrandbits(256)) for i in range(count)]
+    p2pool_data.load_share(raw_shares[0], net, None, known_hashes[0]) # fills the type caches
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    shares = [p2pool_data.load_share(raw_share, net, None, hashes) for raw_share, hashes in zip(raw_shares, known_hashes)]
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'lineno')
+    total = sum(stat.size_diff for stat in stats)
+    print('%i shares, %i bytes per share' % (len(shares), total//len(shares)))
+    for stat in stats[:8]:
+        print('  %8i bytes per share  %s' % (stat.size_diff//len(shares), stat.traceback))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+'''
+Sharechain sync time in a simulated network: a fresh node that has just
+heard of the best share downloads the 2*CHAIN_LENGTH+10 shares below it
+from PEERS peers. Each peer has its own round trip time and upload rate,
+shared between the requests it's serving. Runs the single-peer loop
+P2PNode.start used to have and ShareDownloader, with every peer answering
+and again with one that never does, so requests to it time out after 15
+seconds like GenericDeferrer's, and reports how long each took and how
+many requests it made. Verifying the shares costs both the same and isn't
+simulated.
+
+usage: dev/bench_share_sync.py [PEERS [CHAIN_LENGTH]]
+'''
+
+import random
+import sys
+import time
+
+import benchutil
+
+import p2pool
+
+class Share(object):
+    def __init__(self, hash, previous_hash):
+        self.hash = hash
+        self.previous_hash = previous_hash
+
+def main(peer_count, chain_length):
+    p2pool.DEBUG = False
+    from twisted.internet import defer, reactor
+    from p2pool import node, p2p
+    from p2pool.util import deferral, forest, variable
+    length = 2*chain_length + 10 + 100
+    chain = forest.Tracker(Share(i, i - 1 if i > 0 else None) for i in range(length))
+
+    class Peer(object):
+        def __init__(self, i, rtt, shares_per_second, dead=False):
+            self.addr = '10.0.0.%i' % (i,), 9346
+            self.other_version = p2p.Protocol.VERSION
+            self.rtt = rtt
+            self.seconds_per_share = 1/shares_per_second
+            self.dead = dead
+            self.busy_until = 0
+            self.requests = 0
+
+        def _reply(self, share_hash, count, stops, size, value):
+            self.requests += 1
+            d = defer.Deferred()
+            if self.dead:
+                reactor.callLater(15, d.errback, defer.TimeoutError('in GenericDeferrer'))
+                return d
+            res = []
+            for share in chain.get_chain(share_hash, min(count, chain.get_height(share_hash))):
+                if share.hash in stops:
+                    break
+                res.append(value(share))
+            now = time.time()
+            self.busy_until = max(now + self.rtt/2, self.busy_until) + len(res)*size*self.seconds_per_share
+            reactor.callLater(self.busy_until + self.rtt/2 - now, d.callback, res)
+            return d
+
+        def get_shares(self, hashes, parents, stops):
+            return self._reply(hashes[0], min(parents, 1000) + 1, set(stops), 1, lambda share: share)
+
+        def get_share_hashes(self, share_hash, count, stops):
+            return self._reply(share_hash, min(count, 10000), set(stops), 32/700, lambda share: share.hash) # hashes against ~700-byte shares
+
+        def badPeerHappened(self, bantime=3600):
+            pass
+
+    class P2PNode(object):
+        def __init__(self, peers):
+            self.net = Share(0, None)
+            self.net.CHAIN_LENGTH = chain_length
+            self.tracker = forest.Tracker()
+            self.desired_var = variable.Variable([])
+            self.peers = dict(enumerate(peers))
+            self.node = self
+            self.synced = defer.Deferred()
+
+        def handle_shares(self, shares, peer):
+            for share, new_txs in shares:
+                if share.hash not in self.tracker.items:
+                    self.tracker.add(share)
+            tip = max(self.tracker.heads, key=self.tracker.get_height)
+            height, last = self.tracker.get_height_and_last(tip)
+            if height >= 2*chain_length + 10 or last is None:
+                self.desired_var.set([])
+                if not self.synced.called:
+                    self.synced.callback(None)
+            else:
+                self.desired_var.set([(None, last)])
+
+    def old_download_shares(self, stopped):
+        # the loop P2PNode.start used to run
+        @defer.inlineCallbacks
+        def download_shares():
+            while not stopped:
+                desired = yield self.node.desired_var.get_when_satisfies(lambda val: len(val) != 0)
+                peer_addr, share_hash = random.choice(desired)
+                peer = random.choice(list(self.peers.values()))
+                try:
+                    shares = yield peer.get_shares(
+                        hashes=[share_hash],
+                        parents=random.randrange(500),
+                        stops=list(set(self.node.tracker.heads) | set(
+                            self.node.tracker.get_nth_parent_hash(head, min(max(0, self.node.tracker.get_height_and_last(head)[0] - 1), 10)) for head in self.node.tracker.heads
+                        ))[:100],
+                    )
+                except defer.TimeoutError:
+                    continue
+                if not shares:
+                    yield deferral.sleep(1)
+                    continue
+                self.handle_shares([(share, []) for share in shares], peer)
+        download_shares()
+
+    print('%i peers, %i shares to download' % (peer_count, 2*chain_length + 10))
+    print('%-12s %-10s %10s %10s' % ('', 'peers', 'time', 'requests'))
+
+    @defer.inlineCallbacks
+    def run(name, new, dead):
+        random.seed(1)
+        rng = random.Random(0)
+        peers = [Peer(i, rng.uniform(.05, .3), rng.uniform(500, 5000), dead=dead and i == 0) for i in range(peer_count)]
+        p2p_node = P2PNode(peers)
+        p2p_node.tracker.add(chain.items[length - 1]) # as if it came with the peer's best share hash
+        start = time.time()
+        stopped = []
+        if new:
+            downloader = node.ShareDownloader(p2p_node)
+            downloader.start()
+        else:
+            old_download_shares(p2p_node, stopped)
+        p2p_node.handle_shares([], None)
+        yield p2p_node.synced
+        elapsed = time.time() - start
+        if new:
+            downloader.stop()
+        stopped.append(True)
+        print('%-12s %-10s %8.2f s %10i' % (name, 'one dead' if dead else 'all up', elapsed, sum(peer.requests for peer in peers)))
+        if dead:
+            yield deferral.sleep(15) # let the dead peer's timeouts fire
+
+    @defer.inlineCallbacks
+    def both():
+        try:
+            for dead in [False, True]:
+                yield run('one peer', False, dead)
+                yield run('downloader', True, dead)
+        finally:
+            reactor.stop()
+    reactor.callWhenRunning(both)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8, int(sys.argv[2]) if len(sys.argv) > 2 else 2880)
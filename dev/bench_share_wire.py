@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+'''
+What a share costs when it goes out (as_share, for every peer it's sent to
+and every store) and when a peer relays one we already have: re-packing its
+contents against returning the bytes it was loaded from, and the full
+load_share (unpack, hash link, Verthash) a duplicate used to go through
+against the ShareContentsIndex lookup that now drops it.
+
+usage: dev/bench_share_wire.py [COUNT]
+'''
+
+import random
+import sys
+import time
+
+import benchutil
+
+import p2pool
+
+def timed(f, items):
+    start = time.time()
+    for item in items:
+        f(item)
+    return (time.time() - start)/len(items)
+
+def main(count):
+    p2pool.DEBUG = False
+    benchutil.use_dataset()
+    from p2pool import data as p2pool_data, networks, p2p
+    net = networks.nets['vertcoin']
+    cls = p2pool_data.PaddingBugfixShare
+    rng = random.Random(0)
+    share_type = cls.get_dynamic_types(net)['share_type']
+    tracker = benchutil.make_tracker(net, count, rng=rng)
+    index = p2pool_data.ShareContentsIndex(tracker)
+    shares = list(tracker.items.values())
+    raw_shares = [dict(share.as_share(), contents=bytes(bytearray(share.as_share()['contents']))) for share in shares]
+
+    def old_load(raw_share):
+        try:
+            p2pool_data.load_share(raw_share, net, None)
+        except p2p.PeerMisbehavingError: # made-up hashes, so the PoW check fails after computing it
+            pass
+
+    assert all(index.get(raw_share) == share.hash for raw_share, share in zip(raw_shares, shares))
+
+    print('%i shares, %i bytes each packed' % (count, sum(len(raw_share['contents']) for raw_share in raw_shares)//count))
+    print('as_share:  %8.2f us re-packed, %8.2f us cached' % (
+        timed(lambda share: share_type.pack(share.contents), shares)*1e6,
+        timed(lambda share: share.as_share(), shares)*1e6))
+    print('duplicate: %8.2f us loaded,    %8.2f us looked up' % (
+        timed(old_load, raw_shares[:200])*1e6,
+        timed(index.get, raw_shares)*1e6))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
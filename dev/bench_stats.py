@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+'''
+The chain statistics web.py, the status thread, get_work and BaseShare.check
+ask for, as the chain walks they used to be against the tracker's indexes:
+stale_rates (over decent_height), add_point's pool_rates and version votes
+(an hour back), the global stale proportion, user_stales (the whole chain)
+and the version vote check (CHAIN_LENGTH//10 from 90% back). "same best"
+asks again with nothing changed, "new share" after a share on top.
+
+usage: dev/bench_stats.py [LENGTH]
+'''
+
+import random
+import sys
+import time
+
+import benchutil
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data
+
+def walk_average_stale_prop(tracker, share_hash, lookbehind):
+    stales = sum(1 for share in tracker.get_chain(share_hash, lookbehind) if share.share_data['stale_info'] is not None)
+    return stales/(lookbehind + stales)
+
+def walk_stale_counts(tracker, share_hash, lookbehind, rates=False):
+    res = {}
+    for share in tracker.get_chain(share_hash, lookbehind - 1):
+        res['good'] = res.get('good', 0) + bitcoin_data.target_to_average_attempts(share.target)
+        s = share.share_data['stale_info']
+        if s is not None:
+            res[s] = res.get(s, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    if rates:
+        dt = tracker.items[share_hash].timestamp - tracker.items[tracker.get_nth_parent_hash(share_hash, lookbehind - 1)].timestamp
+        res = dict((k, v/dt) for k, v in res.items())
+    return res
+
+def walk_user_stale_props(tracker, share_hash, lookbehind, net):
+    res = {}
+    for share in tracker.get_chain(share_hash, lookbehind - 1):
+        key = share.share_data['address']
+        stale, total = res.get(key, (0, 0))
+        total += 1
+        if share.share_data['stale_info'] is not None:
+            stale += 1
+            total += 1
+        res[key] = stale, total
+    return dict((key, stale/total) for key, (stale, total) in res.items())
+
+def walk_desired_version_counts(tracker, best_share_hash, dist):
+    res = {}
+    for share in tracker.get_chain(best_share_hash, dist):
+        res[share.desired_version] = res.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    return res
+
+def make_share(net, parent, rng):
+    cls = type(parent)
+    contents = benchutil.make_share_contents(net, cls, parent.hash, rng=rng)
+    share_info = contents['share_info']
+    share_info['share_data']['stale_info'] = rng.choice([None]*8 + ['orphan', 'doa'])
+    share_info['timestamp'] = parent.timestamp + net.SHARE_PERIOD
+    share_info['absheight'] = parent.absheight + 1
+    share_info['abswork'] = parent.abswork + bitcoin_data.target_to_average_attempts(share_info['bits'].target)
+    return cls(net, None, contents, known_hashes=(rng.getrandbits(256), rng.getrandbits(256), 0, rng.getrandbits(256)))
+
+def main(length):
+    p2pool.DEBUG = False
+    from p2pool import data as p2pool_data, networks
+    net = networks.nets['vertcoin']
+    rng = random.Random(0)
+    tracker = benchutil.make_tracker(net, length, rng=rng)
+    for share in tracker.items.values():
+        share.share_data['stale_info'] = rng.choice([None]*8 + ['orphan', 'doa'])
+    best = [max(tracker.heads, key=tracker.get_height)]
+
+    def queries(stale_prop, stale_counts, user_stale_props, version_counts):
+        height = tracker.get_height(best[0])
+        hour = min(net.CHAIN_LENGTH, 60*60//net.SHARE_PERIOD, height)
+        return [
+            ('stale_rates', lambda: stale_counts(tracker, best[0], min(height, 720), rates=True)),
+            ('pool_rates', lambda: stale_counts(tracker, best[0], hour, rates=True)),
+            ('version votes', lambda: version_counts(tracker, best[0], hour)),
+            ('stale prop', lambda: stale_prop(tracker, best[0], hour)),
+            ('user_stales', lambda: user_stale_props(tracker, best[0], height, net.PARENT)),
+            ('check votes', lambda: version_counts(tracker, tracker.get_nth_parent_hash(best[0], net.CHAIN_LENGTH*9//10), net.CHAIN_LENGTH//10)),
+        ]
+    old = queries(walk_average_stale_prop, walk_stale_counts, walk_user_stale_props, walk_desired_version_counts)
+    new = queries(p2pool_data.get_average_stale_prop, p2pool_data.get_stale_counts, p2pool_data.get_user_stale_props, p2pool_data.get_desired_version_counts)
+    for (name, old_f), (name, new_f) in zip(old, new):
+        assert old_f() == new_f(), name # and fills the indexes
+
+    def timed(f, n=20):
+        start = time.time()
+        for i in range(n):
+            f()
+        return (time.time() - start)/n
+    times = [[timed(old_f), timed(new_f)] for (name, old_f), (name, new_f) in zip(old, new)]
+    new_share = [0]*len(new)
+    for i in range(20):
+        share = make_share(net, tracker.items[best[0]], rng)
+        tracker.add(share)
+        best[0] = share.hash
+        for j, (name, f) in enumerate(new):
+            new_share[j] += timed(f, 1)/20
+
+    print('%d shares' % (tracker.get_height(best[0]),))
+    print('%-14s %12s %12s %12s' % ('', 'walk', 'same best', 'new share'))
+    for (name, f), (old_time, new_time), new_share_time in zip(new, times, new_share):
+        print('%-14s %9.3f ms %9.3f ms %9.3f ms' % (name, old_time*1e3, new_time*1e3, new_share_time*1e3))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2*2880 + 10)
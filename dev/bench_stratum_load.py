@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+'''
+Stratum load: CONNS miners connect over TCP and each submits SUBMITS
+pseudoshares as fast as it can, against a worker bridge whose got_response
+computes Verthash on the reactor the way it used to, or hands it to a
+PoWQueue. Reports submissions per second, how late a 5 ms timer on the
+reactor runs (what a job notification waits behind), and the largest
+PoW queue depth seen.
+
+usage: dev/bench_stratum_load.py [CONNS [SUBMITS]]
+'''
+
+import json
+import sys
+import time
+
+import benchutil
+
+import p2pool
+
+def main(conns, submits):
+    p2pool.DEBUG = False
+    benchutil.use_dataset()
+    from twisted.internet import defer, protocol, reactor, task
+    from twisted.protocols import basic
+    from p2pool import verifier
+    from p2pool.bitcoin import data as bitcoin_data, networks, stratum
+    from p2pool.util import variable
+    net = networks.nets['vertcoin']
+    pow_func = net.POW_FUNC
+
+    class WorkerBridge(object):
+        COINBASE_NONCE_LENGTH = 8
+        share_rate = 10
+
+        def __init__(self, queued):
+            self.net = net
+            self.new_work_event = variable.Event()
+            self.pseudoshares = []
+            self.pow_queue = verifier.PoWQueue(pow_func, threads=1 if queued else 0)
+
+        def get_user_details(self, username):
+            return username, username, None, 2**256 - 1
+
+        def preprocess_request(self, username):
+            return self.get_user_details(username)
+
+        def get_local_rates(self):
+            return {}, {}
+
+        def get_work(self, user, address, desired_share_target, desired_pseudoshare_target):
+            x = dict(previous_block=1, coinb1=b'\1'*40, coinb2=b'\0'*4, merkle_link=dict(branch=[1, 2], index=0),
+                version=0x20000000, bits=bitcoin_data.FloatingInteger(0x1d00ffff), timestamp=1600000000, share_target=2**256 - 1, min_share_target=2**256 - 1)
+            def got_pow(pow_hash, username):
+                self.pseudoshares.append((username, pow_hash))
+                return True
+            def got_response(header, username, coinbase_nonce, pseudoshare_target):
+                packed_header = bitcoin_data.block_header_type.pack(header)
+                return self.pow_queue.submit(packed_header).addCallback(got_pow, username)
+            return x, got_response
+
+    class Miner(basic.LineOnlyReceiver):
+        delimiter = b'\n'
+
+        def connectionMade(self):
+            self.username = self.factory.username
+            self.responses = 0
+            self.sent = False
+            self.sendLine(json.dumps(dict(id=1, method='mining.subscribe', params=[])).encode('ascii'))
+            self.sendLine(json.dumps(dict(id=2, method='mining.authorize', params=[self.username, 'x'])).encode('ascii'))
+
+        def lineReceived(self, line):
+            msg = json.loads(line)
+            if msg.get('method') == 'mining.notify' and not self.sent:
+                self.sent = True
+                jobid = msg['params'][0]
+                for i in range(submits):
+                    self.sendLine(json.dumps(dict(id=100 + i, method='mining.submit', params=[self.username, jobid, '%08x' % (i,), '00000000', '%08x' % (i,)])).encode('ascii'))
+            elif (msg.get('id') or 0) >= 100:
+                self.responses += 1
+                if self.responses == submits:
+                    self.factory.done.callback(None)
+
+    print('%i connections, %i submits each' % (conns, submits))
+    print('%-8s %10s %14s %14s %10s' % ('', 'submits/s', 'timer lag p50', 'timer lag max', 'max depth'))
+
+    @defer.inlineCallbacks
+    def run(name, queued):
+        wb = WorkerBridge(queued)
+        factory = stratum.StratumServerFactory(wb)
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        lags, depths = [], []
+        last = [time.time()]
+        def probe():
+            now = time.time()
+            lags.append(max(0, now - last[0] - .005))
+            depths.append(wb.pow_queue.depth)
+            last[0] = now
+        timer = task.LoopingCall(probe)
+        timer.start(.005)
+        start = time.time()
+        dones = []
+        for i in range(conns):
+            client_factory = protocol.ClientFactory()
+            client_factory.protocol = Miner
+            client_factory.done = defer.Deferred()
+            client_factory.username = 'miner%i' % (i,)
+            dones.append(client_factory.done)
+            reactor.connectTCP('127.0.0.1', port.getHost().port, client_factory)
+        yield defer.DeferredList(dones)
+        elapsed = time.time() - start
+        timer.stop()
+        port.stopListening()
+        wb.pow_queue.stop()
+        assert len(wb.pseudoshares) == conns*submits
+        lags.sort()
+        print('%-8s %10.0f %11.1f ms %11.1f ms %10i' % (name, conns*submits/elapsed, lags[len(lags)//2]*1e3, lags[-1]*1e3, max(depths)))
+
+    @defer.inlineCallbacks
+    def both():
+        try:
+            yield run('reactor', False)
+            yield run('queue', True)
+        finally:
+            reactor.stop()
+    reactor.callWhenRunning(both)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20, int(sys.argv[2]) if len(sys.argv) > 2 else 100)
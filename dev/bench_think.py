@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+'''
+OkayTracker.think on a full verified chain with many competing heads (forks
+of one or two shares off its last ten shares), the situation in which it
+stalls the reactor. "cold" is the first think after the head score caches
+are dropped, "warm" is every later one with nothing changed, "new share" is
+one share on top of a random head followed by a think.
+
+usage: dev/bench_think.py [HEADS...]
+'''
+
+import random
+import sys
+import time
+
+import benchutil
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data
+
+def make_share(net, parent, rng):
+    cls = type(parent)
+    contents = benchutil.make_share_contents(net, cls, parent.hash, rng=rng)
+    share_info = contents['share_info']
+    share_info['timestamp'] = parent.timestamp + net.SHARE_PERIOD
+    share_info['absheight'] = parent.absheight + 1
+    share_info['abswork'] = parent.abswork + bitcoin_data.target_to_average_attempts(share_info['bits'].target)
+    return cls(net, None, contents, known_hashes=(rng.getrandbits(256), rng.getrandbits(256), 0, rng.getrandbits(256)))
+
+def add_share(tracker, share):
+    tracker.add(share)
+    tracker.verified.add(share)
+    return share
+
+def main(head_counts):
+    p2pool.DEBUG = False
+    from p2pool import networks
+    net = networks.nets['vertcoin']
+
+    print('%6s %12s %12s %12s' % ('heads', 'cold', 'warm', 'new share'))
+    for head_count in head_counts:
+        rng = random.Random(0)
+        tracker = benchutil.make_tracker(net, net.CHAIN_LENGTH + 100, rng=rng)
+        best = max(tracker.heads, key=tracker.get_height)
+        chain = list(tracker.get_chain(best, tracker.get_height(best)))[::-1]
+        for share in chain:
+            tracker.verified.add(share)
+        while len(tracker.verified.heads) < head_count:
+            parent = chain[-1 - rng.randrange(10)]
+            for i in range(rng.randrange(1, 3)):
+                parent = add_share(tracker, make_share(net, parent, rng))
+
+        block_heights = {}
+        def block_rel_height_func(block_hash):
+            return block_heights.setdefault(block_hash, -rng.randrange(10))
+        def think():
+            return tracker.think(block_rel_height_func, lambda block_hash: 0, 1234, None, {}, None)
+
+        cold = []
+        for i in range(10):
+            tracker.head_scores._anchors.clear()
+            tracker.head_scores._punish.clear()
+            start = time.time()
+            think()
+            cold.append(time.time() - start)
+
+        start = time.time()
+        for i in range(100):
+            think()
+        warm = (time.time() - start)/100
+
+        new_share = []
+        for i in range(50):
+            share = make_share(net, tracker.items[rng.choice(list(tracker.verified.heads))], rng)
+            start = time.time()
+            add_share(tracker, share)
+            think()
+            new_share.append(time.time() - start)
+
+        print('%6i %9.2f ms %9.2f ms %9.2f ms' % (head_count, sum(cold)/len(cold)*1e3, warm*1e3, sum(new_share)/len(new_share)*1e3))
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [10, 50, 100])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+'''
+What a known_txs/mining_txs transition costs across all peers, for a
+mempool of each of the sizes below, a tenth of it replaced: every peer
+diffing the before and after dicts itself and packing the changed txs to
+size them, the way each peer's watcher used to, against one TxSetDiffer
+diffing it once, with sizes cached, for every peer. Sending the resulting
+messages costs both the same and isn't timed.
+
+usage: dev/bench_tx_diff.py [TRANSITIONS]
+'''
+
+import random
+import sys
+import time
+
+import benchutil
+
+import p2pool
+from p2pool import p2p
+from p2pool.bitcoin import data as bitcoin_data
+from p2pool.util import variable
+
+def make_tx(rng):
+    return dict(version=1, tx_ins=[dict(previous_output=dict(hash=rng.getrandbits(256), index=0), script=b'\x00'*100, sequence=None)],
+        tx_outs=[dict(value=rng.getrandbits(40), script=b'\x00'*25) for i in range(2)], lock_time=0)
+
+def old_watcher(before, after):
+    added = set(after) - set(before)
+    removed = set(before) - set(after)
+    removed_size = sum(100 + bitcoin_data.tx_type.packed_size(before[x]) for x in removed)
+    added_size = sum(100 + bitcoin_data.tx_type.packed_size(after[x]) for x in added)
+    return list(added), list(removed), dict((h, before[h]) for h in removed), added_size, removed_size
+
+def new_watcher(diff):
+    return diff.added, diff.removed, diff.removed_txs, diff.added_size, diff.removed_size
+
+def main(transitions):
+    p2pool.DEBUG = False
+    rng = random.Random(0)
+    print('%8s %6s %14s %14s' % ('mempool', 'peers', 'per-peer diff', 'TxSetDiffer'))
+    for mempool in [2000, 10000, 20000]:
+        txs = [make_tx(rng) for i in range(mempool + mempool//10*transitions)]
+        states = [dict((bitcoin_data.get_txid(tx), tx) for tx in txs[i*(mempool//10):i*(mempool//10) + mempool]) for i in range(transitions + 1)]
+        for peers in [1, 10, 50]:
+            times = []
+            for name in ['old', 'new']:
+                var = variable.Variable(states[0])
+                if name == 'old':
+                    for i in range(peers):
+                        var.transitioned.watch(old_watcher)
+                else:
+                    differ = p2p.TxSetDiffer(var)
+                    differ.get_total_size() # as the first peer's handshake does
+                    for i in range(peers):
+                        differ.diffed.watch(new_watcher)
+                start = time.time()
+                for state in states[1:]:
+                    var.set(state)
+                times.append((time.time() - start)/transitions)
+            print('%8i %6i %11.2f ms %11.2f ms' % (mempool, peers, times[0]*1e3, times[1]*1e3))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
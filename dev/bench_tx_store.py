@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+'''
+Resident memory held by a mempool of COUNT transactions: taken from a GBT
+result into known_txs, mining_txs and mining2_txs and sized the way
+helper.getwork and work.py do, and remembered from PEERS peers, each of
+which sends all of them in remember_tx. Measured as growth in VmRSS, each
+way in its own process: with every map holding dicts decoded by tx_type,
+as they used to, and holding Tx objects from tx_store.
+
+usage: dev/bench_tx_store.py [COUNT [PEERS]]
+'''
+
+import binascii
+import gc
+import random
+import subprocess
+import sys
+
+import benchutil
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data
+from p2pool.util import pack
+
+def rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])*1024
+
+def make_tx(rng):
+    # a typical segwit spend: two inputs with signature and pubkey witnesses, two outputs
+    return dict(version=2, marker=0, flag=1,
+        tx_ins=[dict(previous_output=dict(hash=rng.getrandbits(256), index=rng.randrange(4)), script=b'', sequence=None) for i in range(2)],
+        tx_outs=[dict(value=rng.getrandbits(40), script=b'\x00\x14' + rng.getrandbits(160).to_bytes(20, 'little')) for i in range(2)],
+        witness=[[rng.getrandbits(8*72).to_bytes(72, 'little'), rng.getrandbits(8*33).to_bytes(33, 'little')] for i in range(2)],
+        lock_time=0)
+
+def run(mode, count, peers):
+    p2pool.DEBUG = False
+    rng = random.Random(0)
+    packed_txs = [bitcoin_data.tx_type.pack(make_tx(rng)) for i in range(count)]
+    gbt = [dict(data=binascii.hexlify(packed).decode('ascii'), fee=1000) for packed in packed_txs]
+    message_type = pack.ListType(bitcoin_data.tx_type if mode == 'dicts' else bitcoin_data.stored_tx_type)
+    message = pack.VarIntType().pack(count) + b''.join(packed_txs)
+    del packed_txs
+    gc.collect()
+    before = rss()
+
+    txs = []
+    for x in gbt: # helper.getwork
+        packed = binascii.unhexlify(x['data'])
+        tx_hash = bitcoin_data.hash256(packed)
+        txs.append((tx_hash, bitcoin_data.tx_type.unpack(packed) if mode == 'dicts' else bitcoin_data.tx_store.add_packed(packed, tx_hash)))
+    known_txs = dict(txs)
+    mining_txs = dict(txs)
+    mining2_txs = dict(txs)
+    sum(bitcoin_data.get_size(tx) + bitcoin_data.get_stripped_size(tx) for tx_hash, tx in txs)
+    remembered_txs = []
+    for i in range(peers): # Protocol.handle_remember_tx
+        peer_txs = message_type.unpack(message)
+        remembered_txs.append(dict((bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) if mode == 'dicts' else tx.hash, tx) for tx in peer_txs))
+        del peer_txs
+    gc.collect()
+    print(rss() - before)
+
+def main(count, peers):
+    print('%i transactions, %i peers' % (count, peers))
+    print('%-8s %12s %12s' % ('', 'RSS growth', 'per tx'))
+    for mode in ['dicts', 'store']:
+        grown = int(subprocess.check_output([sys.executable, __file__, mode, str(count), str(peers)]))
+        print('%-8s %9.1f MB %10i B' % (mode, grown/2**20, grown//count))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ['dicts', 'store']:
+        run(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000, int(sys.argv[2]) if len(sys.argv) > 2 else 4)
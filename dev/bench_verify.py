@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+'''
+Throughput of the share hash/PoW stage of ShareVerifier (what --verify-workers
+moves off the reactor) for increasing numbers of worker processes.
+
+usage: dev/bench_verify.py [SHARES] [MAX_WORKERS]
+'''
+
+import multiprocessing
+import sys
+import time
+
+import benchutil
+
+from twisted.internet import defer, task
+
+def main(reactor, count, max_workers):
+    benchutil.use_dataset()
+    from p2pool import networks, verifier
+    net = networks.nets['vertcoin']
+    shares = [benchutil.make_raw_share(net) for i in range(count)]
+
+    @defer.inlineCallbacks
+    def run():
+        workers = 0
+        base = None
+        while workers <= max_workers:
+            v = verifier.ShareVerifier(net, workers)
+            yield v.get_hashes(shares[:max(1, workers)]) # warm up: spawn workers, map the dataset
+            start = time.time()
+            hashes = yield v.get_hashes(shares)
+            dt = time.time() - start
+            assert None not in hashes
+            v.stop()
+            base = base or count/dt
+            print('%2i workers: %8.1f shares/s (%.2fx)' % (workers, count/dt, count/dt/base))
+            workers = workers*2 if workers else 1
+    return run()
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    task.react(main, [count, max_workers])
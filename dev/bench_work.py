@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+'''
+Cost of building one stratum job (generate_transaction for a single miner)
+on top of a full share chain: from scratch, as get_work did for every
+miner, against reusing the per-template part that WorkerBridge now shares
+between all jobs for the same bitcoind work and best share.
+
+usage: dev/bench_work.py [TXS...]
+'''
+
+import random
+import sys
+import timeit
+
+import benchutil
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data
+
+def rate(func, seconds=.3):
+    number = 1
+    while True:
+        dt = timeit.timeit(func, number=number)
+        if dt > seconds:
+            return dt/number
+        number *= 2
+
+def make_tx(rng):
+    return dict(version=1, tx_ins=[dict(previous_output=dict(hash=rng.getrandbits(256), index=0), script=bytes(107), sequence=None) for i in range(2)],
+        tx_outs=[dict(value=rng.getrandbits(40), script=bytes(25)) for i in range(2)], lock_time=0)
+
+def main(sizes):
+    p2pool.DEBUG = False
+    from p2pool import data as p2pool_data, networks
+    net = networks.nets['vertcoin']
+    rng = random.Random(0)
+    tracker = benchutil.make_tracker(net, net.REAL_CHAIN_LENGTH + 10, rng=rng)
+    best = max(tracker.heads, key=tracker.get_height)
+    subsidy = net.PARENT.SUBSIDY_FUNC(1000000)
+    share_type = type(tracker.items[best])
+
+    print('%8s %12s %12s %12s %10s' % ('txs', 'template', 'old job', 'new job', 'speedup'))
+    for size in sizes:
+        txs = dict((bitcoin_data.get_txid(tx), tx) for tx in (make_tx(rng) for i in range(size)))
+        hashes_and_fees = [(tx_hash, rng.randrange(10**6)) for tx_hash in txs]
+        address = bitcoin_data.pubkey_hash_to_address(rng.getrandbits(160), net.PARENT.ADDRESS_VERSION, -1, net.PARENT)
+        kwargs = dict(
+            tracker=tracker,
+            share_data=dict(previous_share_hash=best, coinbase=b'\x01\x02', nonce=0, address=address, subsidy=subsidy,
+                donation=0, stale_info=None, desired_version=share_type.VOTING_VERSION),
+            block_target=2**240,
+            desired_timestamp=1600000000 + (net.REAL_CHAIN_LENGTH + 10)*net.SHARE_PERIOD,
+            desired_target=2**256-1,
+            ref_merkle_link=dict(branch=[], index=0),
+            net=net,
+        )
+        def make_template():
+            return share_type.generate_transaction_template(tracker, best, 2**240, subsidy, hashes_and_fees, net, txs)
+        template = make_template()
+        old = lambda: share_type.generate_transaction(desired_other_transaction_hashes_and_fees=hashes_and_fees, known_txs=txs, **kwargs)
+        new = lambda: share_type.generate_transaction(desired_other_transaction_hashes_and_fees=None, template=template, **kwargs)
+        assert old()[:3] == new()[:3]
+
+        times = [rate(make_template), rate(old), rate(new)]
+        print('%8i %s %9.1fx' % (size, ' '.join('%9.2f ms' % (t*1e3,) for t in times), times[1]/times[2]))
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [0, 1000, 5000])
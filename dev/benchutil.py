@@ -0,0 +1,104 @@
+'''
+Helpers shared by the dev/bench_*.py scripts: synthetic shares and a stand-in
+Verthash dataset so they can run without a real verthash.dat.
+'''
+
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import p2pool # before any chdir; p2pool.__version__ is looked up relative to argv[0]
+from p2pool.bitcoin import data as bitcoin_data
+
+VERTHASH_SUM = b'a55531e843cd56b010114aaf6325b0d529ecf88f8ad47639b6ededafd721aa48'
+
+def use_dataset(size=2**26):
+    '''chdirs to a directory with a verthash.dat, creating a random one of the
+    given size (with a sidecar vouching for it) if the current directory
+    doesn't have the real thing. Must be called before importing networks.'''
+    if os.path.exists('verthash.dat'):
+        return
+    dirname = os.path.join(tempfile.gettempdir(), 'p2pool-bench-%i' % (size,))
+    filename = os.path.join(dirname, 'verthash.dat')
+    if not os.path.exists(filename):
+        os.makedirs(dirname, exist_ok=True)
+        with open(filename + '.new', 'wb') as f:
+            for i in range(0, size, 2**20):
+                f.write(os.urandom(min(2**20, size - i)))
+        os.replace(filename + '.new', filename)
+    st = os.stat(filename)
+    with open(filename + '.sha256', 'wb') as f:
+        f.write(b'%i %i %s\n' % (st.st_size, st.st_mtime_ns, VERTHASH_SUM))
+    os.chdir(dirname)
+    print('Using a random %i MB stand-in for verthash.dat in %s' % (size >> 20, dirname))
+
+def make_share_contents(net, cls, previous_share_hash=None, branch_length=10, rng=random):
+    address = bitcoin_data.pubkey_hash_to_address(rng.getrandbits(160), net.PARENT.ADDRESS_VERSION, -1, net.PARENT)
+    from p2pool import data as p2pool_data
+    return dict(
+        min_header=dict(
+            version=0x20000000,
+            previous_block=rng.getrandbits(256),
+            timestamp=1600000000,
+            bits=bitcoin_data.FloatingInteger.from_target_upper_bound(2**240),
+            nonce=rng.getrandbits(32),
+        ),
+        share_info=dict(
+            share_data=dict(
+                previous_share_hash=previous_share_hash if previous_share_hash is not None else rng.getrandbits(256),
+                coinbase=bytes(rng.getrandbits(8) for i in range(40)),
+                nonce=rng.getrandbits(32),
+                address=address,
+                subsidy=25*10**8,
+                donation=0,
+                stale_info=None,
+                desired_version=cls.VERSION,
+            ),
+            segwit_data=dict(txid_merkle_link=dict(branch=[rng.getrandbits(256) for i in range(branch_length)], index=0), wtxid_merkle_root=rng.getrandbits(256)),
+            far_share_hash=rng.getrandbits(256),
+            max_bits=bitcoin_data.FloatingInteger.from_target_upper_bound(net.MAX_TARGET),
+            bits=bitcoin_data.FloatingInteger.from_target_upper_bound(net.MAX_TARGET),
+            timestamp=1600000000,
+            absheight=100,
+            abswork=2**80,
+        ),
+        ref_merkle_link=dict(branch=[], index=0),
+        last_txout_nonce=rng.getrandbits(64),
+        hash_link=p2pool_data.prefix_to_hash_link(bytes(rng.getrandbits(8) for i in range(300)) + cls.gentx_before_refhash, cls.gentx_before_refhash),
+        merkle_link=dict(branch=[rng.getrandbits(256) for i in range(branch_length)], index=0),
+    )
+
+def make_raw_share(net, cls=None, **kwargs):
+    '''a share_type record as sent over the wire. Its PoW is not valid, so
+    load it with known_hashes if it has to get past BaseShare.__init__.'''
+    from p2pool import data as p2pool_data
+    if cls is None:
+        cls = p2pool_data.PaddingBugfixShare
+    return dict(type=cls.VERSION, contents=cls.get_dynamic_types(net)['share_type'].pack(make_share_contents(net, cls, **kwargs)))
+
+def make_tracker(net, length, addresses=100, cls=None, rng=random):
+    '''an OkayTracker with a chain of length synthetic shares, one share
+    period apart, paying to a pool of random addresses. Shares are loaded
+    with made-up known_hashes, so none of them are verified.'''
+    from p2pool import data as p2pool_data
+    if cls is None:
+        cls = p2pool_data.PaddingBugfixShare
+    addresses = [bitcoin_data.pubkey_hash_to_address(rng.getrandbits(160), net.PARENT.ADDRESS_VERSION, -1, net.PARENT) for i in range(addresses)]
+    tracker = p2pool_data.OkayTracker(net)
+    previous_share = None
+    for i in range(length):
+        contents = make_share_contents(net, cls, previous_share.hash if previous_share is not None else None, rng=rng)
+        share_info = contents['share_info']
+        share_info['share_data']['address'] = rng.choice(addresses)
+        share_info['timestamp'] = 1600000000 + i*net.SHARE_PERIOD
+        share_info['absheight'] = i + 1
+        share_info['abswork'] = (previous_share.abswork if previous_share is not None else 0) + bitcoin_data.target_to_average_attempts(share_info['bits'].target)
+        if previous_share is None:
+            share_info['share_data']['previous_share_hash'] = None
+            share_info['far_share_hash'] = None
+        previous_share = cls(net, None, contents, known_hashes=(rng.getrandbits(256), rng.getrandbits(256), 0, rng.getrandbits(256)))
+        tracker.add(previous_share)
+    return tracker
@@ -472,9 +472,9 @@ static void smix(uint8_t *, size_t, uint64_t, uint32_t *, uint32_t *);
 static void
 blkcpy(void * dest, void * src, size_t len)
 {
-	size_t * D = dest;
-	size_t * S = src;
-	size_t L = len / sizeof(size_t);
+	uint32_t * D = dest;
+	uint32_t * S = src;
+	size_t L = len / sizeof(uint32_t);
 	size_t i;
 
 	for (i = 0; i < L; i++)
@@ -484,9 +484,9 @@ blkcpy(void * dest, void * src, size_t len)
 static void
 blkxor(void * dest, void * src, size_t len)
 {
-	size_t * D = dest;
-	size_t * S = src;
-	size_t L = len / sizeof(size_t);
+	uint32_t * D = dest;
+	uint32_t * S = src;
+	size_t L = len / sizeof(uint32_t);
 	size_t i;
 
 	for (i = 0; i < L; i++)
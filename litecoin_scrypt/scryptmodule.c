@@ -1,29 +1,187 @@
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 
-//#include "scrypt.h"
+#include <stdlib.h>
+#include <string.h>
+
+#ifndef _WIN32
+#include <pthread.h>
+#endif
+
+// scrypt.h defines scrypt_scratchpad_size, so including it here as well as
+// in scrypt.c would define it twice
+void scrypt_1024_1_1_256(const char* input, char* output);
+
+#define HEADER_SIZE 80
+#define HASH_SIZE 32
+#define MAX_THREADS 64
 
 static PyObject *scrypt_getpowhash(PyObject *self, PyObject *args)
 {
+    Py_buffer input;
+    char output[HASH_SIZE];
+    if (!PyArg_ParseTuple(args, "y*", &input))
+        return NULL;
+    if (input.len < HEADER_SIZE) {
+        PyBuffer_Release(&input);
+        PyErr_SetString(PyExc_ValueError, "header must be at least 80 bytes");
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    scrypt_1024_1_1_256((const char *)input.buf, output);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&input);
+    return PyBytes_FromStringAndSize(output, HASH_SIZE);
+}
+
+struct batch {
+    const char *input;
     char *output;
-    PyObject *value;
-    PyStringObject *input;
-    if (!PyArg_ParseTuple(args, "S", &input))
+    Py_ssize_t start;
+    Py_ssize_t step;
+    Py_ssize_t count;
+};
+
+static void hash_batch(struct batch *batch)
+{
+    Py_ssize_t i;
+    for (i = batch->start; i < batch->count; i += batch->step)
+        scrypt_1024_1_1_256(batch->input + i*HEADER_SIZE, batch->output + i*HASH_SIZE);
+}
+
+#ifndef _WIN32
+static void *hash_batch_thread(void *arg)
+{
+    hash_batch((struct batch *)arg);
+    return NULL;
+}
+#endif
+
+// hashes count headers from input into output, in this thread and up to
+// threads - 1 others. called without the GIL.
+static void hash_headers(const char *input, char *output, Py_ssize_t count, int threads)
+{
+    struct batch batches[MAX_THREADS];
+    int i;
+#ifndef _WIN32
+    pthread_t ids[MAX_THREADS];
+    int started[MAX_THREADS];
+#endif
+
+    if (threads > count)
+        threads = (int)count;
+    if (threads < 1)
+        threads = 1;
+    for (i = 0; i < threads; i++) {
+        batches[i].input = input;
+        batches[i].output = output;
+        batches[i].start = i;
+        batches[i].step = threads;
+        batches[i].count = count;
+    }
+#ifndef _WIN32
+    for (i = 1; i < threads; i++)
+        started[i] = pthread_create(&ids[i], NULL, hash_batch_thread, &batches[i]) == 0;
+    hash_batch(&batches[0]);
+    for (i = 1; i < threads; i++) {
+        if (started[i])
+            pthread_join(ids[i], NULL);
+        else
+            hash_batch(&batches[i]);
+    }
+#else
+    for (i = 0; i < threads; i++)
+        hash_batch(&batches[i]);
+#endif
+}
+
+static PyObject *scrypt_getpowhashes(PyObject *self, PyObject *args)
+{
+    PyObject *headers, *seq, *value;
+    Py_buffer input;
+    char *joined = NULL;
+    const char *buf;
+    Py_ssize_t count, i;
+    int threads = 1;
+    if (!PyArg_ParseTuple(args, "O|i", &headers, &threads))
         return NULL;
-    Py_INCREF(input);
-    output = PyMem_Malloc(32);
+    if (threads > MAX_THREADS)
+        threads = MAX_THREADS;
+
+    if (PyObject_CheckBuffer(headers)) {
+        // 80-byte headers back to back
+        if (PyObject_GetBuffer(headers, &input, PyBUF_SIMPLE) < 0)
+            return NULL;
+        if (input.len % HEADER_SIZE) {
+            PyBuffer_Release(&input);
+            PyErr_SetString(PyExc_ValueError, "buffer length is not a multiple of 80");
+            return NULL;
+        }
+        count = input.len / HEADER_SIZE;
+        buf = (const char *)input.buf;
+    } else {
+        // a sequence of headers, copied into one buffer so that the hashing
+        // doesn't touch Python objects
+        seq = PySequence_Fast(headers, "headers must be a buffer or a sequence of headers");
+        if (seq == NULL)
+            return NULL;
+        count = PySequence_Fast_GET_SIZE(seq);
+        joined = PyMem_Malloc(count ? count*HEADER_SIZE : 1);
+        if (joined == NULL) {
+            Py_DECREF(seq);
+            return PyErr_NoMemory();
+        }
+        for (i = 0; i < count; i++) {
+            if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(seq, i), &input, PyBUF_SIMPLE) < 0) {
+                PyMem_Free(joined);
+                Py_DECREF(seq);
+                return NULL;
+            }
+            if (input.len < HEADER_SIZE) {
+                PyBuffer_Release(&input);
+                PyMem_Free(joined);
+                Py_DECREF(seq);
+                PyErr_SetString(PyExc_ValueError, "header must be at least 80 bytes");
+                return NULL;
+            }
+            memcpy(joined + i*HEADER_SIZE, input.buf, HEADER_SIZE);
+            PyBuffer_Release(&input);
+        }
+        Py_DECREF(seq);
+        buf = joined;
+    }
 
-    scrypt_1024_1_1_256((char *)PyString_AsString((PyObject*) input), output);
-    Py_DECREF(input);
-    value = Py_BuildValue("s#", output, 32);
-    PyMem_Free(output);
+    value = PyBytes_FromStringAndSize(NULL, count*HASH_SIZE);
+    if (value != NULL) {
+        char *output = PyBytes_AS_STRING(value);
+        Py_BEGIN_ALLOW_THREADS
+        hash_headers(buf, output, count, threads);
+        Py_END_ALLOW_THREADS
+    }
+
+    if (joined != NULL)
+        PyMem_Free(joined);
+    else
+        PyBuffer_Release(&input);
     return value;
 }
 
 static PyMethodDef ScryptMethods[] = {
     { "getPoWHash", scrypt_getpowhash, METH_VARARGS, "Returns the proof of work hash using scrypt" },
+    { "getPoWHashes", scrypt_getpowhashes, METH_VARARGS, "getPoWHashes(headers, threads=1)\n\nReturns the proof of work hashes of a sequence of headers, or of a buffer of 80-byte headers back to back, as their 32-byte digests concatenated. Runs without the GIL, split across up to threads threads." },
     { NULL, NULL, 0, NULL }
 };
 
-PyMODINIT_FUNC initltc_scrypt(void) {
-    (void) Py_InitModule("ltc_scrypt", ScryptMethods);
+static struct PyModuleDef ScryptModule = {
+    PyModuleDef_HEAD_INIT,
+    "ltc_scrypt",
+    "Bindings for scrypt proof of work used by Litecoin",
+    -1,
+    ScryptMethods
+};
+
+PyMODINIT_FUNC PyInit_ltc_scrypt(void) {
+    return PyModule_Create(&ScryptModule);
 }
@@ -1,11 +1,14 @@
-from distutils.core import setup, Extension
+import sys
+
+from setuptools import setup, Extension
 
 ltc_scrypt_module = Extension('ltc_scrypt',
                                sources = ['scryptmodule.c',
                                           'scrypt.c'],
-                               include_dirs=['.'])
+                               include_dirs=['.'],
+                               libraries=[] if sys.platform == 'win32' else ['pthread'])
 
 setup (name = 'ltc_scrypt',
-       version = '1.0',
+       version = '1.1',
        description = 'Bindings for scrypt proof of work used by Litecoin',
        ext_modules = [ltc_scrypt_module])
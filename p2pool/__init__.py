@@ -48,3 +48,4 @@ def _get_version():
 __version__ = _get_version()
 
 DEBUG = True
+BENCH = False
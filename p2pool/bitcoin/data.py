@@ -1,8 +1,11 @@
+import collections
 import hashlib
 import random
+import threading
 import warnings
 import binascii
 import traceback
+import weakref
 
 import p2pool
 from p2pool.util import math, pack, segwit_addr, cash_addr
@@ -104,6 +107,7 @@ class FloatingInteger(object):
 
 class FloatingIntegerType(pack.Type):
     _inner = pack.IntType(32)
+    _interned = {} # bits -> FloatingInteger; shares and headers mostly repeat a few bits values, so they share one (and its target)
     
     def read(self, file):
         bits = self._inner.read(file)
@@ -112,6 +116,22 @@ class FloatingIntegerType(pack.Type):
     def write(self, file, item):
         return self._inner.write(file, item.bits)
 
+    def _compile_reader(self):
+        read_inner, interned = self._inner._get_reader(), self._interned
+        def reader(data, pos):
+            bits, pos = read_inner(data, pos)
+            res = interned.get(bits)
+            if res is None:
+                if len(interned) >= 4096: # peers can send any bits
+                    interned.clear()
+                res = interned[bits] = FloatingInteger(bits)
+            return res, pos
+        return reader
+
+    def _compile_writer(self):
+        write_inner = self._inner._get_writer()
+        return lambda parts, item: write_inner(parts, item.bits)
+
 address_type = pack.ComposedType([
     ('services', pack.IntType(64)),
     ('address', pack.IPV6AddressType()),
@@ -119,6 +139,8 @@ address_type = pack.ComposedType([
 ])
 
 def is_segwit_tx(tx):
+    if isinstance(tx, Tx):
+        return tx.segwit
     return tx.get('marker', -1) == 0 and tx.get('flag', -1) >= 1
 
 tx_in_type = pack.ComposedType([
@@ -143,10 +165,14 @@ tx_id_type = pack.ComposedType([
 ])
 
 def get_stripped_size(tx):
+    if isinstance(tx, Tx):
+        return tx.stripped_size
     if not 'stripped_size' in tx:
         tx['stripped_size'] = tx_id_type.packed_size(tx)
     return tx['stripped_size']
 def get_size(tx):
+    if isinstance(tx, Tx):
+        return tx.stripped_size # what get_size has always measured, witness left out
     if not 'size' in tx:
         tx['size'] = tx_id_type.packed_size(tx)
     return tx['size']
@@ -190,6 +216,9 @@ class TransactionType(pack.Type):
             return dict(version=version, tx_ins=tx_ins, tx_outs=next['tx_outs'], lock_time=next['lock_time'])
     
     def write(self, file, item):
+        if isinstance(item, Tx):
+            file.write(item.raw)
+            return
         if is_segwit_tx(item):
             assert len(item['tx_ins']) == len(item['witness'])
             self._write_type.write(file, item)
@@ -199,8 +228,144 @@ class TransactionType(pack.Type):
             return
         return tx_id_type.write(file, item)
 
+    def _compile_reader(self):
+        read_int, read_varint, read_wtx, read_ntx, read_witness, read_tx_in = [t._get_reader() for t in
+            [self._int_type, self._varint_type, self._wtx_type, self._ntx_type, self._witness_type, tx_in_type]]
+        def reader(data, pos):
+            version, pos = read_int(data, pos)
+            marker, pos = read_varint(data, pos)
+            if marker == 0:
+                next, pos = read_wtx(data, pos)
+                witness = [None]*len(next['tx_ins'])
+                for i in range(len(next['tx_ins'])):
+                    witness[i], pos = read_witness(data, pos)
+                locktime, pos = read_int(data, pos)
+                return dict(version=version, marker=marker, flag=next['flag'], tx_ins=next['tx_ins'], tx_outs=next['tx_outs'], witness=witness, lock_time=locktime), pos
+            else:
+                tx_ins = [None]*marker
+                for i in range(marker):
+                    tx_ins[i], pos = read_tx_in(data, pos)
+                next, pos = read_ntx(data, pos)
+                return dict(version=version, tx_ins=tx_ins, tx_outs=next['tx_outs'], lock_time=next['lock_time']), pos
+        return reader
+
+    def _compile_writer(self):
+        write_int, write_wtx, write_witness, write_tx_id = [t._get_writer() for t in
+            [self._int_type, self._write_type, self._witness_type, tx_id_type]]
+        def writer(parts, item):
+            if isinstance(item, Tx):
+                parts.append(item.raw)
+            elif is_segwit_tx(item):
+                assert len(item['tx_ins']) == len(item['witness'])
+                write_wtx(parts, item)
+                for w in item['witness']:
+                    write_witness(parts, w)
+                write_int(parts, item['lock_time'])
+            else:
+                write_tx_id(parts, item)
+        return writer
+
 tx_type = TransactionType()
 
+class Tx(object):
+    """A transaction as it was serialized, which is how known_txs and the
+    maps fed from it hold transactions. Its hash (of the whole serialization,
+    what those maps are keyed by), txid, wtxid, sizes and weight are worked
+    out once here; its fields are decoded from raw each time something reads
+    them. Get them from tx_store, so that a transaction held by several maps
+    is kept once. Read-only: decode() gives a dict that can be changed."""
+
+    __slots__ = ['raw', 'hash', 'txid', 'wtxid', 'size', 'stripped_size', 'weight', 'segwit', '__weakref__']
+
+    def __init__(self, raw, tx_hash=None, record=None):
+        self.raw = raw = bytes(raw)
+        self.hash = hash256(raw) if tx_hash is None else tx_hash
+        self.size = len(raw)
+        self.segwit = len(raw) > 5 and raw[4] == 0 and raw[5] >= 1 # marker and flag
+        if self.segwit:
+            if record is None:
+                record = tx_type.unpack(raw)
+            stripped = tx_id_type.pack(record)
+            self.txid = hash256(stripped)
+            self.stripped_size = len(stripped)
+            self.wtxid = self.hash if any(len(w) > 0 for w in record['witness']) else self.txid
+        else:
+            self.txid = self.wtxid = self.hash
+            self.stripped_size = self.size
+        self.weight = 3*self.stripped_size + self.size
+
+    def decode(self):
+        return tx_type.unpack(self.raw)
+
+    def __getitem__(self, key):
+        return self.decode()[key]
+
+    def get(self, key, default=None):
+        return self.decode().get(key, default)
+
+    def __contains__(self, key):
+        return key in self.decode()
+
+    def __eq__(self, other):
+        if isinstance(other, Tx):
+            return self.raw == other.raw
+        if isinstance(other, dict):
+            return self.decode() == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.hash)
+
+    def __repr__(self):
+        return '<Tx %064x>' % (self.hash,)
+
+class TxStore(object):
+    """Every Tx in use, by hash, so that a transaction heard of from GBT,
+    bitcoind's p2p connection and any number of peers is kept once. Holds
+    them weakly: a Tx is dropped when the last map holding it lets go."""
+
+    def __init__(self):
+        self._txs = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._txs)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self._txs
+
+    def get(self, tx_hash):
+        return self._txs.get(tx_hash)
+
+    def add_packed(self, packed, tx_hash=None, record=None):
+        if tx_hash is None:
+            tx_hash = hash256(packed)
+        tx = self._txs.get(tx_hash)
+        if tx is None:
+            tx = self._txs[tx_hash] = Tx(packed, tx_hash, record)
+        return tx
+
+    def add(self, tx):
+        if isinstance(tx, Tx):
+            return self._txs.setdefault(tx.hash, tx)
+        return self.add_packed(tx_type.pack(tx), record=tx)
+
+tx_store = TxStore()
+
+class StoredTransactionType(TransactionType):
+    # tx_type for messages whose transactions end up in known_txs: reads them
+    # into tx_store instead of into dicts
+    def read(self, file):
+        return tx_store.add(TransactionType.read(self, file))
+
+    def _compile_reader(self):
+        read_tx = TransactionType._compile_reader(self)
+        def reader(data, pos):
+            record, end = read_tx(data, pos)
+            return tx_store.add_packed(data[pos:end], record=record), end
+        return reader
+
+stored_tx_type = StoredTransactionType()
+
 merkle_link_type = pack.ComposedType([
     ('branch', pack.ListType(pack.IntType(256))),
     ('index', pack.IntType(32)),
@@ -355,6 +520,161 @@ def calculate_merkle_link(hashes, index):
         index_node = index_node.parent
     return {'index': index, 'branch': merkle_branch}
 
+def _common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]: # the usual case: b is a with things appended or removed at the end
+        return n
+    lo, hi = 0, n - 1
+    while lo < hi:
+        mid = (lo + hi + 1)//2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+class MerkleTree(object):
+    """Merkle tree over a list of hashes, stored as a flat list of packed
+    node hashes per level, leaves first. When built from a base tree, nodes
+    are shared with it and only those above leaves that differ are rehashed,
+    so a transaction list that only changed at the end costs a few hashes per
+    level. None leaves count as 0, like in calculate_merkle_link."""
+
+    __slots__ = ['hashes', 'levels']
+
+    def __init__(self, hashes, base=None):
+        self.hashes = hashes = list(hashes)
+        base_hashes, base_levels = (base.hashes, base.levels) if base is not None else ([], [])
+
+        first = _common_prefix_length(base_hashes, hashes)
+        dirty = [i for i in range(first, len(hashes)) if i >= len(base_hashes) or hashes[i] != base_hashes[i]]
+        level = base_levels[0][:len(hashes)] if base_levels else []
+        level.extend([None]*(len(hashes) - len(level)))
+        for i in dirty:
+            level[i] = pack256(hashes[i])
+        self.levels = levels = [level]
+
+        sha256 = hashlib.sha256
+        while len(level) > 1:
+            k = len(levels)
+            old_length = len(base_levels[k - 1]) if k - 1 < len(base_levels) else 0
+            parent = base_levels[k][:(len(level) + 1)//2] if k < len(base_levels) else []
+            dirty_parents = set(i >> 1 for i in dirty)
+            dirty_parents.update(range(len(parent), (len(level) + 1)//2))
+            if len(level) != old_length:
+                dirty_parents.add((len(level) - 1) >> 1) # the last node's sibling changed, or it's now paired with itself
+            parent.extend([None]*((len(level) + 1)//2 - len(parent)))
+            dirty = sorted(dirty_parents)
+            for i in dirty:
+                left = level[2*i]
+                right = level[2*i + 1] if 2*i + 1 < len(level) else left
+                parent[i] = sha256(sha256(left + right).digest()).digest()
+            levels.append(parent)
+            level = parent
+
+    def get_root(self):
+        if not self.hashes:
+            return 0
+        return unpack256(self.levels[-1][0])
+
+    def get_link(self, index):
+        assert index < len(self.hashes)
+        branch = []
+        i = index
+        for level in self.levels[:-1]:
+            branch.append(unpack256(level[i ^ 1 if i ^ 1 < len(level) else i]))
+            i >>= 1
+        return {'index': index, 'branch': branch}
+
+class MerkleTreeCache(object):
+    """Keeps the last few MerkleTrees built. A list seen before returns its
+    tree; otherwise the new tree is built from the cached one sharing the
+    longest prefix with it."""
+
+    def __init__(self, size=8):
+        self.size = size
+        self.trees = [] # least recently used first
+
+    def get(self, hashes):
+        hashes = list(hashes)
+        best, best_length = None, -1
+        for i, tree in enumerate(self.trees):
+            if tree.hashes == hashes:
+                self.trees.append(self.trees.pop(i))
+                return tree
+            length = _common_prefix_length(tree.hashes, hashes)
+            if length > best_length:
+                best, best_length = tree, length
+        tree = MerkleTree(hashes, best)
+        self.trees.append(tree)
+        del self.trees[:-self.size]
+        return tree
+
+merkle_tree_cache = MerkleTreeCache()
+
+class PoWCache(object):
+    """Wraps a network's POW_FUNC, remembering the results for the last few
+    headers: the same header is hashed by the share, block and work code
+    alike, and Verthash is slow. Callable from any thread; the hash itself
+    runs outside the lock. batch_func, the network's POW_BATCH_FUNC if it
+    has one, hashes a list of headers in one call to packed 32-byte
+    digests; get_many uses it for the headers that miss."""
+
+    def __init__(self, pow_func, batch_func=None, size=4096):
+        self.pow_func = pow_func
+        self.batch_func = batch_func
+        self.size = size
+        self._lock = threading.Lock()
+        self._results = collections.OrderedDict() # header -> pow hash, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, header):
+        header = bytes(header)
+        with self._lock:
+            res = self._results.get(header)
+            if res is not None:
+                self._results.move_to_end(header)
+                self.hits += 1
+                return res
+            self.misses += 1
+        res = self.pow_func(header)
+        with self._lock:
+            self._results[header] = res
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return res
+
+    def get_many(self, headers):
+        headers = [bytes(header) for header in headers]
+        res = {}
+        with self._lock:
+            for header in headers:
+                if header in res:
+                    continue
+                value = self._results.get(header)
+                if value is not None:
+                    self._results.move_to_end(header)
+                    self.hits += 1
+                res[header] = value
+            missing = [header for header, value in res.items() if value is None]
+            self.misses += len(missing)
+        if self.batch_func is not None and missing:
+            digests = self.batch_func(missing)
+            values = [pack.IntType(256).unpack(digests[i*32:i*32 + 32]) for i in range(len(missing))]
+        else:
+            values = [self.pow_func(header) for header in missing]
+        with self._lock:
+            for header, value in zip(missing, values):
+                self._results[header] = res[header] = value
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return [res[header] for header in headers]
+
+    def get_stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._results))
+
 def check_merkle_link(tip_hash, link):
     if link['index'] >= 2**len(link['branch']):
         raise ValueError('index too large')
@@ -492,6 +812,8 @@ def get_witness_commitment_hash(witness_root_hash, witness_reserved_value):
     return hash256(merkle_record_type.pack(dict(left=witness_root_hash, right=witness_reserved_value)))
 
 def get_wtxid(tx, txid=None, txhash=None):
+    if isinstance(tx, Tx):
+        return tx.wtxid
     has_witness = False
     if is_segwit_tx(tx):
         assert len(tx['tx_ins']) == len(tx['witness'])
@@ -502,11 +824,13 @@ def get_wtxid(tx, txid=None, txhash=None):
         return hash256(tx_id_type.pack(tx)) if txid is None else txid
 
 def get_txid(tx):
+    if isinstance(tx, Tx):
+        return tx.txid
     return hash256(tx_id_type.pack(tx))
 
 def pubkey_to_script2(pubkey):
     assert len(pubkey) <= 75
-    return (bytes(len(pubkey)) + pubkey) + b'\xac'
+    return bytes([len(pubkey)]) + pubkey + b'\xac'
 
 def pubkey_hash_to_script2(pubkey_hash, version, bech32_version, net):
     if version == -1 and bech32_version >= 0:
@@ -11,7 +11,7 @@ from p2pool.util import pack
 def _swap4(s):
     if len(s) % 4:
         raise ValueError()
-    return ''.join(s[x:x+4][::-1] for x in range(0, len(s), 4))
+    return b''.join(s[x:x+4][::-1] for x in range(0, len(s), 4))
 
 class BlockAttempt(object):
     def __init__(self, version, previous_block, merkle_root, timestamp, bits, share_target):
@@ -99,7 +99,7 @@ def getwork(bitcoind, use_getblocktemplate=False, txidcache={}, feecache={}, fee
             knownmisses += 1
             if not packed:
                 packed = binascii.unhexlify(x)
-            unpacked = bitcoin_data.tx_type.unpack(packed)
+            unpacked = bitcoin_data.tx_store.add_packed(packed, txid)
         unpacked_transactions.append(unpacked)
         # The only place where we can get information on transaction fees is in GBT results, so we need to store those
         # for a while so we can spot shares that miscalculate the block reward
@@ -1,7 +1,10 @@
 import pkgutil
 from importlib import import_module
 
+from p2pool.bitcoin import data
+
 nets = dict((name, import_module('p2pool.bitcoin.networks.%s' %name))
     for module_loader, name, ispkg in pkgutil.iter_modules(__path__))
 for net_name, net in nets.items():
     net.NAME = net_name
+    net.POW_FUNC = data.PoWCache(net.POW_FUNC, getattr(net, 'POW_BATCH_FUNC', None))
@@ -1,24 +1,15 @@
 import os
 import platform
-import hashlib
 
 from twisted.internet import defer
 
-from .. import data, helper
+from .. import data, helper, verthash_dataset
 from p2pool.util import pack
 
-import verthash
-
-verthash_data = None
-if verthash_data is None:
-    with open('verthash.dat', 'rb') as f:
-        verthash_data = f.read()
-
-    verthash_sum = hashlib.sha256(verthash_data).hexdigest().encode('ascii')
-    assert verthash_sum == b'a55531e843cd56b010114aaf6325b0d529ecf88f8ad47639b6ededafd721aa48'
+verthash_data = verthash_dataset.get_dataset('verthash.dat', b'a55531e843cd56b010114aaf6325b0d529ecf88f8ad47639b6ededafd721aa48')
 
 def verthash_hash(dat):
-    return verthash.getPoWHash(dat, verthash_data)
+    return verthash_data.hash(dat)
 
 P2P_PREFIX = bytes.fromhex('fabfb5da') # new net magic
 P2P_PORT = 5889
@@ -32,6 +23,7 @@ RPC_CHECK = defer.inlineCallbacks(lambda bitcoind: defer.returnValue(
         ))
 SUBSIDY_FUNC = lambda height: 50*100000000 >> (height + 1)//840000
 POW_FUNC = lambda data: pack.IntType(256).unpack(verthash_hash(data))
+POW_BATCH_FUNC = lambda headers: verthash_data.hash_many(headers)
 BLOCK_PERIOD = 150 # s
 SYMBOL='VTC'
 CONF_FILE_FUNC=lambda: os.path.join(os.path.join(os.environ['APPDATA'], 'Vertcoin') if platform.system() == 'Windows' else os.path.expanduser('~/Library/Application Support/Vertcoin/') if platform.system() == 'Darwin' else os.path.expanduser('~/.vertcoin'), 'vertcoin.conf')
@@ -3,18 +3,13 @@ import platform
 
 from twisted.internet import defer
 
-from .. import data, helper
+from .. import data, helper, verthash_dataset
 from p2pool.util import pack
 
-import verthash
-
-verthash_data = None
-if verthash_data is None:
-    with open('verthash.dat', 'rb') as f:
-        verthash_data = f.read()
+verthash_data = verthash_dataset.get_dataset('verthash.dat')
 
 def verthash_hash(dat):
-    return verthash.getPoWHash(dat, verthash_data)
+    return verthash_data.hash(dat)
 
 P2P_PREFIX=bytes.fromhex('76657274')
 P2P_PORT=15889
@@ -24,6 +19,7 @@ RPC_PORT=15888
 RPC_CHECK=lambda bitcoind: True
 SUBSIDY_FUNC=lambda height: 50*100000000 >> (height + 1)//840000
 POW_FUNC=lambda data: pack.IntType(256).unpack(verthash_hash(data))
+POW_BATCH_FUNC=lambda headers: verthash_data.hash_many(headers)
 BLOCK_PERIOD=150 # s
 SYMBOL='VTCTEST'
 CONF_FILE_FUNC=lambda: os.path.join(os.path.join(os.environ['APPDATA'], 'Vertcoin') if platform.system() == 'Windows' else os.path.expanduser('~/Library/Application Support/Vertcoin/') if platform.system() == 'Darwin' else os.path.expanduser('~/.vertcoin'), 'vertcoin.conf')
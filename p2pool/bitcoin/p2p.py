@@ -106,7 +106,7 @@ class Protocol(p2protocol.Protocol):
             pass
     
     message_tx = pack.ComposedType([
-        ('tx', bitcoin_data.tx_type),
+        ('tx', bitcoin_data.stored_tx_type),
     ])
     def handle_tx(self, tx):
         self.factory.new_tx.happened(tx)
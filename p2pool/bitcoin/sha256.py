@@ -13,7 +13,14 @@ k = [
     0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
 ]
 
-def process(state, chunk):
+def py_process(state, data):
+    '''SHA-256 compression of data (a multiple of 64 bytes) starting from
+    state; the fallback for when the sha256_midstate extension isn't built.'''
+    for i in range(0, len(data), 64):
+        state = _process_chunk(state, data[i:i + 64])
+    return state
+
+def _process_chunk(state, chunk):
     def rightrotate(x, n):
         return (x >> n) | (x << 32 - n) % 2**32
     
@@ -34,6 +41,11 @@ def process(state, chunk):
     
     return struct.pack('>8I', *((x + y) % 2**32 for x, y in zip(start_state, [a, b, c, d, e, f, g, h])))
 
+try:
+    from sha256_midstate import process
+except ImportError:
+    process = py_process
+
 
 initial_state = struct.pack('>8I', 0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
 
@@ -49,12 +61,12 @@ class sha256(object):
         state = self.state
         buf = self.buf + data
         
-        chunks = [buf[i:i + self.block_size] for i in range(0, len(buf) + 1, self.block_size)]
-        for chunk in chunks[:-1]:
-            state = process(state, chunk)
+        full = len(buf) - len(buf) % self.block_size
+        if full:
+            state = process(state, buf[:full])
         
         self.state = state
-        self.buf = chunks[-1]
+        self.buf = buf[full:]
         
         self.length += 8*len(data)
     
@@ -65,10 +77,7 @@ class sha256(object):
         state = self.state
         buf = self.buf + b'\x80' + b'\x00'*((self.block_size - 9 - len(self.buf)) % self.block_size) + struct.pack('>Q', self.length)
         
-        for chunk in [buf[i:i + self.block_size] for i in range(0, len(buf), self.block_size)]:
-            state = process(state, chunk)
-        
-        return state
+        return process(state, buf)
     
     def hexdigest(self):
         return binascii.hexlify(self.digest())
@@ -1,41 +1,119 @@
+import json
 import random
 import sys
 import time
 
-from twisted.internet import protocol, reactor
+from twisted.internet import defer, protocol, reactor
 from twisted.python import log
 
 from p2pool.bitcoin import data as bitcoin_data, getwork
-from p2pool.util import expiring_dict, jsonrpc, pack
+from p2pool.util import expiring_dict, jsonrpc, math, pack
 
 def clip(num, bot, top):
     return min(top, max(bot, num))
 
+def _notification(method, params):
+    return json.dumps(dict(jsonrpc='2.0', method=method, params=params, id=None)).encode('ascii') + b'\n'
+
+class StratumNotifier(object):
+    '''Sends the new jobs to every stratum connection in one pass when
+    new_work_event fires, biggest miners first. Connections that resolve to
+    the same payout address and targets share one job (and one serialized
+    mining.notify line), told apart by their extranonce1.'''
+    
+    EXTRANONCE1_LENGTH = 4
+    LATENCY_BOUNDS = [.001, .002, .005, .01, .02, .05, .1, .2, .5, 1, 2, 5]
+    
+    def __init__(self, wb):
+        self.wb = wb
+        self.providers = {} # extranonce1 -> StratumRPCMiningProvider
+        self._next_extranonce1 = random.randrange(2**(8*self.EXTRANONCE1_LENGTH))
+        self.notify_latency = {} # username -> math.Histogram of seconds from new work to notify, for connected users only
+        self.watch_id = wb.new_work_event.watch(self.notify_all)
+    
+    def add(self, provider):
+        while True:
+            extranonce1 = pack.IntType(8*self.EXTRANONCE1_LENGTH).pack(self._next_extranonce1)
+            self._next_extranonce1 = (self._next_extranonce1 + 1) % 2**(8*self.EXTRANONCE1_LENGTH)
+            if extranonce1 not in self.providers:
+                break
+        self.providers[extranonce1] = provider
+        return extranonce1
+    
+    def remove(self, provider):
+        self.providers.pop(provider.extranonce1, None)
+    
+    def get_job(self, user, address, desired_share_target, desired_pseudoshare_target):
+        x, got_response = self.wb.get_work(user, address, desired_share_target, desired_pseudoshare_target)
+        jobid = str(random.randrange(2**128))
+        line = _notification('mining.notify', [
+            jobid, # jobid
+            getwork._swap4(pack.IntType(256).pack(x['previous_block'])).hex(), # prevhash
+            x['coinb1'].hex(), # coinb1
+            x['coinb2'].hex(), # coinb2
+            [pack.IntType(256).pack(s).hex() for s in x['merkle_link']['branch']], # merkle_branch
+            getwork._swap4(pack.IntType(32).pack(x['version'])).hex(), # version
+            getwork._swap4(pack.IntType(32).pack(x['bits'].bits)).hex(), # nbits
+            getwork._swap4(pack.IntType(32).pack(x['timestamp'])).hex(), # ntime
+            True, # clean_jobs
+        ])
+        return jobid, x, got_response, line
+    
+    def notify_all(self):
+        start = time.time()
+        hash_rates, dead_hash_rates = self.wb.get_local_rates()
+        providers = sorted(self.providers.values(), key=lambda provider: hash_rates.get(provider.username, 0), reverse=True)
+        jobs = {}
+        for provider in providers:
+            provider._send_work(jobs)
+            if provider.username is not None:
+                if provider.username not in self.notify_latency:
+                    self.notify_latency[provider.username] = math.Histogram(self.LATENCY_BOUNDS)
+                self.notify_latency[provider.username].add(time.time() - start)
+        # usernames come from miners, so forget those without a connection left
+        usernames = set(provider.username for provider in providers)
+        for username in list(self.notify_latency):
+            if username not in usernames:
+                del self.notify_latency[username]
+    
+    def get_notify_latency(self):
+        return dict((username, histogram.to_dict()) for username, histogram in self.notify_latency.items())
+
 class StratumRPCMiningProvider(object):
-    def __init__(self, wb, other, transport):
+    MAX_PENDING_SUBMITS = 32
+    
+    def __init__(self, wb, other, transport, notifier, producer=None):
+        # producer is what's paused for backpressure: the protocol, if it can
+        # hold back lines it has already read, otherwise the transport
         self.pool_version_mask = 0x1fffe000
         self.wb = wb
         self.other = other
         self.transport = transport
+        self.producer = producer if producer is not None else transport
+        self.notifier = notifier
 
         self.username = None
         self.handler_map = expiring_dict.ExpiringDict(300)
 
-        self.watch_id = self.wb.new_work_event.watch(self._send_work)
+        self.extranonce1 = self.notifier.add(self)
 
         self.recent_shares = []
         self.target = None
         self.share_rate = wb.share_rate
         self.fixed_target = False
         self.desired_pseudoshare_target = None
+        
+        self.pending_submits = 0
+        self.paused = False
+        self._waiting_for_room = False
 
     def rpc_subscribe(self, miner_version=None, session_id=None, *args):
         reactor.callLater(0, self._send_work)
 
         return [
             ["mining.notify", "ae6812eb4cd7735a302a8a9dd95cf71f"], # subscription details
-            "", # extranonce1
-            self.wb.COINBASE_NONCE_LENGTH, # extranonce2_size
+            self.extranonce1.hex(), # extranonce1
+            self.wb.COINBASE_NONCE_LENGTH - len(self.extranonce1), # extranonce2_size
         ]
 
     def rpc_authorize(self, username, password):
@@ -69,13 +147,22 @@ class StratumRPCMiningProvider(object):
         if 'subscribe-extranonce' in extensions:
             print('Extension method subscribe-extranonce not implemented')
 
-    def _send_work(self):
+    def _send_work(self, jobs=None):
+        # jobs is shared between the connections notified in one StratumNotifier pass
         try:
-            x, got_response = self.wb.get_work(*self.wb.preprocess_request('' if self.username is None else self.username))
+            user, address, desired_share_target, desired_pseudoshare_target = self.wb.preprocess_request('' if self.username is None else self.username)
+            key = address, desired_share_target, desired_pseudoshare_target
+            if jobs is None or key not in jobs:
+                job = self.notifier.get_job(user, address, desired_share_target, desired_pseudoshare_target)
+                if jobs is not None:
+                    jobs[key] = job
+            else:
+                job = jobs[key]
         except:
             log.err()
             self.transport.loseConnection()
             return
+        jobid, x, got_response, notify_line = job
         if self.desired_pseudoshare_target:
             self.fixed_target = True
             self.target = self.desired_pseudoshare_target
@@ -83,20 +170,8 @@ class StratumRPCMiningProvider(object):
         else:
             self.fixed_target = False
             self.target = x['share_target'] if self.target == None else max(x['min_share_target'], self.target)
-        jobid = str(random.randrange(2**128))
-        self.other.svc_mining.rpc_set_difficulty(bitcoin_data.target_to_difficulty(self.target)*self.wb.net.DUMB_SCRYPT_DIFF).addErrback(lambda err: None)
-        self.other.svc_mining.rpc_notify(
-            jobid, # jobid
-            getwork._swap4(pack.IntType(256).pack(x['previous_block'])).encode('hex'), # prevhash
-            x['coinb1'].encode('hex'), # coinb1
-            x['coinb2'].encode('hex'), # coinb2
-            [pack.IntType(256).pack(s).encode('hex') for s in x['merkle_link']['branch']], # merkle_branch
-            getwork._swap4(pack.IntType(32).pack(x['version'])).encode('hex'), # version
-            getwork._swap4(pack.IntType(32).pack(x['bits'].bits)).encode('hex'), # nbits
-            getwork._swap4(pack.IntType(32).pack(x['timestamp'])).encode('hex'), # ntime
-            True, # clean_jobs
-        ).addErrback(lambda err: None)
         self.handler_map[jobid] = x, got_response
+        self.transport.write(_notification('mining.set_difficulty', [bitcoin_data.target_to_difficulty(self.target)*self.wb.net.DUMB_SCRYPT_DIFF]) + notify_line)
     
     def rpc_submit(self, worker_name, job_id, extranonce2, ntime, nonce, version_bits = None, *args):
         #asicboost: version_bits is the version mask that the miner used
@@ -106,7 +181,7 @@ class StratumRPCMiningProvider(object):
             #self.other.svc_client.rpc_reconnect().addErrback(lambda err: None)
             return False
         x, got_response = self.handler_map[job_id]
-        coinb_nonce = extranonce2.decode('hex')
+        coinb_nonce = self.extranonce1 + bytes.fromhex(extranonce2)
         assert len(coinb_nonce) == self.wb.COINBASE_NONCE_LENGTH
         new_packed_gentx = x['coinb1'] + coinb_nonce + x['coinb2']
 
@@ -126,11 +201,15 @@ class StratumRPCMiningProvider(object):
             version=nversion,
             previous_block=x['previous_block'],
             merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.hash256(new_packed_gentx), x['merkle_link']), # new_packed_gentx has witness data stripped
-            timestamp=pack.IntType(32).unpack(getwork._swap4(ntime.decode('hex'))),
+            timestamp=pack.IntType(32).unpack(getwork._swap4(bytes.fromhex(ntime))),
             bits=x['bits'],
-            nonce=pack.IntType(32).unpack(getwork._swap4(nonce.decode('hex'))),
+            nonce=pack.IntType(32).unpack(getwork._swap4(bytes.fromhex(nonce))),
         )
-        result = got_response(header, worker_name, coinb_nonce, self.target)
+        # fires once the PoW has been checked, off the reactor
+        result = defer.maybeDeferred(got_response, header, worker_name, coinb_nonce, self.target)
+        self.pending_submits += 1
+        result.addBoth(self._submit_done)
+        self._update_paused()
 
         # adjust difficulty on this stratum to target ~10sec/pseudoshare
         if not self.fixed_target:
@@ -149,14 +228,44 @@ class StratumRPCMiningProvider(object):
                 self._send_work()
 
         return result
-
+    
+    def _submit_done(self, res):
+        self.pending_submits -= 1
+        self._update_paused()
+        return res
+    
+    def _update_paused(self):
+        # stops reading from this connection while too many of its submits are
+        # waiting for their PoW, or while the PoW queue is full, so a farm
+        # submitting faster than it can be checked is slowed down instead of
+        # growing the queue
+        pow_queue = self.wb.pow_queue
+        if self.pending_submits >= self.MAX_PENDING_SUBMITS:
+            paused = True
+        elif pow_queue.is_full():
+            paused = True
+            if not self._waiting_for_room:
+                self._waiting_for_room = True
+                pow_queue.wait_for_room().addCallback(self._got_room)
+        else:
+            paused = False
+        if paused != self.paused:
+            self.paused = paused # first, since resumeProducing goes on to the lines it held back
+            if paused:
+                self.producer.pauseProducing()
+            else:
+                self.producer.resumeProducing()
+    
+    def _got_room(self, _):
+        self._waiting_for_room = False
+        self._update_paused()
     
     def close(self):
-        self.wb.new_work_event.unwatch(self.watch_id)
+        self.notifier.remove(self)
 
 class StratumProtocol(jsonrpc.LineBasedPeer):
     def connectionMade(self):
-        self.svc_mining = StratumRPCMiningProvider(self.factory.wb, self.other, self.transport)
+        self.svc_mining = StratumRPCMiningProvider(self.factory.wb, self.other, self.transport, self.factory.notifier, self)
     
     def connectionLost(self, reason):
         self.svc_mining.close()
@@ -166,3 +275,4 @@ class StratumServerFactory(protocol.ServerFactory):
     
     def __init__(self, wb):
         self.wb = wb
+        self.notifier = StratumNotifier(wb)
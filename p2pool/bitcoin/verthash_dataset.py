@@ -0,0 +1,177 @@
+'''
+Shared, memory-mapped access to the Verthash dataset (verthash.dat).
+
+The dataset is mapped lazily on first use instead of being read into a
+private bytes object at import time, so every p2pool process on a host shares
+the same page cache. Its SHA-256 is cached in a sidecar file next to the
+dataset, keyed by size and mtime, so it is only recomputed when the file
+changes.
+'''
+
+import ctypes
+import hashlib
+import mmap
+import os
+import threading
+
+import verthash
+
+CHECKSUM_CHUNK_SIZE = 2**24
+
+def _get_native_hash():
+    # verthash's module only accepts bytes, which would force a full copy of
+    # the dataset; its shared object also exports the underlying C function,
+    # which can be handed the mapped buffer directly
+    try:
+        func = ctypes.CDLL(verthash.__file__).verthash_hash
+    except (AttributeError, OSError):
+        return None
+    func.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_char_p]
+    func.restype = None
+    return func
+
+class VerthashDataset(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.sidecar_filename = filename + '.sha256'
+        self._lock = threading.Lock()
+        self._map = None
+        self._buf = None
+        self._data = None
+        self._native_hash = _get_native_hash()
+        self._required_sums = set()
+        self._checked_sums = set()
+
+    def require_checksum(self, expected_sum):
+        with self._lock:
+            if expected_sum not in self._checked_sums:
+                self._required_sums.add(expected_sum)
+
+    def _open(self):
+        with open(self.filename, 'rb') as f:
+            # ACCESS_COPY maps the file MAP_PRIVATE: pages stay shared with the
+            # page cache since they are never written, but the buffer is
+            # writable as far as ctypes.from_buffer is concerned
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if self._native_hash is not None:
+            self._buf = ctypes.c_char.from_buffer(self._map)
+        else:
+            self._data = self._map[:]
+
+    def _get_cached_checksum(self, st):
+        try:
+            with open(self.sidecar_filename, 'rb') as f:
+                size, mtime, checksum = f.read().split()
+        except (IOError, ValueError):
+            return None
+        if (int(size), int(mtime)) != (st.st_size, st.st_mtime_ns):
+            return None
+        return checksum
+
+    def _set_cached_checksum(self, st, checksum):
+        tmp_filename = self.sidecar_filename + '.new'
+        try:
+            with open(tmp_filename, 'wb') as f:
+                f.write(b'%i %i %s\n' % (st.st_size, st.st_mtime_ns, checksum))
+            os.replace(tmp_filename, self.sidecar_filename)
+        except (IOError, OSError):
+            pass # the sidecar is only a cache, so a read-only datadir is fine
+
+    def _compute_checksum(self):
+        h = hashlib.sha256()
+        view = memoryview(self._map)
+        try:
+            for i in range(0, len(view), CHECKSUM_CHUNK_SIZE):
+                h.update(view[i:i + CHECKSUM_CHUNK_SIZE])
+        finally:
+            view.release()
+        return h.hexdigest().encode('ascii')
+
+    def checksum(self):
+        with self._lock:
+            if self._map is None:
+                self._open()
+            return self._checksum()
+
+    def _checksum(self):
+        st = os.stat(self.filename)
+        checksum = self._get_cached_checksum(st)
+        if checksum is None:
+            checksum = self._compute_checksum()
+            self._set_cached_checksum(st, checksum)
+        return checksum
+
+    def _check_required_sums(self):
+        checksum = self._checksum()
+        for expected_sum in self._required_sums:
+            if checksum != expected_sum:
+                raise ValueError('%s has checksum %s, expected %s' % (self.filename, checksum.decode('ascii'), expected_sum.decode('ascii')))
+        self._checked_sums.update(self._required_sums)
+        self._required_sums.clear()
+
+    def _prepare(self):
+        with self._lock:
+            if self._map is None:
+                self._open()
+            if self._required_sums:
+                self._check_required_sums()
+
+    def hash(self, data):
+        if self._map is None or self._required_sums:
+            self._prepare()
+        if self._buf is None:
+            return verthash.getPoWHash(data, self._data)
+        output = ctypes.create_string_buffer(32)
+        self._native_hash(ctypes.addressof(self._buf), len(self._map), data, len(data), output)
+        return output.raw
+
+    def hash_many(self, headers, threads=None):
+        '''Hashes a sequence of headers, or a buffer of 80-byte headers back to
+        back, returning their 32-byte digests concatenated. ctypes releases the
+        GIL around the native function, so the headers are split across
+        threads (by default one per CPU); without it they're hashed in turn.'''
+
+        if not isinstance(headers, (list, tuple)):
+            view = memoryview(headers).cast('B')
+            if len(view) % 80:
+                raise ValueError('buffer length %i is not a multiple of 80' % (len(view),))
+            headers = [view[i:i + 80].tobytes() for i in range(0, len(view), 80)]
+        if self._map is None or self._required_sums:
+            self._prepare()
+        if threads is None:
+            threads = os.cpu_count() or 1
+        threads = max(1, min(threads, len(headers)))
+        if self._buf is None or threads == 1:
+            return b''.join(self.hash(header) for header in headers)
+
+        res = [None]*len(headers)
+        def run(start):
+            address, size = ctypes.addressof(self._buf), len(self._map)
+            output = ctypes.create_string_buffer(32)
+            for i in range(start, len(headers), threads):
+                header = bytes(headers[i])
+                self._native_hash(address, size, header, len(header), output)
+                res[i] = output.raw
+        workers = [threading.Thread(target=run, args=(i,)) for i in range(1, threads)]
+        for worker in workers:
+            worker.start()
+        run(0)
+        for worker in workers:
+            worker.join()
+        return b''.join(res)
+
+_datasets = {}
+_datasets_lock = threading.Lock()
+
+def get_dataset(filename, expected_sum=None):
+    '''Returns the process-wide dataset for filename. Nothing is read until
+    the first hash; if expected_sum is given, that hash verifies it first.'''
+
+    filename = os.path.abspath(filename)
+    with _datasets_lock:
+        dataset = _datasets.get(filename)
+        if dataset is None:
+            dataset = _datasets[filename] = VerthashDataset(filename)
+    if expected_sum is not None:
+        dataset.require_checksum(expected_sum)
+    return dataset
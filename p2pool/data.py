@@ -1,11 +1,14 @@
+import collections
 import hashlib
 import os
 import random
 import sys
 import time
 import array
+import bisect
 import traceback
 import binascii
+import struct
 
 from twisted.python import log
 
@@ -47,11 +50,11 @@ share_type = pack.ComposedType([
     ('contents', pack.VarStrType()),
 ])
 
-def load_share(share, net, peer_addr):
+def load_share(share, net, peer_addr, known_hashes=None):
     assert peer_addr is None or isinstance(peer_addr, tuple)
     if share['type'] in share_versions:
         net.PARENT.padding_bugfix = (share['type'] >= 35)
-        return share_versions[share['type']](net, peer_addr, share_versions[share['type']].get_dynamic_types(net)['share_type'].unpack(share['contents']))
+        return share_versions[share['type']](net, peer_addr, share_versions[share['type']].get_dynamic_types(net)['share_type'].unpack(share['contents']), known_hashes, share['contents'])
 
     elif share['type'] < Share.VERSION:
         from p2pool import p2p
@@ -59,12 +62,86 @@ def load_share(share, net, peer_addr):
     else:
         raise ValueError('unknown share type: %r' % (share['type'],))
 
+# compact shares leave out the merkle branches a peer can fill in itself: a
+# segwit share's merkle_link is the same as its segwit txid_merkle_link, and
+# shares built on one block template repeat their parent's branches
+
+compact_share_type = pack.ComposedType([
+    ('type', pack.VarIntType()),
+    ('hash', pack.IntType(256)),
+    ('omitted', pack.IntType(8)), # COMPACT_* flags
+    ('contents', pack.VarStrType()), # share_type, with the omitted branches empty
+])
+
+COMPACT_MERKLE_LINK_IS_TXID_LINK = 1
+COMPACT_TXID_LINK_FROM_PARENT = 2
+COMPACT_MERKLE_LINK_FROM_PARENT = 4
+COMPACT_FLAGS = COMPACT_MERKLE_LINK_IS_TXID_LINK | COMPACT_TXID_LINK_FROM_PARENT | COMPACT_MERKLE_LINK_FROM_PARENT
+
+def get_compact_share(share, parent):
+    '''share as a compact_share_type record, relative to parent (the share
+    it builds on, or None if we don't have it). Only for shares without
+    transactions of their own (VERSION >= 34).'''
+    assert share.VERSION >= 34
+    empty_link = dict(branch=[], index=0)
+    contents = dict(share.contents)
+    omitted = 0
+    segwit_data = share.share_info.get('segwit_data')
+    if segwit_data is not None:
+        if parent is not None and parent.VERSION == share.VERSION and parent.share_info.get('segwit_data') is not None and \
+                parent.share_info['segwit_data']['txid_merkle_link'] == segwit_data['txid_merkle_link']:
+            omitted |= COMPACT_TXID_LINK_FROM_PARENT
+            contents['share_info'] = dict(share.share_info, segwit_data=dict(segwit_data, txid_merkle_link=empty_link))
+        if share.merkle_link == segwit_data['txid_merkle_link']:
+            omitted |= COMPACT_MERKLE_LINK_IS_TXID_LINK
+            contents['merkle_link'] = empty_link
+    elif parent is not None and parent.merkle_link == share.merkle_link:
+        omitted |= COMPACT_MERKLE_LINK_FROM_PARENT
+        contents['merkle_link'] = empty_link
+    return dict(
+        type=share.VERSION,
+        hash=share.hash,
+        omitted=omitted,
+        contents=share.get_dynamic_types(share.net)['share_type'].pack(contents) if omitted else share.as_share()['contents'],
+    )
+
+def decompact_share(compact_share, net, get_share):
+    '''the share_type record a compact share stands for. get_share looks up
+    shares we have by hash; returns None if the parent it refers to isn't one
+    of them.'''
+    if compact_share['type'] not in share_versions or compact_share['type'] < 34:
+        raise ValueError('compact share of unsupported type: %r' % (compact_share['type'],))
+    omitted = compact_share['omitted']
+    if not omitted:
+        return dict(type=compact_share['type'], contents=compact_share['contents'])
+    if omitted & ~COMPACT_FLAGS:
+        raise ValueError('unknown compact share flags: %r' % (omitted,))
+    share_type = share_versions[compact_share['type']].get_dynamic_types(net)['share_type']
+    contents = share_type.unpack(compact_share['contents'])
+    share_info = contents['share_info']
+    if omitted & (COMPACT_TXID_LINK_FROM_PARENT | COMPACT_MERKLE_LINK_FROM_PARENT):
+        parent = get_share(share_info['share_data']['previous_share_hash'])
+        if parent is None:
+            return None
+    if omitted & (COMPACT_TXID_LINK_FROM_PARENT | COMPACT_MERKLE_LINK_IS_TXID_LINK) and share_info.get('segwit_data') is None:
+        raise ValueError('compact share refers to segwit data it does not have')
+    if omitted & COMPACT_TXID_LINK_FROM_PARENT:
+        if parent.share_info.get('segwit_data') is None:
+            raise ValueError("compact share refers to its parent's segwit data, which it does not have")
+        share_info['segwit_data'] = dict(share_info['segwit_data'], txid_merkle_link=parent.share_info['segwit_data']['txid_merkle_link'])
+    if omitted & COMPACT_MERKLE_LINK_FROM_PARENT:
+        contents['merkle_link'] = parent.merkle_link
+    if omitted & COMPACT_MERKLE_LINK_IS_TXID_LINK:
+        contents['merkle_link'] = share_info['segwit_data']['txid_merkle_link']
+    return dict(type=compact_share['type'], contents=share_type.pack(contents))
+
 def is_segwit_activated(version, net):
     assert not(version is None or net is None)
     segwit_activation_version = getattr(net, 'SEGWIT_ACTIVATION_VERSION', 0)
     return version >= segwit_activation_version and segwit_activation_version > 0
 
 DONATION_SCRIPT = bytes.fromhex('4104ffd03de44a6e11b9917f3a29f9443283d9871c9d743ef30d5eddcd37094b64d1b3d8090496b53256786bf5c82932ec23c3b74d9f05a6f95a8b5529352656664bac')
+WITNESS_RESERVED_VALUE = b'[P2Pool]'*4 # the coinbase witness, committed to along with the wtxid root
 def donation_script_to_address(net):
     try:
         return bitcoin_data.script2_to_address(
@@ -109,7 +186,7 @@ class BaseShare(object):
         t = dict(share_info_type=None, share_type=None, ref_type=None)
         segwit_data = ('segwit_data', pack.PossiblyNoneType(dict(txid_merkle_link=dict(branch=[], index=0), wtxid_merkle_root=2**256-1), pack.ComposedType([
             ('txid_merkle_link', pack.ComposedType([
-                ('branch', pack.ListType(pack.IntType(256))),
+                ('branch', pack.PackedIntListType(pack.IntType(256))),
                 ('index', pack.IntType(0)), # it will always be 0
             ])),
             ('wtxid_merkle_root', pack.IntType(256))
@@ -127,7 +204,7 @@ class BaseShare(object):
                 ('stale_info', pack.EnumType(pack.IntType(8), dict((k, {0: None, 253: 'orphan', 254: 'doa'}.get(k, 'unk%i' % (k,))) for k in range(256)))),
                 ('desired_version', pack.VarIntType()),
             ]))] + ([segwit_data] if is_segwit_activated(cls.VERSION, net) else []) + ([
-            ('new_transaction_hashes', pack.ListType(pack.IntType(256))),
+            ('new_transaction_hashes', pack.PackedIntListType(pack.IntType(256))),
             ('transaction_hash_refs', pack.ListType(pack.VarIntType(), 2)), # pairs of share_count, tx_count
             ] if cls.VERSION < 34 else []) + [
             ('far_share_hash', pack.PossiblyNoneType(0, pack.IntType(256))),
@@ -141,13 +218,13 @@ class BaseShare(object):
             ('min_header', cls.small_block_header_type),
             ('share_info', t['share_info_type']),
             ('ref_merkle_link', pack.ComposedType([
-                ('branch', pack.ListType(pack.IntType(256))),
+                ('branch', pack.PackedIntListType(pack.IntType(256))),
                 ('index', pack.IntType(0)),
             ])),
             ('last_txout_nonce', pack.IntType(64)),
             ('hash_link', hash_link_type),
             ('merkle_link', pack.ComposedType([
-                ('branch', pack.ListType(pack.IntType(256))),
+                ('branch', pack.PackedIntListType(pack.IntType(256))),
                 ('index', pack.IntType(0)), # it will always be 0
             ])),
         ])
@@ -160,21 +237,25 @@ class BaseShare(object):
         return t
 
     @classmethod
-    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None, segwit_data=None):
+    def generate_transaction_template(cls, tracker, previous_share_hash, block_target, subsidy, desired_other_transaction_hashes_and_fees, net, known_txs=None, base_subsidy=None, segwit_data=None):
+        '''The part of generate_transaction that only depends on the previous
+        share and the block template, not on the miner: target range,
+        transaction selection, payout weights and segwit commitment. Pass the
+        result to generate_transaction as template to generate any number of
+        shares on top of it.'''
         t0 = time.time()
-        previous_share = tracker.items[share_data['previous_share_hash']] if share_data['previous_share_hash'] is not None else None
+        previous_share = tracker.items[previous_share_hash] if previous_share_hash is not None else None
 
-        height, last = tracker.get_height_and_last(share_data['previous_share_hash'])
+        height, last = tracker.get_height_and_last(previous_share_hash)
         assert height >= net.REAL_CHAIN_LENGTH or last is None
         if height < net.TARGET_LOOKBEHIND:
             pre_target3 = net.MAX_TARGET
         else:
-            attempts_per_second = get_pool_attempts_per_second(tracker, share_data['previous_share_hash'], net.TARGET_LOOKBEHIND, min_work=True, integer=True)
+            attempts_per_second = get_pool_attempts_per_second(tracker, previous_share_hash, net.TARGET_LOOKBEHIND, min_work=True, integer=True)
             pre_target = 2**256//(net.SHARE_PERIOD*attempts_per_second) - 1 if attempts_per_second else 2**256-1
             pre_target2 = math.clip(pre_target, (previous_share.max_target*9//10, previous_share.max_target*11//10))
             pre_target3 = math.clip(pre_target2, (net.MIN_TARGET, net.MAX_TARGET))
         max_bits = bitcoin_data.FloatingInteger.from_target_upper_bound(pre_target3)
-        bits = bitcoin_data.FloatingInteger.from_target_upper_bound(math.clip(desired_target, (pre_target3//30, pre_target3)))
 
         new_transaction_hashes = []
         new_transaction_size = 0 # including witnesses
@@ -187,7 +268,7 @@ class BaseShare(object):
         t1 = time.time()
         tx_hash_to_this = {}
         if cls.VERSION < 34:
-            past_shares = list(tracker.get_chain(share_data['previous_share_hash'], min(height, 100)))
+            past_shares = list(tracker.get_chain(previous_share_hash, min(height, 100)))
             for i, share in enumerate(past_shares):
                 for j, tx_hash in enumerate(share.new_transaction_hashes):
                     if tx_hash not in tx_hash_to_this:
@@ -253,10 +334,10 @@ class BaseShare(object):
         removed_fees = [fee for tx_hash, fee in desired_other_transaction_hashes_and_fees if tx_hash not in included_transactions]
         definite_fees = sum(0 if fee is None else fee for tx_hash, fee in desired_other_transaction_hashes_and_fees if tx_hash in included_transactions)
         if None not in removed_fees:
-            share_data = dict(share_data, subsidy=share_data['subsidy'] - sum(removed_fees))
+            subsidy = subsidy - sum(removed_fees)
         else:
             assert base_subsidy is not None
-            share_data = dict(share_data, subsidy=base_subsidy + definite_fees)
+            subsidy = base_subsidy + definite_fees
 
         weights, total_weight, donation_weight = tracker.get_cumulative_weights(previous_share.share_data['previous_share_hash'] if previous_share is not None else None,
             max(0, min(height, net.REAL_CHAIN_LENGTH) - 1),
@@ -264,14 +345,72 @@ class BaseShare(object):
         )
         assert total_weight == sum(weights.values()) + donation_weight, (total_weight, sum(weights.values()) + donation_weight)
 
-        amounts = dict((script, share_data['subsidy']*(199*weight)//(200*total_weight)) for script, weight in weights.items()) # 99.5% goes according to weights prior to this share
+        amounts = dict((script, subsidy*(199*weight)//(200*total_weight)) for script, weight in weights.items()) # 99.5% goes according to weights prior to this share
+        donation_address = donation_script_to_address(net)
+
+        segwit_activated = is_segwit_activated(cls.VERSION, net)
+        if segwit_data is None and known_txs is None:
+            segwit_activated = False
+        if not(segwit_activated or known_txs is None) and any(bitcoin_data.is_segwit_tx(known_txs[h]) for h in other_transaction_hashes):
+            raise ValueError('segwit transaction included before activation')
+        if segwit_activated and known_txs is not None:
+            share_txs = [(known_txs[h], bitcoin_data.get_txid(known_txs[h]), h) for h in other_transaction_hashes]
+            segwit_data = dict(txid_merkle_link=bitcoin_data.merkle_tree_cache.get([None] + [tx[1] for tx in share_txs]).get_link(0), wtxid_merkle_root=bitcoin_data.merkle_tree_cache.get([0] + [bitcoin_data.get_wtxid(tx[0], tx[1], tx[2]) for tx in share_txs]).get_root())
+        if segwit_activated and segwit_data is not None:
+            witness_commitment_hash = bitcoin_data.get_witness_commitment_hash(segwit_data['wtxid_merkle_root'], pack.IntType(256).unpack(WITNESS_RESERVED_VALUE))
+        else:
+            witness_commitment_hash = None
+
+        t5 = time.time()
+        if p2pool.BENCH: print("%8.3f ms for data.py:generate_transaction_template(). Parts: %8.3f %8.3f %8.3f %8.3f %8.3f " % (
+            (t5-t0)*1000.,
+            (t1-t0)*1000.,
+            (t2-t1)*1000.,
+            (t3-t2)*1000.,
+            (t4-t3)*1000.,
+            (t5-t4)*1000.))
+        return dict(
+            previous_share_hash=previous_share_hash,
+            previous_share=previous_share,
+            pre_target3=pre_target3,
+            max_bits=max_bits,
+            far_share_hash=None if last is None and height < 99 else tracker.get_nth_parent_hash(previous_share_hash, 99),
+            other_transaction_hashes=other_transaction_hashes,
+            new_transaction_hashes=new_transaction_hashes,
+            transaction_hash_refs=transaction_hash_refs,
+            subsidy=subsidy,
+            amounts=amounts,
+            amounts_sum=sum(amounts.values()),
+            ranked_payees=sorted((amount, address) for address, amount in amounts.items() if address != donation_address),
+            donation_address=donation_address,
+            scripts={}, # address -> script, filled in as shares are generated
+            segwit_activated=segwit_activated,
+            segwit_data=segwit_data,
+            witness_commitment_hash=witness_commitment_hash,
+        )
+
+    @classmethod
+    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None, segwit_data=None, template=None):
+        t0 = time.time()
+        if template is None:
+            template = cls.generate_transaction_template(tracker, share_data['previous_share_hash'], block_target, share_data['subsidy'],
+                desired_other_transaction_hashes_and_fees, net, known_txs, base_subsidy, segwit_data)
+        assert template['previous_share_hash'] == share_data['previous_share_hash']
+        previous_share = template['previous_share']
+        pre_target3 = template['pre_target3']
+        other_transaction_hashes = template['other_transaction_hashes']
+        segwit_activated, segwit_data = template['segwit_activated'], template['segwit_data']
+        bits = bitcoin_data.FloatingInteger.from_target_upper_bound(math.clip(desired_target, (pre_target3//30, pre_target3)))
+
+        share_data = dict(share_data, subsidy=template['subsidy'])
+        amounts = dict(template['amounts'])
         if 'address' not in share_data:
             this_address = bitcoin_data.pubkey_hash_to_address(
                     share_data['pubkey_hash'], net.PARENT.ADDRESS_VERSION,
                     -1, net.PARENT)
         else:
             this_address = share_data['address']
-        donation_address = donation_script_to_address(net)
+        donation_address = template['donation_address']
         # 0.5% goes to block finder
         amounts[this_address] = amounts.get(this_address, 0) \
                                 + share_data['subsidy']//200
@@ -279,7 +418,7 @@ class BaseShare(object):
         # satoshis due to rounding
         amounts[donation_address] = amounts.get(donation_address, 0) \
                                     + share_data['subsidy'] \
-                                    - sum(amounts.values())
+                                    - (template['amounts_sum'] + share_data['subsidy']//200)
         if cls.VERSION < 34 and 'pubkey_hash' not in share_data:
             share_data['pubkey_hash'], _, _ = bitcoin_data.address_to_pubkey_hash(
                     this_address, net.PARENT)
@@ -288,29 +427,23 @@ class BaseShare(object):
         if sum(amounts.values()) != share_data['subsidy'] or any(x < 0 for x in amounts.values()):
             raise ValueError()
 
+        # payees by amount, then address, with the donation last; only the
+        # finder's amount differs from the template's order.
         # block length limit, unlikely to ever be hit
-        dests = sorted(amounts.keys(), key=lambda address: (
-            address == donation_address, amounts[address], address))[-4000:]
+        ranked_payees = template['ranked_payees']
+        if this_address != donation_address:
+            ranked_payees = list(ranked_payees)
+            if this_address in template['amounts']:
+                del ranked_payees[bisect.bisect_left(ranked_payees, (template['amounts'][this_address], this_address))]
+            bisect.insort(ranked_payees, (amounts[this_address], this_address))
+        dests = [address for amount, address in ranked_payees[-3999:]] + [donation_address]
         if len(dests) >= 200:
             print("found %i payment dests. Antminer S9s may crash when this is close to 226." % len(dests))
 
-        segwit_activated = is_segwit_activated(cls.VERSION, net)
-        if segwit_data is None and known_txs is None:
-            segwit_activated = False
-        if not(segwit_activated or known_txs is None) and any(bitcoin_data.is_segwit_tx(known_txs[h]) for h in other_transaction_hashes):
-            raise ValueError('segwit transaction included before activation')
-        if segwit_activated and known_txs is not None:
-            share_txs = [(known_txs[h], bitcoin_data.get_txid(known_txs[h]), h) for h in other_transaction_hashes]
-            segwit_data = dict(txid_merkle_link=bitcoin_data.calculate_merkle_link([None] + [tx[1] for tx in share_txs], 0), wtxid_merkle_root=bitcoin_data.merkle_hash([0] + [bitcoin_data.get_wtxid(tx[0], tx[1], tx[2]) for tx in share_txs]))
-        if segwit_activated and segwit_data is not None:
-            witness_reserved_value_str = b'[P2Pool]'*4
-            witness_reserved_value = pack.IntType(256).unpack(witness_reserved_value_str)
-            witness_commitment_hash = bitcoin_data.get_witness_commitment_hash(segwit_data['wtxid_merkle_root'], witness_reserved_value)
-
         share_info = dict(
             share_data=share_data,
-            far_share_hash=None if last is None and height < 99 else tracker.get_nth_parent_hash(share_data['previous_share_hash'], 99),
-            max_bits=max_bits,
+            far_share_hash=template['far_share_hash'],
+            max_bits=template['max_bits'],
             bits=bits,
 
             timestamp=(math.clip(desired_timestamp, (
@@ -322,8 +455,8 @@ class BaseShare(object):
             abswork=((previous_share.abswork if previous_share is not None else 0) + bitcoin_data.target_to_average_attempts(bits.target)) % 2**128,
         )
         if cls.VERSION < 34:
-            share_info['new_transaction_hashes'] = new_transaction_hashes
-            share_info['transaction_hash_refs'] = transaction_hash_refs
+            share_info['new_transaction_hashes'] = template['new_transaction_hashes']
+            share_info['transaction_hash_refs'] = template['transaction_hash_refs']
 
         if previous_share != None and desired_timestamp > previous_share.timestamp + 180:
             print("Warning: Previous share's timestamp is %i seconds old." % int(desired_timestamp - previous_share.timestamp))
@@ -338,9 +471,14 @@ class BaseShare(object):
         if segwit_activated:
             share_info['segwit_data'] = segwit_data
 
-        payouts = [dict(value=amounts[addr],
-                        script=bitcoin_data.address_to_script2(addr, net.PARENT)
-                        ) for addr in dests if amounts[addr] and addr != donation_address]
+        scripts = template['scripts']
+        payouts = []
+        for addr in dests:
+            if amounts[addr] and addr != donation_address:
+                script = scripts.get(addr)
+                if script is None:
+                    script = scripts[addr] = bitcoin_data.address_to_script2(addr, net.PARENT)
+                payouts.append(dict(value=amounts[addr], script=script))
         payouts.append({'script': DONATION_SCRIPT, 'value': amounts[donation_address]})
 
         gentx = dict(
@@ -352,7 +490,7 @@ class BaseShare(object):
             )],
             tx_outs=([dict(value=0, script=b'\x6a\x24\xaa\x21\xa9\xed' \
                                            + pack.IntType(256).pack(
-                                                witness_commitment_hash))]
+                                                template['witness_commitment_hash']))]
                                            if segwit_activated else []) \
                     + payouts \
                     + [dict(value=0, script=b'\x6a\x28' + cls.get_ref_hash(
@@ -363,7 +501,7 @@ class BaseShare(object):
         if segwit_activated:
             gentx['marker'] = 0
             gentx['flag'] = 1
-            gentx['witness'] = [[witness_reserved_value_str]]
+            gentx['witness'] = [[WITNESS_RESERVED_VALUE]]
 
         def get_share(header, last_txout_nonce=last_txout_nonce):
             min_header = dict(header); del min_header['merkle_root']
@@ -373,18 +511,11 @@ class BaseShare(object):
                 ref_merkle_link=dict(branch=[], index=0),
                 last_txout_nonce=last_txout_nonce,
                 hash_link=prefix_to_hash_link(bitcoin_data.tx_id_type.pack(gentx)[:-32-8-4], cls.gentx_before_refhash),
-                merkle_link=bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0),
+                merkle_link=bitcoin_data.merkle_tree_cache.get([None] + other_transaction_hashes).get_link(0),
             ))
             assert share.header == header # checks merkle_root
             return share
-        t5 = time.time()
-        if p2pool.BENCH: print("%8.3f ms for data.py:generate_transaction(). Parts: %8.3f %8.3f %8.3f %8.3f %8.3f " % (
-            (t5-t0)*1000.,
-            (t1-t0)*1000.,
-            (t2-t1)*1000.,
-            (t3-t2)*1000.,
-            (t4-t3)*1000.,
-            (t5-t4)*1000.))
+        if p2pool.BENCH: print("%8.3f ms for data.py:generate_transaction()" % ((time.time() - t0)*1000.,))
         return share_info, gentx, other_transaction_hashes, get_share
 
     @classmethod
@@ -394,17 +525,20 @@ class BaseShare(object):
             share_info=share_info,
         ))), ref_merkle_link))
 
-    __slots__ = 'net peer_addr contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen absheight abswork'.split(' ')
-
-    def __init__(self, net, peer_addr, contents):
-        dynamic_types = self.get_dynamic_types(net)
-        self.share_info_type = dynamic_types['share_info_type']
-        self.share_type = dynamic_types['share_type']
-        self.ref_type = dynamic_types['ref_type']
+    # subclasses declare no slots of their own, so shares have no __dict__
+    __slots__ = 'net peer_addr contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash address desired_version gentx_hash merkle_root pow_hash new_transaction_hashes time_seen absheight abswork hydrated naughty all_txs_size stripped_txs_size packed_contents'.split(' ')
+    
+    _interned_addresses = {} # address -> the same bytes, shared by every share paying to it
 
+    def __init__(self, net, peer_addr, contents, known_hashes=None, packed_contents=None):
+        # known_hashes is (gentx_hash, merkle_root, pow_hash, hash) as previously
+        # computed by get_hashes for a share we stored ourselves. Trusting it skips
+        # the hash link and PoW until reverify is called. packed_contents is
+        # what contents was unpacked from, if it was; as_share returns it.
         self.net = net
         self.peer_addr = peer_addr
         self.contents = contents
+        self.packed_contents = bytes(packed_contents) if packed_contents is not None else None
 
         self.min_header = contents['min_header']
         self.share_info = contents['share_info']
@@ -420,8 +554,6 @@ class BaseShare(object):
             elif txrefs and max(txrefs) < 2**32: # in case we see blocks with more than 65536 tx in the future
                 self.share_info['transaction_hash_refs'] = array.array('L', txrefs)
 
-        segwit_activated = is_segwit_activated(self.VERSION, net)
-
         if not (2 <= len(self.share_info['share_data']['coinbase']) <= 100):
             raise ValueError('''bad coinbase size! %i bytes''' % (len(self.share_info['share_data']['coinbase']),))
 
@@ -433,16 +565,16 @@ class BaseShare(object):
         self.timestamp = self.share_info['timestamp']
         self.previous_hash = self.share_data['previous_share_hash']
         if self.VERSION >= 34:
-            self.new_script = bitcoin_data.address_to_script2(
-                    self.share_data['address'], net.PARENT)
-            self.address = self.share_data['address']
+            address = self.share_data['address']
         else:
-            self.new_script = bitcoin_data.pubkey_hash_to_script2(
-                    self.share_data['pubkey_hash'],
-                    net.PARENT.ADDRESS_VERSION, -1, net.PARENT)
-            self.address = bitcoin_data.pubkey_hash_to_address(
+            address = bitcoin_data.pubkey_hash_to_address(
                     self.share_data['pubkey_hash'],
                     net.PARENT.ADDRESS_VERSION, -1, net.PARENT)
+        if len(self._interned_addresses) >= 2**14: # peers can send any address
+            self._interned_addresses.clear()
+        self.address = self._interned_addresses.setdefault(address, address)
+        if self.VERSION >= 34:
+            self.share_data['address'] = self.address
         self.desired_version = self.share_data['desired_version']
         self.absheight = self.share_info['absheight']
         self.abswork = self.share_info['abswork']
@@ -457,23 +589,17 @@ class BaseShare(object):
                     n.add(tx_count)
             assert n == set(range(len(self.share_info['new_transaction_hashes'])))
 
-        self.gentx_hash = check_hash_link(
-            self.hash_link,
-            self.get_ref_hash(net, self.share_info, contents['ref_merkle_link']) + pack.IntType(64).pack(self.contents['last_txout_nonce']) + pack.IntType(32).pack(0),
-            self.gentx_before_refhash,
-        )
-        merkle_root = bitcoin_data.check_merkle_link(self.gentx_hash, self.share_info['segwit_data']['txid_merkle_link'] if segwit_activated else self.merkle_link)
-        self.header = dict(self.min_header, merkle_root=merkle_root)
-        self.pow_hash = net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(self.header))
-        self.hash = self.header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(self.header))
+        if known_hashes is None:
+            self.gentx_hash, self.merkle_root, self.pow_hash, self.hash = self.get_hashes()
+        else:
+            self.gentx_hash, self.merkle_root, self.pow_hash, self.hash = known_hashes
+        self.hydrated = known_hashes is not None
 
         if self.target > net.MAX_TARGET:
             from p2pool import p2p
             raise p2p.PeerMisbehavingError('share target invalid')
 
-        if self.pow_hash > self.target:
-            from p2pool import p2p
-            raise p2p.PeerMisbehavingError('share PoW invalid : ' + str(self.pow_hash) + ' vs ' + str(self.target))
+        self._check_pow()
 
         if self.VERSION < 34:
             self.new_transaction_hashes = self.share_info['new_transaction_hashes']
@@ -481,11 +607,60 @@ class BaseShare(object):
         # XXX eww
         self.time_seen = time.time()
 
+    def _check_pow(self):
+        if self.pow_hash > self.target:
+            from p2pool import p2p
+            raise p2p.PeerMisbehavingError('share PoW invalid : ' + str(self.pow_hash) + ' vs ' + str(self.target))
+
+    def set_hashes(self, hashes):
+        # for a share loaded with placeholder known_hashes while its header was
+        # hashed in a batch: what __init__ would have computed and checked
+        self.gentx_hash, self.merkle_root, self.pow_hash, self.hash = hashes
+        self.hydrated = False
+        self._check_pow()
+
+    def get_packed_header(self):
+        # get_hashes without the PoW, for hashing many shares' headers in one batch
+        gentx_hash = check_hash_link(
+            self.hash_link,
+            self.get_ref_hash(self.net, self.share_info, self.contents['ref_merkle_link']) + pack.IntType(64).pack(self.contents['last_txout_nonce']) + pack.IntType(32).pack(0),
+            self.gentx_before_refhash,
+        )
+        merkle_root = bitcoin_data.check_merkle_link(gentx_hash, self.share_info['segwit_data']['txid_merkle_link'] if is_segwit_activated(self.VERSION, self.net) else self.merkle_link)
+        return gentx_hash, merkle_root, bitcoin_data.block_header_type.pack(dict(self.min_header, merkle_root=merkle_root))
+
+    def get_hashes(self):
+        gentx_hash, merkle_root, header = self.get_packed_header()
+        return gentx_hash, merkle_root, self.net.PARENT.POW_FUNC(header), bitcoin_data.hash256(header)
+    
+    def reverify(self):
+        # recomputes what known_hashes let __init__ skip
+        if self.get_hashes() != (self.gentx_hash, self.merkle_root, self.pow_hash, self.hash):
+            return False
+        self.hydrated = False
+        return True
+
+    @property
+    def header(self):
+        return dict(self.min_header, merkle_root=self.merkle_root)
+
+    @property
+    def header_hash(self):
+        return self.hash
+
+    @property
+    def new_script(self):
+        if self.VERSION >= 34:
+            return bitcoin_data.address_to_script2(self.address, self.net.PARENT)
+        return bitcoin_data.pubkey_hash_to_script2(self.share_data['pubkey_hash'], self.net.PARENT.ADDRESS_VERSION, -1, self.net.PARENT)
+
     def __repr__(self):
         return 'Share' + repr((self.net, self.peer_addr, self.contents))
 
     def as_share(self):
-        return dict(type=self.VERSION, contents=self.share_type.pack(self.contents))
+        if self.packed_contents is None:
+            self.packed_contents = self.get_dynamic_types(self.net)['share_type'].pack(self.contents)
+        return dict(type=self.VERSION, contents=self.packed_contents)
 
     def iter_transaction_hash_refs(self):
         try:
@@ -621,7 +796,7 @@ class BaseShare(object):
         if other_txs is None:
             pass
         else:
-            if not hasattr(self, 'all_tx_size'):
+            if not hasattr(self, 'all_txs_size'):
                 self.all_txs_size = sum(bitcoin_data.get_size(tx) for tx in other_txs)
                 self.stripped_txs_size = sum(bitcoin_data.get_stripped_size(tx) for tx in other_txs)
             if self.all_txs_size + 3 * self.stripped_txs_size + 4*80 + self.gentx_weight > tracker.net.BLOCK_MAX_WEIGHT:
@@ -638,29 +813,34 @@ class BaseShare(object):
         return dict(header=self.header, txs=[self.check(tracker, other_txs)] + other_txs)
 
 class PaddingBugfixShare(BaseShare):
+    __slots__ = ()
     VERSION=35
     VOTING_VERSION = 35
     SUCCESSOR = None
     MINIMUM_PROTOCOL_VERSION = 3500
 
 class SegwitMiningShare(BaseShare):
+    __slots__ = ()
     VERSION = 34
     VOTING_VERSION = 34
     SUCCESSOR = PaddingBugfixShare
     MINIMUM_PROTOCOL_VERSION = 3300
 
 class NewShare(BaseShare):
+    __slots__ = ()
     VERSION = 33
     VOTING_VERSION = 33
     SUCCESSOR = PaddingBugfixShare
     MINIMUM_PROTOCOL_VERSION = 3300
 
 class PreSegwitShare(BaseShare):
+    __slots__ = ()
     VERSION = 32
     VOTING_VERSION = 32
     SUCCESSOR = PaddingBugfixShare
 
 class Share(BaseShare):
+    __slots__ = ()
     VERSION = 17
     VOTING_VERSION = 17
     SUCCESSOR = PaddingBugfixShare
@@ -712,6 +892,263 @@ class WeightsSkipList(forest.TrackerSkipList):
         return (math.add_dicts(*math.flatten_linked_list(share[1])),
                 share[2], share[3])
 
+class ChainWindow(object):
+    '''Entries for a run of shares from start back, newest first, with sums
+    over them, that can be slid along the chain. Subclasses define
+    get_entry(share), whose first element is the share's previous_hash, and
+    _add and _sub, which update the sums.'''
+    
+    def __init__(self, start):
+        self.reset(start)
+    
+    def reset(self, start):
+        self.start = start
+        self.shares = collections.deque() # entries, newest first
+    
+    def _extend(self, tracker):
+        entry = self.get_entry(tracker.items[self.shares[-1][0] if self.shares else self.start])
+        self.shares.append(entry)
+        self._add(entry)
+    
+    def advance(self, tracker, start, dist):
+        for share in reversed(list(tracker.get_chain(start, dist))):
+            entry = self.get_entry(share)
+            self.shares.appendleft(entry)
+            self._add(entry)
+        self.start = start
+    
+    def rewind(self, start, dist):
+        if dist >= len(self.shares):
+            self.reset(start)
+            return
+        for i in range(dist):
+            self._sub(self.shares.popleft())
+        self.start = start
+
+class WeightsWindow(ChainWindow):
+    '''The full shares counted by get_cumulative_weights from one start, with
+    their per-address sums.'''
+    
+    def reset(self, start):
+        ChainWindow.reset(self, start) # entries: (previous_hash, address, weight, donation_weight, total_weight)
+        self.weights = {} # address -> weight, only nonzero ones
+        self.total_weight = 0
+        self.donation_weight = 0
+    
+    @staticmethod
+    def get_entry(share):
+        att = bitcoin_data.target_to_average_attempts(share.target)
+        return (share.previous_hash, share.address, att*(65535-share.share_data['donation']),
+            att*share.share_data['donation'], att*65535)
+    
+    def _add(self, entry):
+        previous_hash, address, weight, donation_weight, total_weight = entry
+        if weight:
+            self.weights[address] = self.weights.get(address, 0) + weight
+        self.total_weight += total_weight
+        self.donation_weight += donation_weight
+    
+    def _sub(self, entry):
+        previous_hash, address, weight, donation_weight, total_weight = entry
+        if weight:
+            new_weight = self.weights[address] - weight
+            if new_weight:
+                self.weights[address] = new_weight
+            else:
+                del self.weights[address]
+        self.total_weight -= total_weight
+        self.donation_weight -= donation_weight
+    
+    def get(self, tracker, max_shares, desired_weight):
+        while len(self.shares) > max_shares or self.total_weight > desired_weight:
+            self._sub(self.shares.pop())
+        while len(self.shares) < max_shares and self.total_weight < desired_weight:
+            entry = self.get_entry(tracker.items[self.shares[-1][0] if self.shares else self.start])
+            previous_hash, address, weight, donation_weight, total_weight = entry
+            if self.total_weight + total_weight > desired_weight:
+                # only part of this share fits, same rounding as WeightsSkipList.apply_delta
+                remaining = (desired_weight - self.total_weight)//65535
+                weights = dict(self.weights)
+                partial_weight = remaining * weight // (total_weight//65535)
+                if partial_weight:
+                    weights[address] = weights.get(address, 0) + partial_weight
+                return weights, desired_weight, self.donation_weight + remaining * donation_weight // (total_weight//65535)
+            self.shares.append(entry)
+            self._add(entry)
+        return dict(self.weights), self.total_weight, self.donation_weight
+
+class WindowLanes(object):
+    '''A few ChainWindows ("lanes"), most recently used first; a query from
+    a start near a lane's (the next best share, a share being verified after
+    its parent) only moves that lane by the distance between them and
+    re-fits its old end, instead of walking the whole window.'''
+    
+    LANES = 4
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.lanes = []
+    
+    def _new_window(self, start):
+        raise NotImplementedError()
+    
+    def _get_lane(self, start, max_shares):
+        for i, lane in enumerate(self.lanes):
+            if lane.start == start:
+                break
+        else:
+            height, last = self.tracker.get_height_and_last(start)
+            for i, lane in enumerate(self.lanes):
+                lane_height, lane_last = self.tracker.get_height_and_last(lane.start)
+                if lane_last != last:
+                    continue
+                dist = height - lane_height
+                if 0 < dist <= max_shares and self.tracker.get_nth_parent_hash(start, dist) == lane.start:
+                    lane.advance(self.tracker, start, dist)
+                    break
+                if 0 < -dist <= max_shares and self.tracker.get_nth_parent_hash(lane.start, -dist) == start:
+                    lane.rewind(start, -dist)
+                    break
+            else:
+                lane = self._new_window(start)
+                self.lanes.insert(0, lane)
+                del self.lanes[self.LANES:]
+                return lane
+        self.lanes.insert(0, self.lanes.pop(i))
+        return lane
+
+class WeightsAccumulator(WindowLanes):
+    '''Drop-in for WeightsSkipList, on WeightsWindows.'''
+    
+    def _new_window(self, start):
+        return WeightsWindow(start)
+    
+    def __call__(self, start, max_shares, desired_weight):
+        assert desired_weight % 65535 == 0, divmod(desired_weight, 65535)
+        if max_shares == 0:
+            return {}, 0, 0
+        return self._get_lane(start, max_shares).get(self.tracker, max_shares, desired_weight)
+
+class CountsWindow(ChainWindow):
+    '''Per-key sums of get_item(share), a (key, amount) pair.'''
+    
+    def __init__(self, get_item, start):
+        self.get_item = get_item
+        ChainWindow.__init__(self, start)
+    
+    def reset(self, start):
+        ChainWindow.reset(self, start) # entries: (previous_hash, key, amount)
+        self.counts = {} # key -> amount, only nonzero ones
+    
+    def get_entry(self, share):
+        key, amount = self.get_item(share)
+        return share.previous_hash, key, amount
+    
+    def _add(self, entry):
+        previous_hash, key, amount = entry
+        if amount:
+            self.counts[key] = self.counts.get(key, 0) + amount
+    
+    def _sub(self, entry):
+        previous_hash, key, amount = entry
+        if amount:
+            new_amount = self.counts[key] - amount
+            if new_amount:
+                self.counts[key] = new_amount
+            else:
+                del self.counts[key]
+    
+    def get(self, tracker, length):
+        while len(self.shares) > length:
+            self._sub(self.shares.pop())
+        while len(self.shares) < length:
+            self._extend(tracker)
+        return dict(self.counts)
+
+class CountsAccumulator(WindowLanes):
+    '''Per-key sums of get_item over the length shares from a start, on
+    CountsWindows.'''
+    
+    def __init__(self, tracker, get_item):
+        WindowLanes.__init__(self, tracker)
+        self.get_item = get_item
+    
+    def _new_window(self, start):
+        return CountsWindow(self.get_item, start)
+    
+    def __call__(self, start, length):
+        if length <= 0: # get_user_stale_props(..., lookbehind=0, ...) when there are no shares
+            return {}
+        return self._get_lane(start, length).get(self.tracker, length)
+
+class HeadScores(object):
+    '''What OkayTracker.think ranks verified heads by, kept between calls:
+    each head's anchor (the verified share min(5, height) back, whose work
+    is the head's score), dropped when the head or its ancestry changes, and
+    should_punish_reason verdicts for the current previous_block.'''
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self._anchors = {} # verified head hash -> anchor hash
+        self._punish = {} # share hash -> should_punish_reason(self._punish_block, ...)
+        self._punish_block = None
+        tracker.verified.added.watch_weakref(self, lambda self, share: self._handle_added(share))
+        tracker.verified.removed.watch_weakref(self, lambda self, share: self._handle_removed(share))
+        tracker.removed.watch_weakref(self, lambda self, share: self._punish.pop(share.hash, None))
+    
+    def _handle_added(self, share):
+        if share.hash in self.tracker.verified.reverse: # added under verified shares, whose depths all changed
+            self._anchors.clear()
+        else:
+            self._anchors.pop(share.previous_hash, None)
+    
+    def _handle_removed(self, share):
+        if share.hash in self._anchors:
+            del self._anchors[share.hash]
+        else: # the bottom of a chain
+            self._anchors.clear()
+    
+    def get_anchor(self, head):
+        if head not in self._anchors:
+            self._anchors[head] = self.tracker.verified.get_nth_parent_hash(head, min(5, self.tracker.verified.get_height(head)))
+        return self._anchors[head]
+    
+    def should_punish_reason(self, share, previous_block, bits, known_txs):
+        if previous_block != self._punish_block:
+            self._punish.clear()
+            self._punish_block = previous_block
+        if share.hash in self._punish:
+            return self._punish[share.hash]
+        res = share.should_punish_reason(previous_block, bits, self.tracker, known_txs)
+        if share.VERSION >= 34: # older shares' verdicts depend on which transactions we know
+            self._punish[share.hash] = res
+        return res
+
+class ShareContentsIndex(object):
+    '''Finds the share a share record received again describes, from its
+    packed contents alone. Packing is canonical and a share's hash only
+    depends on its contents, so equal contents are the same share; looking
+    them up costs no unpacking, hash link or PoW.'''
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self._hashes = {} # packed contents -> share hash; the keys are the shares' own cached bytes
+        for share in tracker.items.values():
+            self._handle_added(share)
+        tracker.added.watch_weakref(self, lambda self, share: self._handle_added(share))
+        tracker.removed.watch_weakref(self, lambda self, share: self._hashes.pop(share.packed_contents, None))
+    
+    def _handle_added(self, share):
+        self._hashes[share.as_share()['contents']] = share.hash
+    
+    def get(self, share):
+        '''share: a share record, dict(type=..., contents=...). Returns the
+        hash of the share in the tracker it describes, or None.'''
+        share_hash = self._hashes.get(share['contents'])
+        if share_hash is None or self.tracker.items[share_hash].VERSION != share['type']:
+            return None
+        return share_hash
+
 class OkayTracker(forest.Tracker):
     def __init__(self, net):
         forest.Tracker.__init__(self, delta_type=forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
@@ -722,7 +1159,20 @@ class OkayTracker(forest.Tracker):
         self.verified = forest.SubsetTracker(delta_type=forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
             work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
         )), subset_of=self)
-        self.get_cumulative_weights = WeightsSkipList(self)
+        self.get_cumulative_weights = WeightsAccumulator(self)
+        self.head_scores = HeadScores(self)
+        
+        # for get_average_stale_prop, get_stale_counts, get_user_stale_props and get_desired_version_counts
+        self.stale_view = forest.TrackerView(self, forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+            stale_count=lambda share: 1 if share.share_data['stale_info'] is not None else 0,
+            orphan_work=lambda share: bitcoin_data.target_to_average_attempts(share.target) if share.share_data['stale_info'] == 'orphan' else 0,
+            doa_work=lambda share: bitcoin_data.target_to_average_attempts(share.target) if share.share_data['stale_info'] == 'doa' else 0,
+            other_stale_count=lambda share: 1 if share.share_data['stale_info'] not in [None, 'orphan', 'doa'] else 0,
+        )))
+        user_key = lambda share: share.share_data['address'] if share.VERSION >= 34 else share.share_data['pubkey_hash']
+        self.user_share_counts = CountsAccumulator(self, lambda share: (user_key(share), 1 if share.share_data['stale_info'] is None else 2))
+        self.user_stale_counts = CountsAccumulator(self, lambda share: (user_key(share), 1 if share.share_data['stale_info'] is not None else 0))
+        self.version_counts = CountsAccumulator(self, lambda share: (share.desired_version, bitcoin_data.target_to_average_attempts(share.target)))
 
     def attempt_verify(self, share, block_abs_height_func, known_txs, feecache):
         if share.hash in self.verified.items:
@@ -731,7 +1181,7 @@ class OkayTracker(forest.Tracker):
         if height < self.net.CHAIN_LENGTH + 1 and last is not None:
             raise AssertionError()
         try:
-            share.gentx = share.check(self, known_txs, block_abs_height_func=block_abs_height_func, feecache=feecache)
+            share.check(self, known_txs, block_abs_height_func=block_abs_height_func, feecache=feecache)
         except:
             log.err(None, 'Share check failed: %064x -> %064x' % (share.hash, share.previous_hash if share.previous_hash is not None else 0))
             return False
@@ -780,6 +1230,8 @@ class OkayTracker(forest.Tracker):
         # try to get at least CHAIN_LENGTH height for each verified head, requesting parents if needed
         for head in list(self.verified.heads):
             head_height, last_hash = self.verified.get_height_and_last(head)
+            if head_height >= self.net.CHAIN_LENGTH:
+                continue # nothing to verify or request below it
             last_height, last_last_hash = self.get_height_and_last(last_hash)
             # XXX review boundary conditions
             want = max(self.net.CHAIN_LENGTH - head_height, 0)
@@ -806,20 +1258,23 @@ class OkayTracker(forest.Tracker):
         best_tail_score, best_tail = decorated_tails[-1] if decorated_tails else (None, None)
         
         # decide best verified head
+        head_scores = dict((h, (
+            self.verified.get_work(self.head_scores.get_anchor(h)),
+            self.head_scores.should_punish_reason(self.items[h], previous_block, bits, known_txs)[0],
+            self.items[h].time_seen,
+        )) for h in self.verified.tails.get(best_tail, []))
         decorated_heads = sorted(((
-            self.verified.get_work(self.verified.get_nth_parent_hash(h, min(5, self.verified.get_height(h)))) -
-            min(self.items[h].should_punish_reason(previous_block, bits, self, known_txs)[0], 1) * bitcoin_data.target_to_average_attempts(self.items[h].target),
+            work - min(punish, 1) * bitcoin_data.target_to_average_attempts(self.items[h].target),
             #self.items[h].peer_addr is None,
-            -self.items[h].should_punish_reason(previous_block, bits, self, known_txs)[0],
-            #-self.items[h].should_punish_reason(previous_block, bits, self, known_txs)[0] * bitcoin_data.target_to_average_attempts(self.items[h].target),
-            -self.items[h].time_seen,
-        ), h) for h in self.verified.tails.get(best_tail, []))
+            -punish,
+            -time_seen,
+        ), h) for h, (work, punish, time_seen) in head_scores.items())
         traditional_sort = sorted(((
-            self.verified.get_work(self.verified.get_nth_parent_hash(h, min(5, self.verified.get_height(h)))),
+            work,
             #self.items[h].peer_addr is None,
-            -self.items[h].time_seen, # assume they can't tell we should punish this share and will be sorting based on time
-            -self.items[h].should_punish_reason(previous_block, bits, self, known_txs)[0],
-        ), h) for h in self.verified.tails.get(best_tail, []))
+            -time_seen, # assume they can't tell we should punish this share and will be sorting based on time
+            -punish,
+        ), h) for h, (work, punish, time_seen) in head_scores.items())
         punish_aggressively = traditional_sort[-1][0][2] if traditional_sort else False
 
         if p2pool.DEBUG:
@@ -834,12 +1289,12 @@ class OkayTracker(forest.Tracker):
         punish = 0
         if best is not None:
             best_share = self.items[best]
-            punish, punish_reason = best_share.should_punish_reason(previous_block, bits, self, known_txs)
+            punish, punish_reason = self.head_scores.should_punish_reason(best_share, previous_block, bits, known_txs)
             while punish > 0:
                 print('Punishing share for %r! Jumping from %s to %s!' % (punish_reason, format_hash(best), format_hash(best_share.previous_hash)))
                 best = best_share.previous_hash
                 best_share = self.items[best]
-                punish, punish_reason = best_share.should_punish_reason(previous_block, bits, self, known_txs)
+                punish, punish_reason = self.head_scores.should_punish_reason(best_share, previous_block, bits, known_txs)
                 if not punish:
                     def best_descendent(hsh, limit=20):
                         child_hashes = self.reverse.get(hsh, set())
@@ -883,8 +1338,8 @@ class OkayTracker(forest.Tracker):
         
         end_point = self.verified.get_nth_parent_hash(share_hash, self.net.CHAIN_LENGTH*15//16)
         
-        block_height = max(block_rel_height_func(share.header['previous_block']) for share in
-            self.verified.get_chain(end_point, self.net.CHAIN_LENGTH//16))
+        block_height = max(block_rel_height_func(previous_block) for previous_block in
+            set(share.header['previous_block'] for share in self.verified.get_chain(end_point, self.net.CHAIN_LENGTH//16)))
         
         return self.net.CHAIN_LENGTH, self.verified.get_delta(share_hash, end_point).work/((0 - block_height + 1)*self.net.PARENT.BLOCK_PERIOD)
 
@@ -909,37 +1364,41 @@ def get_pool_attempts_per_second(tracker, previous_share_hash, dist, min_work=Fa
     return attempts/time
 
 def get_average_stale_prop(tracker, share_hash, lookbehind):
-    stales = sum(1 for share in tracker.get_chain(share_hash, lookbehind) if share.share_data['stale_info'] is not None)
+    assert lookbehind <= tracker.get_height(share_hash)
+    stales = tracker.stale_view.get_delta(share_hash, tracker.get_nth_parent_hash(share_hash, lookbehind)).stale_count
     return stales/(lookbehind + stales)
 
 def get_stale_counts(tracker, share_hash, lookbehind, rates=False):
     res = {}
-    for share in tracker.get_chain(share_hash, lookbehind - 1):
-        res['good'] = res.get('good', 0) + bitcoin_data.target_to_average_attempts(share.target)
-        s = share.share_data['stale_info']
-        if s is not None:
-            res[s] = res.get(s, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    if lookbehind > 1:
+        end_hash = tracker.get_nth_parent_hash(share_hash, lookbehind - 1)
+        delta = tracker.stale_view.get_delta(share_hash, end_hash)
+        if delta.other_stale_count: # stale_info values no share is made with, counted under their own names
+            for share in tracker.get_chain(share_hash, lookbehind - 1):
+                s = share.share_data['stale_info']
+                if s not in [None, 'orphan', 'doa']:
+                    res[s] = res.get(s, 0) + bitcoin_data.target_to_average_attempts(share.target)
+        res['good'] = tracker.get_delta(share_hash, end_hash).work
+        if delta.orphan_work:
+            res['orphan'] = delta.orphan_work
+        if delta.doa_work:
+            res['doa'] = delta.doa_work
     if rates:
         dt = tracker.items[share_hash].timestamp - tracker.items[tracker.get_nth_parent_hash(share_hash, lookbehind - 1)].timestamp
         res = dict((k, v/dt) for k, v in res.items())
     return res
 
 def get_user_stale_props(tracker, share_hash, lookbehind, net):
+    assert lookbehind - 1 <= tracker.get_height(share_hash)
+    totals = tracker.user_share_counts(share_hash, lookbehind - 1) # stale shares count twice
+    stales = tracker.user_stale_counts(share_hash, lookbehind - 1)
     res = {}
-    for share in tracker.get_chain(share_hash, lookbehind - 1):
-        if share.VERSION < 34:
-            stale, total = res.get(share.share_data['pubkey_hash'], (0, 0))
-            key = bitcoin_data.pubkey_hash_to_address(
-                    share.share_data['pubkey_hash'], net.ADDRESS_VERSION, -1,
-                    net)
-        else:
-            key = share.share_data['address']
-            stale, total = res.get(key, (0, 0))
-        total += 1
-        if share.share_data['stale_info'] is not None:
-            stale += 1
-            total += 1
-        res[key] = stale, total
+    for key, total in totals.items():
+        stale = stales.get(key, 0)
+        if isinstance(key, int): # pubkey_hash of a share before v34
+            key = bitcoin_data.pubkey_hash_to_address(key, net.ADDRESS_VERSION, -1, net)
+        old_stale, old_total = res.get(key, (0, 0))
+        res[key] = old_stale + stale, old_total + total
     return dict((pubkey_hash, stale/total) for pubkey_hash, (stale, total) in res.items())
 
 def get_expected_payouts(tracker, best_share_hash, block_target, subsidy, net):
@@ -950,10 +1409,8 @@ def get_expected_payouts(tracker, best_share_hash, block_target, subsidy, net):
     return res
 
 def get_desired_version_counts(tracker, best_share_hash, dist):
-    res = {}
-    for share in tracker.get_chain(best_share_hash, dist):
-        res[share.desired_version] = res.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
-    return res
+    assert dist <= tracker.get_height(best_share_hash)
+    return tracker.version_counts(best_share_hash, dist)
 
 def get_warnings(tracker, best_share, net, bitcoind_getinfo, bitcoind_work_value):
     res = []
@@ -984,82 +1441,198 @@ def format_hash(x):
         return 'xxxxxxxx'
     return '%08x' % (x % 2**32)
 
+share_record_length = struct.Struct('<I')
+share_index_entry = struct.Struct('<32sII') # share hash, segment, offset of record in segment
+share_hashes_entry = struct.Struct('<32s32s32s') # gentx hash, merkle root, pow hash
+
 class ShareStore(object):
+    # shares are kept as length-prefixed raw share_type records in append-only
+    # segment files (prefix + 'dat.N'). prefix + 'idx' maps share hashes to
+    # (segment, offset) and prefix + 'verified' holds one bit per index entry.
+    # prefix + 'hashes' is parallel to the index and holds what BaseShare.get_hashes
+    # computed, so verified shares can be loaded without redoing the PoW.
+    
+    max_segment_size = 10e6
+    
     def __init__(self, prefix, net, share_cb, verified_hash_cb):
         self.dirname = os.path.dirname(os.path.abspath(prefix))
         self.filename = os.path.basename(os.path.abspath(prefix))
+        self.index_filename = os.path.join(self.dirname, self.filename + 'idx')
+        self.verified_filename = os.path.join(self.dirname, self.filename + 'verified')
+        self.hashes_filename = os.path.join(self.dirname, self.filename + 'hashes')
         self.net = net
-
+        
         start = time.time()
         
-        known = {}
+        self.index = {} # share hash -> (segment filename, offset, index entry number)
+        self.index_size = 0
+        self.verified_bits = bytearray()
+        self.known = {} # filename -> (set of share hashes, set of verified hashes)
+        
+        segments = set(self.get_segment_filenames_and_next()[0])
+        hashes_data = b''
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'rb') as f:
+                index_data = f.read()
+            if os.path.exists(self.verified_filename):
+                with open(self.verified_filename, 'rb') as f:
+                    self.verified_bits = bytearray(f.read())
+            if os.path.exists(self.hashes_filename):
+                with open(self.hashes_filename, 'rb') as f:
+                    hashes_data = f.read()
+            for i in range(len(index_data)//share_index_entry.size):
+                share_hash, segment, offset = share_index_entry.unpack_from(index_data, i*share_index_entry.size)
+                filename = self._get_segment_filename(segment)
+                if filename not in segments: # removed segment that the index wasn't compacted for
+                    continue
+                self.index[pack.IntType(256).unpack(share_hash)] = filename, offset, i
+            self.index_size = len(index_data)//share_index_entry.size
+        if len(hashes_data) != self.index_size*share_hashes_entry.size:
+            # keep it aligned with the index; missing entries are all zeros, which means unknown
+            hashes_data = hashes_data[:self.index_size*share_hashes_entry.size].ljust(self.index_size*share_hashes_entry.size, b'\0')
+            with open(self.hashes_filename, 'wb') as f:
+                f.write(hashes_data)
+        
+        by_segment = {}
+        for share_hash, (filename, offset, i) in self.index.items():
+            by_segment.setdefault(filename, []).append((offset, share_hash, i))
+        for filename in sorted(by_segment, key=self._get_segment_number):
+            share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
+            with open(filename, 'rb') as f:
+                segment_data = f.read()
+            for offset, share_hash, i in sorted(by_segment[filename]):
+                try:
+                    length, = share_record_length.unpack_from(segment_data, offset)
+                    record = segment_data[offset + share_record_length.size:offset + share_record_length.size + length]
+                    if len(record) != length:
+                        raise ValueError('truncated share record')
+                    raw_share = share_type.unpack(record)
+                    if raw_share['type'] < Share.VERSION:
+                        continue
+                    known_hashes = None
+                    if self._get_verified_bit(i):
+                        known_hashes = self._get_known_hashes(hashes_data, i, share_hash)
+                    share = load_share(raw_share, self.net, None, known_hashes)
+                    if share.hash != share_hash:
+                        raise ValueError('share hash mismatch')
+                    share_cb(share)
+                    share_hashes.add(share.hash)
+                    if self._get_verified_bit(i):
+                        verified_hash_cb(share.hash)
+                        verified_hashes.add(share.hash)
+                except Exception:
+                    log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
+        for filename in segments - set(self.known):
+            self.known[filename] = set(), set()
+        
+        self.known_desired = dict((k, (set(a), set(b))) for k, (a, b) in self.known.items())
+        
+        self._migrate_text_files(share_cb, verified_hash_cb)
+        self.check_remove()
+        
+        print("Share loading took %.3f seconds" % (time.time() - start))
+    
+    def _migrate_text_files(self, share_cb, verified_hash_cb):
+        # one-shot conversion of the old "<type> <hex>" per line shares.N files
         filenames, next = self.get_filenames_and_next()
+        if not filenames:
+            return
+        print("Migrating %i share files to the binary share store..." % (len(filenames),))
+        verified = set()
         for filename in filenames:
-            share_hashes, verified_hashes = known.setdefault(filename, (set(), set()))
             with open(filename, 'rb') as f:
                 for line in f:
                     try:
-                        type_id_str, data_hex = line.strip().split(' ')
+                        type_id_str, data_hex = line.strip().split(b' ')
                         type_id = int(type_id_str)
                         if type_id == 0:
                             pass
                         elif type_id == 1:
                             pass
                         elif type_id == 2:
-                            verified_hash = int(data_hex, 16)
-                            verified_hash_cb(verified_hash)
-                            verified_hashes.add(verified_hash)
+                            verified.add(int(data_hex, 16))
                         elif type_id == 5:
                             raw_share = share_type.unpack(binascii.unhexlify(data_hex))
                             if raw_share['type'] < Share.VERSION:
                                 continue
                             share = load_share(raw_share, self.net, None)
-                            share_cb(share)
-                            share_hashes.add(share.hash)
+                            if share.hash not in self.index:
+                                share_cb(share)
+                            self.add_share(share)
                         else:
                             raise NotImplementedError("share type %i" % (type_id,))
                     except Exception:
                         log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
-        
-        self.known = known # filename -> (set of share hashes, set of verified hashes)
-        self.known_desired = dict((k, (set(a), set(b))) for k, (a, b) in known.items())
-
-        print("Share loading took %.3f seconds" % (time.time() - start))
+        for share_hash in verified:
+            if share_hash in self.index:
+                if not self._get_verified_bit(self.index[share_hash][2]):
+                    verified_hash_cb(share_hash)
+                self.add_verified_hash(share_hash)
+        for filename in filenames:
+            os.remove(filename)
+        print("    ...migrated %i shares (%i verified)" % (len(self.index), len(verified)))
     
-    def _add_line(self, line):
-        filenames, next = self.get_filenames_and_next()
-        if filenames and os.path.getsize(filenames[-1]) < 10e6:
-            filename = filenames[-1]
-        else:
-            filename = next
-        
-        with open(filename, 'ab') as f:
-            f.write(line + b'\n')
-        
-        return filename
+    def _get_segment_filename(self, segment):
+        return os.path.join(self.dirname, self.filename + 'dat.' + str(segment))
+    
+    def _get_segment_number(self, filename):
+        return int(os.path.basename(filename)[len(self.filename + 'dat.'):])
+    
+    def _get_known_hashes(self, hashes_data, i, share_hash):
+        entry = hashes_data[i*share_hashes_entry.size:(i + 1)*share_hashes_entry.size]
+        if not entry.strip(b'\0'):
+            return None
+        gentx_hash, merkle_root, pow_hash = [pack.IntType(256).unpack(x) for x in share_hashes_entry.unpack(entry)]
+        return gentx_hash, merkle_root, pow_hash, share_hash
+    
+    def _get_verified_bit(self, i):
+        return i//8 < len(self.verified_bits) and bool(self.verified_bits[i//8] & (1 << i % 8))
     
     def add_share(self, share):
-        for filename, (share_hashes, verified_hashes) in self.known.items():
-            if share.hash in share_hashes:
-                break
+        if share.hash in self.index:
+            filename = self.index[share.hash][0]
         else:
-            filename = self._add_line(b"%i %s" % (5, binascii.hexlify(share_type.pack(share.as_share()))))
+            record = share_type.pack(share.as_share())
+            filenames, next = self.get_segment_filenames_and_next()
+            if filenames and os.path.getsize(filenames[-1]) < self.max_segment_size:
+                filename = filenames[-1]
+            else:
+                filename = next
+            with open(filename, 'ab') as f:
+                offset = f.tell()
+                f.write(share_record_length.pack(len(record)) + record)
+            with open(self.index_filename, 'ab') as f:
+                f.write(share_index_entry.pack(pack.IntType(256).pack(share.hash), self._get_segment_number(filename), offset))
+            with open(self.hashes_filename, 'ab') as f:
+                f.write(share_hashes_entry.pack(*[pack.IntType(256).pack(x) for x in [share.gentx_hash, share.header['merkle_root'], share.pow_hash]]))
+            self.index[share.hash] = filename, offset, self.index_size
+            self.index_size += 1
             share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
             share_hashes.add(share.hash)
         share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
         share_hashes.add(share.hash)
     
     def add_verified_hash(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known.items():
-            if share_hash in verified_hashes:
-                break
-        else:
-            filename = self._add_line(b"%i %x" % (2, share_hash))
+        if share_hash not in self.index:
+            return # verified bits are only kept for stored shares
+        filename, offset, i = self.index[share_hash]
+        if not self._get_verified_bit(i):
+            if i//8 >= len(self.verified_bits):
+                self.verified_bits.extend(b'\0'*(i//8 + 1 - len(self.verified_bits)))
+            self.verified_bits[i//8] |= 1 << i % 8
+            with open(self.verified_filename, 'r+b' if os.path.exists(self.verified_filename) else 'wb') as f:
+                f.seek(i//8)
+                f.write(self.verified_bits[i//8:i//8 + 1])
             share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
             verified_hashes.add(share_hash)
         share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
         verified_hashes.add(share_hash)
     
+    def get_segment_filenames_and_next(self):
+        prefix = self.filename + 'dat.'
+        suffixes = sorted(int(x[len(prefix):]) for x in os.listdir(self.dirname) if x.startswith(prefix) and x[len(prefix):].isdigit())
+        return [self._get_segment_filename(suffix) for suffix in suffixes], self._get_segment_filename(suffixes[-1] + 1 if suffixes else 0)
+    
     def get_filenames_and_next(self):
         suffixes = sorted(int(x[len(self.filename):]) for x in os.listdir(self.dirname) if x.startswith(self.filename) and x[len(self.filename):].isdigit())
         return [os.path.join(self.dirname, self.filename + str(suffix)) for suffix in suffixes], os.path.join(self.dirname, self.filename + (str(suffixes[-1] + 1) if suffixes else str(0)))
@@ -1087,3 +1660,28 @@ class ShareStore(object):
             self.known_desired.pop(filename)
             os.remove(filename)
             print("REMOVED", filename)
+        if to_remove:
+            self._compact_index()
+    
+    def _compact_index(self):
+        entries = sorted((i, share_hash, filename, offset) for share_hash, (filename, offset, i) in self.index.items() if filename in self.known)
+        old_hashes_data = b''
+        if os.path.exists(self.hashes_filename):
+            with open(self.hashes_filename, 'rb') as f:
+                old_hashes_data = f.read()
+        index_data = []
+        hashes_data = []
+        verified_bits = bytearray((len(entries) + 7)//8)
+        self.index = {}
+        for j, (i, share_hash, filename, offset) in enumerate(entries):
+            index_data.append(share_index_entry.pack(pack.IntType(256).pack(share_hash), self._get_segment_number(filename), offset))
+            hashes_data.append(old_hashes_data[i*share_hashes_entry.size:(i + 1)*share_hashes_entry.size].ljust(share_hashes_entry.size, b'\0'))
+            if self._get_verified_bit(i):
+                verified_bits[j//8] |= 1 << j % 8
+            self.index[share_hash] = filename, offset, j
+        self.index_size = len(entries)
+        self.verified_bits = verified_bits
+        for filename, data in [(self.index_filename, b''.join(index_data)), (self.verified_filename, bytes(verified_bits)), (self.hashes_filename, b''.join(hashes_data))]:
+            with open(filename + '.new', 'wb') as f:
+                f.write(data)
+            os.replace(filename + '.new', filename)
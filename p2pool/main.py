@@ -20,7 +20,7 @@ import p2pool.bitcoin.p2p as bitcoin_p2p, p2pool.bitcoin.data as bitcoin_data
 from p2pool.bitcoin import stratum, worker_interface, helper
 from p2pool.util import (fixargparse, jsonrpc, variable, deferral, math,
         logging, switchprotocol)
-from . import networks, web, work
+from . import networks, verifier, web, work
 import p2pool, p2pool.data as p2pool_data, p2pool.node as p2pool_node
 
 class keypool():
@@ -262,6 +262,7 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
             desired_outgoing_conns=args.p2pool_outgoing_conns,
             advertise_ip=args.advertise_ip,
             external_ip=args.p2pool_external_ip,
+            share_verifier=verifier.ShareVerifier(net, args.verify_workers),
         )
         node.p2p_node.start()
 
@@ -280,12 +281,14 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         wb = work.WorkerBridge(node, my_address, 0.0,
                                merged_urls, args.worker_fee, args, pubkeys,
                                bitcoind, args.share_rate)
-        web_root = web.get_web_root(wb, datadir_path, bitcoind_getinfo_var, static_dir=args.web_static)
+        # stratum splits the coinbase nonce itself, into per-connection extranonce1s
+        stratum_serverfactory = stratum.StratumServerFactory(wb)
+        web_root = web.get_web_root(wb, datadir_path, bitcoind_getinfo_var, static_dir=args.web_static, stratum_notifier=stratum_serverfactory.notifier)
         caching_wb = worker_interface.CachingWorkerBridge(wb)
         worker_interface.WorkerInterface(caching_wb).attach_to(web_root, get_handler=lambda request: request.redirect('/static/'))
         web_serverfactory = server.Site(web_root)
 
-        serverfactory = switchprotocol.FirstByteSwitchFactory({'{': stratum.StratumServerFactory(caching_wb)}, web_serverfactory)
+        serverfactory = switchprotocol.FirstByteSwitchFactory({b'{': stratum_serverfactory}, web_serverfactory)
         deferral.retry('Error binding to worker port:', traceback=False)(reactor.listenTCP)(worker_endpoint[1], serverfactory, interface=worker_endpoint[0])
 
         with open(os.path.join(os.path.join(datadir_path, 'ready_flag')), 'wb') as f:
@@ -299,6 +302,9 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         print('Go to http://127.0.0.1:%i/ to view graphs and statistics!' % (worker_endpoint[1],))
         print()
 
+        if args.reverify_shares:
+            node.reverify_hydrated_shares()
+
         if hasattr(signal, 'SIGALRM'):
             signal.signal(signal.SIGALRM, lambda signum, frame: reactor.callFromThread(
                 sys.stderr.write, 'Watchdog timer went off at:\n' + ''.join(traceback.format_stack())
@@ -490,6 +496,9 @@ def run():
     parser.add_argument('--irc-announce',
         help='announce any blocks found on irc://irc.freenode.net/#p2pool',
         action='store_true', default=False, dest='irc_announce')
+    parser.add_argument('--no-share-reverify',
+        help='''don't re-check the PoW of shares loaded from disk in the background after startup''',
+        action='store_false', default=True, dest='reverify_shares')
     parser.add_argument('--no-bugreport',
         help='disable submitting caught exceptions to the author',
         action='store_true', default=False, dest='no_bugreport')
@@ -510,6 +519,9 @@ def run():
     p2pool_group.add_argument('--external-ip', metavar='ADDR[:PORT]',
         help='specify your own public IP address instead of asking peers to discover it, useful for running dual WAN or asymmetric routing',
         type=str, action='store', default=None, dest='p2pool_external_ip')
+    p2pool_group.add_argument('--verify-workers', metavar='N',
+        help='compute the PoW of shares received from peers in N worker processes instead of on the main thread (default: 0)',
+        type=int, action='store', default=0, dest='verify_workers')
     parser.add_argument('--disable-advertise',
         help='''don't advertise local IP address as being available for incoming connections. useful for running a dark node, along with multiple -n ADDR's and --outgoing-conns 0''',
         action='store_false', default=True, dest='advertise_ip')
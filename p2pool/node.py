@@ -1,3 +1,4 @@
+import heapq
 import random
 import sys
 import time
@@ -21,6 +22,12 @@ class P2PNode(p2p.Node):
             mining2_txs_var=node.mining2_txs_var, # transactions sent to miners
         **kwargs)
 
+    def have_share(self, share):
+        return self.node.shares_by_contents.get(share) is not None
+    
+    def get_share(self, share_hash):
+        return self.node.tracker.items.get(share_hash)
+    
     def handle_shares(self, shares, peer):
         if len(shares) > 5:
             print('Processing %i shares from %s...' % (len(shares), '%s:%i' % peer.addr if peer is not None else None))
@@ -29,7 +36,7 @@ class P2PNode(p2p.Node):
         all_new_txs = {}
         for share, new_txs in shares:
             if new_txs is not None:
-                all_new_txs.update((bitcoin_data.hash256(bitcoin_data.tx_type.pack(new_tx)), new_tx) for new_tx in new_txs)
+                all_new_txs.update((new_tx.hash, new_tx) for new_tx in map(bitcoin_data.tx_store.add, new_txs))
 
             if share.hash in self.node.tracker.items:
                 #print 'Got duplicate share, ignoring. Hash: %s' % (p2pool_data.format_hash(share.hash),)
@@ -63,6 +70,17 @@ class P2PNode(p2p.Node):
         else:
             self.handle_shares([(share, []) for share in shares], peer)
 
+    def handle_get_share_hashes(self, share_hash, count, stops, peer):
+        count = min(count, 10000)
+        stops = set(stops)
+        share_hashes = []
+        if share_hash in self.node.tracker.items:
+            for share in self.node.tracker.get_chain(share_hash, min(count, self.node.tracker.get_height(share_hash))):
+                if share.hash in stops:
+                    break
+                share_hashes.append(share.hash)
+        return share_hashes
+
     def handle_get_shares(self, hashes, parents, stops, peer):
         parents = min(parents, 1000//len(hashes))
         stops = set(stops)
@@ -76,6 +94,10 @@ class P2PNode(p2p.Node):
             print('Sending %i shares to %s:%i' % (len(shares), peer.addr[0], peer.addr[1]))
         return shares
 
+    def stop(self):
+        self.downloader.stop()
+        return p2p.Node.stop(self)
+
     def handle_bestblock(self, header, peer):
         if self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(header)) > header['bits'].target:
             raise p2p.PeerMisbehavingError('received block header fails PoW test')
@@ -89,48 +111,17 @@ class P2PNode(p2p.Node):
             self.shared_share_hashes.add(share.hash)
             shares.append(share)
 
+        broadcast = p2p.ShareBroadcast(shares, self.node.tracker) # packed and framed once for every peer
         for peer in self.peers.values():
-            peer.sendShares([share for share in shares if share.peer_addr != peer.addr], self.node.tracker, self.node.known_txs_var.value, include_txs_with=[share_hash])
+            peer.sendShares([share for share in shares if share.peer_addr != peer.addr], self.node.tracker, self.node.known_txs_var.value, include_txs_with=[share_hash], broadcast=broadcast)
 
     def start(self):
         p2p.Node.start(self)
         self.shared_share_hashes = set(self.node.tracker.items)
         self.node.tracker.removed.watch_weakref(self, lambda self, share: self.shared_share_hashes.discard(share.hash))
 
-        @defer.inlineCallbacks
-        def download_shares():
-            while True:
-                desired = yield self.node.desired_var.get_when_satisfies(lambda val: len(val) != 0)
-                peer_addr, share_hash = random.choice(desired)
-
-                if len(self.peers) == 0:
-                    yield deferral.sleep(1)
-                    continue
-                peer = random.choice(list(self.peers.values()))
-
-                print('Requesting parent share %s from %s' % (p2pool_data.format_hash(share_hash), '%s:%i' % peer.addr))
-                try:
-                    shares = yield peer.get_shares(
-                        hashes=[share_hash],
-                        parents=random.randrange(500), # randomize parents so that we eventually get past a too large block of shares
-                        stops=list(set(self.node.tracker.heads) | set(
-                            self.node.tracker.get_nth_parent_hash(head, min(max(0, self.node.tracker.get_height_and_last(head)[0] - 1), 10)) for head in self.node.tracker.heads
-                        ))[:100],
-                    )
-                except defer.TimeoutError:
-                    print('Share request timed out!')
-                    continue
-                except Exception as e:
-                    log.err(None, 'in download_shares:%s' % e)
-                    peer.badPeerHappened(30)
-                    continue
-
-                if not shares:
-                    yield deferral.sleep(1) # sleep so we don't keep rerequesting the same share nobody has
-                    continue
-                self.handle_shares([(share, []) for share in shares], peer)
-
-        download_shares()
+        self.downloader = ShareDownloader(self)
+        self.downloader.start()
 
         @self.node.best_block_header.changed.watch
         def _(header):
@@ -153,6 +144,296 @@ class P2PNode(p2p.Node):
             reactor.callLater(5, spread) # so get_height_rel_highest can update
         
 
+class ShareDownloader(object):
+    '''Fetches the shares desired_var asks for from all peers at once. For
+    each desired share it first asks one peer for the hashes of the chain
+    below it (gethashes), then requests disjoint ranges of that chain from
+    different peers, keeping up to WINDOW sharereqs outstanding. Ranges that
+    time out or come back empty are retried on another peer. Peers are
+    picked by how many shares per second they have delivered. Peers too old
+    for gethashes are asked for one range at a time, each continuing where
+    the last one ended.'''
+    
+    WINDOW = 8 # sharereqs outstanding at once
+    PEER_WINDOW = 2 # ... to any one peer
+    RANGE = 100 # shares asked for in one sharereq
+    RETRY_DELAY = 1 # seconds before asking again for a share nobody had
+    
+    def __init__(self, p2p_node):
+        self.p2p_node = p2p_node
+        self.node = p2p_node.node
+        self.queue = [] # ranges not yet requested: (share hash, parents, stops, remaining, peers tried)
+        self.pending = {} # share hash -> peer, for ranges and chains requested
+        self.outstanding = {} # peer -> number of requests to it not yet answered
+        self.rates = {} # peer -> shares per second it delivered, averaged
+        self.failed = {} # share hash -> when nobody had it
+    
+    def start(self):
+        self._watch_id = self.node.desired_var.changed.watch(lambda desired: self._think())
+        self._stop_thinking = deferral.run_repeatedly(lambda: [self._think(), self.RETRY_DELAY][-1])
+    
+    def stop(self):
+        self.node.desired_var.changed.unwatch(self._watch_id)
+        self._stop_thinking()
+    
+    def _get_stops(self):
+        tracker = self.node.tracker
+        return list(set(tracker.heads) | set(
+            tracker.get_nth_parent_hash(head, min(max(0, tracker.get_height_and_last(head)[0] - 1), 10)) for head in tracker.heads
+        ))[:100]
+    
+    def _think(self):
+        for peer in list(self.rates):
+            if peer not in self.p2p_node.peers.values():
+                del self.rates[peer]
+        now = time.time()
+        for share_hash, t in list(self.failed.items()):
+            if t + self.RETRY_DELAY < now:
+                del self.failed[share_hash]
+        queued = set(x[0] for x in self.queue)
+        for peer_addr, share_hash in self.node.desired_var.value or []:
+            if share_hash in self.node.tracker.items or share_hash in self.pending or share_hash in queued or share_hash in self.failed:
+                continue
+            # enough for the chain above it to reach the length the tracker keeps
+            above = max([self.node.tracker.get_height(head) for head in self.node.tracker.tails.get(share_hash, [])] + [0])
+            count = max(self.RANGE, 2*self.node.net.CHAIN_LENGTH + 10 - above)
+            self._fetch_chain(share_hash, count)
+        self._pump()
+    
+    def _pick_peer(self, exclude=(), min_version=0):
+        peers = [peer for peer in self.p2p_node.peers.values() if peer not in exclude and peer.other_version >= min_version and
+            self.outstanding.get(peer, 0) < self.PEER_WINDOW]
+        if not peers:
+            return None
+        # peers we haven't measured first, so every peer gets tried
+        return max(peers, key=lambda peer: (peer not in self.rates, self.rates.get(peer, 0), -self.outstanding.get(peer, 0), random.random()))
+    
+    def _got_rate(self, peer, share_count, dt):
+        rate = share_count/max(dt, 1e-3)
+        self.rates[peer] = rate if peer not in self.rates else .7*self.rates[peer] + .3*rate
+    
+    @defer.inlineCallbacks
+    def _fetch_chain(self, share_hash, count):
+        peer = self._pick_peer(min_version=p2p.Protocol.SHARE_HASHES_VERSION)
+        if peer is None:
+            # nobody can tell us the chain's hashes, so fetch it a range at a time
+            self.queue.append((share_hash, min(self.RANGE, count) - 1, None, count, set()))
+            return
+        self.pending[share_hash] = peer
+        self.outstanding[peer] = self.outstanding.get(peer, 0) + 1
+        try:
+            share_hashes = yield peer.get_share_hashes(share_hash=share_hash, count=count, stops=self._get_stops())
+        except Exception as e:
+            print('Share hashes request to %s:%i failed: %s' % (peer.addr[0], peer.addr[1], e))
+            share_hashes = []
+        finally:
+            del self.pending[share_hash]
+            self.outstanding[peer] -= 1
+        if not share_hashes or share_hashes[0] != share_hash:
+            self.queue.append((share_hash, min(self.RANGE, count) - 1, None, count, set()))
+        else:
+            for i in range(0, len(share_hashes), self.RANGE):
+                stops = share_hashes[i + self.RANGE:i + self.RANGE + 1]
+                self.queue.append((share_hashes[i], min(self.RANGE, len(share_hashes) - i) - 1, stops, 0, set()))
+        self._pump()
+    
+    def _pump(self):
+        while self.queue and sum(self.outstanding.values()) < self.WINDOW:
+            for i, (share_hash, parents, stops, remaining, tried) in enumerate(self.queue):
+                peer = self._pick_peer(tried)
+                if peer is not None:
+                    break
+            else:
+                # every range left has been tried on every free peer
+                if not any(self.outstanding.values()):
+                    for share_hash, parents, stops, remaining, tried in self.queue:
+                        self.failed[share_hash] = time.time()
+                    self.queue = []
+                return
+            del self.queue[i]
+            self._request(peer, share_hash, parents, stops, remaining, tried)
+    
+    @defer.inlineCallbacks
+    def _request(self, peer, share_hash, parents, stops, remaining, tried):
+        print('Requesting %i shares from %s down from %s' % (parents + 1, '%s:%i' % peer.addr, p2pool_data.format_hash(share_hash)))
+        self.pending[share_hash] = peer
+        self.outstanding[peer] = self.outstanding.get(peer, 0) + 1
+        t0 = time.time()
+        try:
+            shares = yield peer.get_shares(
+                hashes=[share_hash],
+                parents=parents,
+                stops=stops if stops is not None else self._get_stops(),
+            )
+        except Exception as e:
+            if isinstance(e, defer.TimeoutError):
+                print('Share request timed out!')
+            else:
+                log.err(None, 'in download_shares:%s' % e)
+                peer.badPeerHappened(30)
+            self.rates[peer] = 0
+            shares = None
+        finally:
+            del self.pending[share_hash]
+            self.outstanding[peer] -= 1
+        
+        if not shares or shares[0].hash != share_hash:
+            # it doesn't have them; someone else might
+            self.queue.insert(0, (share_hash, parents, stops, remaining, tried | set([peer])))
+        else:
+            self._got_rate(peer, len(shares), time.time() - t0)
+            self.p2p_node.handle_shares([(share, []) for share in shares], peer)
+            remaining -= len(shares)
+            last = shares[-1].previous_hash
+            if remaining > 0 and last is not None and last not in self.node.tracker.items:
+                self.queue.insert(0, (last, min(self.RANGE, remaining) - 1, None, remaining, set()))
+        self._pump()
+
+class TrackerPruner(object):
+    '''Removes the shares clean_tracker drops: heads unseen for HEAD_AGE
+    seconds (other than the best few), and the bottom of chains whose
+    shortest branch is longer than 2*CHAIN_LENGTH+10. Kept up to date from
+    the tracker's events, so a pass only visits what it removes: heads are
+    in a heap by time_seen, and each tail has a heap of its heads by depth
+    (distance from an arbitrary point in their tree), whose top minus the
+    depth of the tail's children gives its shortest branch.'''
+    
+    HEAD_AGE = 300
+    UNVERIFIED_TAIL_AGE = 120 # an unverified head stays while shares are still arriving at the bottom of its chain
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        # heaps may hold entries for shares that are no longer heads (of that tail, at that depth); they're skipped when popped
+        self._heads = [] # heap of (time_seen, share hash)
+        self._depth = {} # share hash -> depth, one more than its parent's
+        self._tail_heads = {} # tail hash -> heap of (depth, head hash)
+        for tail in tracker.tails:
+            self._set_depths(tracker.reverse[tail], 0)
+            self._rebuild(tail)
+        for share_hash in tracker.heads:
+            self._push(share_hash)
+        tracker.added.watch_weakref(self, lambda self, share: self._handle_added(share))
+        tracker.removed.watch_weakref(self, lambda self, share: self._handle_removed(share))
+        
+        self.pruned_heads = 0
+        self.pruned_tails = 0
+        self.last_pass = dict(heads=0, tails=0, duration=0)
+    
+    def _push(self, share_hash):
+        heapq.heappush(self._heads, (self.tracker.items[share_hash].time_seen, share_hash))
+    
+    def _set_depths(self, share_hashes, depth):
+        todo = [(share_hash, depth) for share_hash in share_hashes]
+        while todo:
+            share_hash, depth = todo.pop()
+            self._depth[share_hash] = depth
+            todo.extend((child, depth + 1) for child in self.tracker.reverse.get(share_hash, ()))
+    
+    def _rebuild(self, tail):
+        self._tail_heads[tail] = [(self._depth[head], head) for head in self.tracker.tails[tail]]
+        heapq.heapify(self._tail_heads[tail])
+    
+    def _handle_added(self, share):
+        siblings = self.tracker.reverse[share.previous_hash] - set([share.hash])
+        children = self.tracker.reverse.get(share.hash, set())
+        if share.previous_hash in self.tracker.items:
+            depth = self._depth[share.previous_hash] + 1
+        elif siblings:
+            depth = self._depth[next(iter(siblings))]
+        elif children:
+            depth = self._depth[next(iter(children))] - 1
+        else:
+            depth = 0
+        self._depth[share.hash] = depth
+        if children: # joined the tree above it to the one it's on, or went under it
+            if self._depth[next(iter(children))] != depth + 1:
+                self._set_depths(children, depth + 1)
+            self._tail_heads.pop(share.hash, None)
+            self._rebuild(self.tracker.get_last(share.hash))
+        else:
+            heapq.heappush(self._tail_heads.setdefault(self.tracker.heads[share.hash], []), (depth, share.hash))
+            self._push(share.hash)
+    
+    def _handle_removed(self, share):
+        del self._depth[share.hash]
+        if share.previous_hash in self.tracker.items: # a head
+            if share.previous_hash in self.tracker.heads:
+                parent_tail = self.tracker.heads[share.previous_hash]
+                heapq.heappush(self._tail_heads[parent_tail], (self._depth[share.previous_hash], share.previous_hash))
+                self._push(share.previous_hash)
+        else: # the bottom of a tree; its children are on a tail of their own now
+            if share.previous_hash not in self.tracker.reverse:
+                heap = self._tail_heads.pop(share.previous_hash)
+                if share.hash in self.tracker.tails:
+                    self._tail_heads[share.hash] = heap
+            elif share.hash in self.tracker.tails:
+                self._rebuild(share.hash)
+    
+    def _get_min_height(self, tail):
+        heap = self._tail_heads[tail]
+        while True:
+            depth, head = heap[0]
+            if head in self.tracker.heads and self.tracker.heads[head] == tail and self._depth[head] == depth:
+                break
+            heapq.heappop(heap)
+        return depth - self._depth[next(iter(self.tracker.reverse[tail]))] + 1
+    
+    def _remove(self, share_hash):
+        if share_hash in self.tracker.verified.items:
+            self.tracker.verified.remove(share_hash)
+        self.tracker.remove(share_hash)
+    
+    def _prune_heads(self, best_heads, now):
+        removed = 0
+        seen = set()
+        kept = []
+        while self._heads and self._heads[0][0] <= now - self.HEAD_AGE:
+            time_seen, share_hash = entry = heapq.heappop(self._heads)
+            if share_hash in seen or share_hash not in self.tracker.heads:
+                continue
+            seen.add(share_hash)
+            if share_hash in best_heads or (share_hash not in self.tracker.verified.items and
+                    max(self.tracker.items[h].time_seen for h in self.tracker.reverse[self.tracker.heads[share_hash]]) > now - self.UNVERIFIED_TAIL_AGE):
+                kept.append(entry)
+                continue
+            self._remove(share_hash) # pushes its parent if that's a head now, which is popped next if it's old enough
+            removed += 1
+        for entry in kept:
+            heapq.heappush(self._heads, entry)
+        return removed
+    
+    def _prune_tails(self):
+        max_height = 2*self.tracker.net.CHAIN_LENGTH + 10
+        removed = 0
+        todo = list(self._tail_heads)
+        while todo:
+            tail = todo.pop()
+            if tail not in self.tracker.tails or self._get_min_height(tail) < max_height:
+                continue
+            bottoms = list(self.tracker.reverse[tail])
+            for share_hash in bottoms:
+                self._remove(share_hash)
+                removed += 1
+            todo.extend(bottoms) # now tails themselves
+        return removed
+    
+    def prune(self, best_heads, now=None):
+        '''best_heads: hashes of heads to keep however old they are. If it's
+        empty (nothing verified yet), no heads are removed.'''
+        start = time.time()
+        heads = self._prune_heads(set(best_heads), start if now is None else now) if best_heads else 0
+        tails = self._prune_tails()
+        self.pruned_heads += heads
+        self.pruned_tails += tails
+        self.last_pass = dict(heads=heads, tails=tails, duration=time.time() - start)
+    
+    def get_stats(self):
+        return dict(
+            pruned_heads=self.pruned_heads,
+            pruned_tails=self.pruned_tails,
+            last_pass=self.last_pass,
+        )
+
 class Node(object):
     def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net):
         self.factory = factory
@@ -178,6 +459,10 @@ class Node(object):
         for share_hash in known_verified_share_hashes:
             if share_hash in self.tracker.items:
                 self.tracker.verified.add(self.tracker.items[share_hash])
+        
+        self.pruner = TrackerPruner(self.tracker)
+        self.shares_by_contents = p2pool_data.ShareContentsIndex(self.tracker)
+        self.decorated_heads = [] # from the last think
 
         self.p2p_node = None # overwritten externally
         self.cur_share_ver = 0
@@ -261,7 +546,7 @@ class Node(object):
         @self.factory.new_tx.watch
         def _(tx):
             self.known_txs_var.add({
-                bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)): tx,
+                tx.hash: tx,
             })
 
         if self.cur_share_ver < 34:
@@ -320,7 +605,7 @@ class Node(object):
     
     def set_best_share(self):
         oldpunish = self.punish
-        best, desired, decorated_heads, bad_peer_addresses, self.punish= self.tracker.think(self.get_height_rel_highest, self.get_height, self.bitcoind_work.value['previous_block'], self.bitcoind_work.value['bits'], self.known_txs_var.value, self.feecache)
+        best, desired, self.decorated_heads, bad_peer_addresses, self.punish = self.tracker.think(self.get_height_rel_highest, self.get_height, self.bitcoind_work.value['previous_block'], self.bitcoind_work.value['bits'], self.known_txs_var.value, self.feecache)
         if self.punish and not oldpunish and best == self.best_share_var.value: # need to reissue work with lower difficulty
             self.best_share_var.changed.happened(best) # triggers wb.new_work_event to reissue work
 
@@ -342,50 +627,48 @@ class Node(object):
         return p2pool_data.get_expected_payouts(self.tracker, self.best_share_var.value, self.bitcoind_work.value['bits'].target, self.bitcoind_work.value['subsidy'], self.net)
     
     def clean_tracker(self):
-        best, desired, decorated_heads, bad_peer_addresses, self.punish = self.tracker.think(self.get_height_rel_highest, self.get_height, self.bitcoind_work.value['previous_block'], self.bitcoind_work.value['bits'], self.known_txs_var.value, self.feecache)
-        
-        # eat away at heads
-        if decorated_heads:
-            for i in range(1000):
-                to_remove = set()
-                for share_hash, tail in self.tracker.heads.items():
-                    if share_hash in [head_hash for score, head_hash in decorated_heads[-5:]]:
-                        #print 1
-                        continue
-                    if self.tracker.items[share_hash].time_seen > time.time() - 300:
-                        #print 2
-                        continue
-                    if share_hash not in self.tracker.verified.items and max(self.tracker.items[after_tail_hash].time_seen for after_tail_hash in self.tracker.reverse.get(tail)) > time.time() - 120: # XXX stupid
-                        #print 3
-                        continue
-                    to_remove.add(share_hash)
-                if not to_remove:
-                    break
-                for share_hash in to_remove:
-                    if share_hash in self.tracker.verified.items:
-                        self.tracker.verified.remove(share_hash)
-                    self.tracker.remove(share_hash)
-                #print "_________", to_remove
-        
-        # drop tails
-        for i in range(1000):
-            to_remove = set()
-            for tail, heads in self.tracker.tails.items():
-                if min(self.tracker.get_height(head) for head in heads) < 2*self.tracker.net.CHAIN_LENGTH + 10:
-                    continue
-                to_remove.update(self.tracker.reverse.get(tail, set()))
-            if not to_remove:
-                break
-            # if removed from this, it must be removed from verified
-            #start = time.time()
-            for aftertail in to_remove:
-                if self.tracker.items[aftertail].previous_hash not in self.tracker.tails:
-                    print("erk", aftertail, self.tracker.items[aftertail].previous_hash)
-                    continue
-                if aftertail in self.tracker.verified.items:
-                    self.tracker.verified.remove(aftertail)
-                self.tracker.remove(aftertail)
-            #end = time.time()
-            #print "removed! %i %f" % (len(to_remove), (end - start)/len(to_remove))
-        
+        self.pruner.prune([head_hash for score, head_hash in self.decorated_heads[-5:]])
         self.set_best_share()
+    
+    def remove_share_and_descendants(self, share_hash):
+        descendants = [h for h in self.tracker.items if self.tracker.is_child_of(share_hash, h)]
+        # highest first, so that every share is a head by the time it is removed
+        for h in sorted(descendants, key=self.tracker.get_height, reverse=True):
+            if h in self.tracker.verified.items:
+                self.tracker.verified.remove(h)
+            self.tracker.remove(h)
+    
+    @defer.inlineCallbacks
+    def reverify_hydrated_shares(self, batch_size=20):
+        # shares loaded from the share store skipped the hash link and PoW checks;
+        # redo them a few at a time once we're already serving work
+        start = time.time()
+        count = 0
+        shares = [share for share in self.tracker.items.values() if share.hydrated]
+        for i in range(0, len(shares), batch_size):
+            batch = [share for share in shares[i:i + batch_size] if share.hash in self.tracker.items and share.hydrated]
+            headers = []
+            for share in batch:
+                try:
+                    headers.append(share.get_packed_header()[2])
+                except Exception:
+                    pass # reverify raises it again
+            # the batch's PoW in one call, so that reverify finds it in the cache
+            self.net.PARENT.POW_FUNC.get_many(headers)
+            for share in batch:
+                if share.hash not in self.tracker.items or not share.hydrated:
+                    continue
+                count += 1
+                try:
+                    ok = share.reverify()
+                except Exception:
+                    log.err(None, 'Error while re-verifying stored share %s:' % (p2pool_data.format_hash(share.hash),))
+                    ok = False
+                if not ok:
+                    print('Stored share %s failed re-verification! Removing it and its descendants.' % (p2pool_data.format_hash(share.hash),), file=sys.stderr)
+                    self.remove_share_and_descendants(share.hash)
+                    self.set_best_share() # the best share may have been among them
+            yield deferral.sleep(0)
+        if count:
+            print('Re-verified %i stored shares in %.3f seconds' % (count, time.time() - start))
+            self.set_best_share()
@@ -7,7 +7,7 @@ from twisted.internet import defer, protocol, reactor, task
 from twisted.python import failure, log
 
 import p2pool
-from p2pool import data as p2pool_data
+from p2pool import data as p2pool_data, verifier
 from p2pool.bitcoin import data as bitcoin_data
 from p2pool.util import deferral, p2protocol, pack, variable
 
@@ -22,8 +22,105 @@ def fragment(f, **kwargs):
         fragment(f, **dict((k, v[:len(v)//2]) for k, v in kwargs.items()))
         fragment(f, **dict((k, v[len(v)//2:]) for k, v in kwargs.items()))
 
+class ShareBroadcast(object):
+    '''A shares message going out to many peers, serialized once: each share
+    is packed once, and each distinct selection of them (peers aren't sent
+    the shares they sent us) is framed once, checksum included, so every
+    peer it's for is written the same bytes. Given the tracker, it also
+    makes the cmpctshares message for peers that take it.'''
+    
+    def __init__(self, shares, tracker=None):
+        self._packed = dict((share.hash, p2pool_data.share_type.pack(share.as_share())) for share in shares)
+        self._tracker = tracker
+        self._compact = {} # share hash -> packed compact_share_type record, made on first use
+        self._frames = {} # (compact, prefix, max payload length, share hashes) -> frames
+    
+    def can_compact(self, shares):
+        return self._tracker is not None and all(share.VERSION >= 34 for share in shares)
+    
+    def get_frames(self, shares, message_prefix, max_payload_length, compact=False):
+        key = compact, message_prefix, max_payload_length, tuple(share.hash for share in shares)
+        frames = self._frames.get(key)
+        if frames is None:
+            if compact:
+                assert self.can_compact(shares)
+                packed = [self._get_compact(share) for share in shares]
+            else:
+                packed = [self._packed[share.hash] for share in shares]
+            frames = self._frames[key] = self._frame(packed, message_prefix, max_payload_length, 'cmpctshares' if compact else 'shares')
+        return frames
+    
+    def _get_compact(self, share):
+        packed = self._compact.get(share.hash)
+        if packed is None:
+            packed = self._compact[share.hash] = p2pool_data.compact_share_type.pack(
+                p2pool_data.get_compact_share(share, self._tracker.items.get(share.previous_hash)))
+        return packed
+    
+    def _frame(self, packed_shares, message_prefix, max_payload_length, command):
+        payload = pack.VarIntType().pack(len(packed_shares)) + b''.join(packed_shares)
+        if len(payload) > max_payload_length:
+            # split like fragment does
+            if len(packed_shares) < 2:
+                raise p2protocol.TooLong('share too long')
+            half = len(packed_shares)//2
+            return self._frame(packed_shares[:half], message_prefix, max_payload_length, command) + self._frame(packed_shares[half:], message_prefix, max_payload_length, command)
+        return [p2protocol.frame_message(message_prefix, command, payload)]
+
+class TxDiff(object):
+    '''One transition of a hash -> tx dict, worked out once for every peer it
+    goes to: the hashes added and removed, the removed txs, and the sizes
+    remember_tx accounts for them with.'''
+    
+    def __init__(self, added, removed, removed_txs, added_size, removed_size):
+        self.added = added
+        self.removed = removed
+        self.removed_txs = removed_txs
+        self.added_size = added_size
+        self.removed_size = removed_size
+
+class TxSetDiffer(object):
+    '''Watches a Variable holding a hash -> tx dict and diffs each of its
+    transitions once, telling diffed's watchers (every peer's view of it)
+    with a TxDiff. The cost of a transition scales with the number of txs,
+    no longer with that times the number of peers. Also caches txs' sizes
+    as remember_tx accounts for them, for as long as they are in the dict.'''
+    
+    def __init__(self, var):
+        self.var = var
+        self.diffed = variable.Event()
+        self._sizes = {} # tx hash -> 100 + packed size
+        var.transitioned.watch(self._transitioned)
+    
+    def get_size(self, tx_hash, tx):
+        size = self._sizes.get(tx_hash)
+        if size is None:
+            size = self._sizes[tx_hash] = 100 + bitcoin_data.tx_type.packed_size(tx)
+        return size
+    
+    def get_total_size(self):
+        return sum(self.get_size(tx_hash, tx) for tx_hash, tx in self.var.value.items())
+    
+    def _transitioned(self, before, after):
+        t0 = time.time()
+        added = [tx_hash for tx_hash in after if tx_hash not in before]
+        removed = [tx_hash for tx_hash in before if tx_hash not in after]
+        if not added and not removed:
+            return
+        removed_txs = dict((tx_hash, before[tx_hash]) for tx_hash in removed)
+        added_size = sum(self.get_size(tx_hash, after[tx_hash]) for tx_hash in added)
+        removed_size = sum(self.get_size(tx_hash, tx) for tx_hash, tx in removed_txs.items())
+        for tx_hash in removed:
+            self._sizes.pop(tx_hash, None)
+        t1 = time.time()
+        self.diffed.happened(TxDiff(added, removed, removed_txs, added_size, removed_size))
+        t2 = time.time()
+        if p2pool.BENCH: print("%8.3f ms for diffing %i -> %i txs (%i added, %i removed), %8.3f ms for %i peers' views" % ((t1-t0)*1000., len(before), len(after), len(added), len(removed), (t2-t1)*1000., len(self.diffed.observers)))
+
 class Protocol(p2protocol.Protocol):
-    VERSION = 3501
+    VERSION = 3503
+    COMPACT_SHARES_VERSION = 3502 # peers from this version on take cmpctshares
+    SHARE_HASHES_VERSION = 3503 # ... and answer gethashes
 
     max_remembered_txs_size = 25000000
 
@@ -67,6 +164,12 @@ class Protocol(p2protocol.Protocol):
             timeout=15,
             on_timeout=self.disconnect,
         )
+        self.get_share_hashes = deferral.GenericDeferrer(
+            max_id=2**256,
+            func=lambda id, share_hash, count, stops: self.send_gethashes(id=id, hash=share_hash, count=count, stops=stops),
+            timeout=15,
+            on_timeout=self.disconnect,
+        )
 
         self.remote_tx_hashes = set() # view of peer's known_txs # not actually initially empty, but sending txs instead of tx hashes won't hurt
         self.remote_remembered_txs_size = 0
@@ -208,44 +311,34 @@ class Protocol(p2protocol.Protocol):
         watch_id1 = self.node.known_txs_var.removed.watch(remove_from_remote_view_of_my_known_txs)
         self.connection_lost_event.watch(lambda: self.node.known_txs_var.removed.unwatch(watch_id1))
         
-        def update_remote_view_of_my_known_txs(before, after):
-            t0 = time.time()
-            added = set(after) - set(before)
-            removed = set(before) - set(after)
-            if added:
-                self.send_have_tx(tx_hashes=list(added))
-            if removed:
-                self.send_losing_tx(tx_hashes=list(removed))
+        def update_remote_view_of_my_known_txs(diff):
+            if diff.added:
+                self.send_have_tx(tx_hashes=diff.added)
+            if diff.removed:
+                self.send_losing_tx(tx_hashes=diff.removed)
                 
                 # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
                 key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
-                self.known_txs_cache[key] = dict((h, before[h]) for h in removed)
+                self.known_txs_cache[key] = diff.removed_txs
                 reactor.callLater(20, self.known_txs_cache.pop, key)
-            t1 = time.time()
-            if p2pool.BENCH and (t1-t0) > .01: print("%8.3f ms for update_remote_view_of_my_known_txs" % ((t1-t0)*1000.))
-        watch_id2 = self.node.known_txs_var.transitioned.watch(update_remote_view_of_my_known_txs)
-        self.connection_lost_event.watch(lambda: self.node.known_txs_var.transitioned.unwatch(watch_id2))
+        watch_id2 = self.node.known_txs_differ.diffed.watch(update_remote_view_of_my_known_txs)
+        self.connection_lost_event.watch(lambda: self.node.known_txs_differ.diffed.unwatch(watch_id2))
         
         self.send_have_tx(tx_hashes=self.node.known_txs_var.value.keys())
         
-        def update_remote_view_of_my_mining_txs(before, after):
-            t0 = time.time()
-            added = set(after) - set(before)
-            removed = set(before) - set(after)
-            if removed:
-                self.send_forget_tx(tx_hashes=list(removed))
-                self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(before[x]) for x in removed)
-            if added:
-                self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(after[x]) for x in added)
+        def update_remote_view_of_my_mining_txs(diff):
+            if diff.removed:
+                self.send_forget_tx(tx_hashes=diff.removed)
+                self.remote_remembered_txs_size -= diff.removed_size
+            if diff.added:
+                self.remote_remembered_txs_size += diff.added_size
                 assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
-                fragment(self.send_remember_tx, tx_hashes=[x for x in added if x in self.remote_tx_hashes], txs=[after[x] for x in added if x not in self.remote_tx_hashes])
-            t1 = time.time()
-            if p2pool.BENCH and (t1-t0) > .01: print("%8.3f ms for update_remote_view_of_my_mining_txs" % ((t1-t0)*1000.))
+                fragment(self.send_remember_tx, tx_hashes=[x for x in diff.added if x in self.remote_tx_hashes], txs=[self.node.mining_txs_var.value[x] for x in diff.added if x not in self.remote_tx_hashes])
 
-        watch_id2 = self.node.mining_txs_var.transitioned.watch(update_remote_view_of_my_mining_txs)
-        self.connection_lost_event.watch(lambda: self.node.mining_txs_var.transitioned.unwatch(watch_id2))
+        watch_id3 = self.node.mining_txs_differ.diffed.watch(update_remote_view_of_my_mining_txs)
+        self.connection_lost_event.watch(lambda: self.node.mining_txs_differ.diffed.unwatch(watch_id3))
         
-        self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(x) for x in list(self.node.mining_txs_var.value.values()))
+        self.remote_remembered_txs_size += self.node.mining_txs_differ.get_total_size()
         assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
         fragment(self.send_remember_tx, tx_hashes=[], txs=list(self.node.mining_txs_var.value.values()))
     
@@ -311,6 +404,20 @@ class Protocol(p2protocol.Protocol):
     ])
     def handle_shares(self, shares):
         t0 = time.time()
+        # shares we have are usually relayed to us by every other peer too; drop them before loading
+        shares = [wrappedshare for wrappedshare in shares if wrappedshare['type'] >= p2pool_data.Share.VERSION and not self.node.have_share(wrappedshare)]
+        if all(wrappedshare['type'] >= 34 for wrappedshare in shares):
+            # no transactions to look up, so loading can happen off the reactor
+            def got_shares(loaded):
+                self.node.handle_shares([(share, None) for share in loaded], self)
+                t1 = time.time()
+                if p2pool.BENCH: print("%8.3f ms for %i shares in handle_shares (%3.3f ms/share)" % ((t1-t0)*1000., len(shares), (t1-t0)*1000./ max(1, len(shares))))
+            d = self.node.share_verifier.load_shares(shares, self.addr)
+            d.addCallback(got_shares)
+            d.addErrback(self._share_load_failed)
+            d.addErrback(lambda fail: None) # handled, there's no caller to pass it on to
+            return
+        
         result = []
         for wrappedshare in shares:
             if wrappedshare['type'] < p2pool_data.Share.VERSION: continue
@@ -341,8 +448,30 @@ class Protocol(p2protocol.Protocol):
         t1 = time.time()
         if p2pool.BENCH: print("%8.3f ms for %i shares in handle_shares (%3.3f ms/share)" % ((t1-t0)*1000., len(shares), (t1-t0)*1000./ max(1, len(shares))))
 
-    
-    def sendShares(self, shares, tracker, known_txs, include_txs_with=[]):
+    message_cmpctshares = pack.ComposedType([
+        ('shares', pack.ListType(p2pool_data.compact_share_type)),
+    ])
+    def handle_cmpctshares(self, shares):
+        raw_shares = []
+        missing = []
+        for compact_share in shares:
+            if self.node.get_share(compact_share['hash']) is not None:
+                continue
+            try:
+                raw_share = p2pool_data.decompact_share(compact_share, self.node.net, self.node.get_share)
+            except (ValueError, pack.EarlyEnd, pack.LateEnd) as e:
+                raise PeerMisbehavingError('sent a bad compact share: %r' % (e,))
+            if raw_share is None:
+                missing.append(compact_share['hash']) # built on a share we don't have; ask for it whole
+            else:
+                raw_shares.append(raw_share)
+        if raw_shares:
+            self.handle_shares(raw_shares)
+        if missing:
+            self.node.handle_share_hashes(missing, self)
+    
+    def sendShares(self, shares, tracker, known_txs, include_txs_with=[], broadcast=None):
+        # broadcast is a ShareBroadcast covering shares, shared between the peers they're sent to
         t0 = time.time()
         tx_hashes = set()
         hashes_to_send = []
@@ -368,13 +497,13 @@ class Protocol(p2protocol.Protocol):
         
             hashes_to_send = [x for x in tx_hashes if x not in self.node.mining_txs_var.value and x in known_txs]
             all_hashes = share.share_info['new_transaction_hashes']
-            new_tx_size = sum(100 + bitcoin_data.tx_type.packed_size(known_txs[x]) for x in hashes_to_send)
-            all_tx_size = sum(100 + bitcoin_data.tx_type.packed_size(known_txs[x]) for x in all_hashes)
+            new_tx_size = sum(self.node.known_txs_differ.get_size(x, known_txs[x]) for x in hashes_to_send)
+            all_tx_size = sum(self.node.known_txs_differ.get_size(x, known_txs[x]) for x in all_hashes)
             print("Sending a share with %i txs (%i new) totaling %i msg bytes (%i new)" % (len(all_hashes), len(hashes_to_send), all_tx_size, new_tx_size))
 
         if tx_hashes:
             hashes_to_send = [x for x in tx_hashes if x not in self.node.mining_txs_var.value and x in known_txs]
-            new_tx_size = sum(100 + bitcoin_data.tx_type.packed_size(known_txs[x]) for x in hashes_to_send)
+            new_tx_size = sum(self.node.known_txs_differ.get_size(x, known_txs[x]) for x in hashes_to_send)
 
             new_remote_remembered_txs_size = self.remote_remembered_txs_size + new_tx_size
             if new_remote_remembered_txs_size > self.max_remembered_txs_size:
@@ -383,7 +512,11 @@ class Protocol(p2protocol.Protocol):
 
             fragment(self.send_remember_tx, tx_hashes=[x for x in hashes_to_send if x in self.remote_tx_hashes], txs=[known_txs[x] for x in hashes_to_send if x not in self.remote_tx_hashes])
 
-        fragment(self.send_shares, shares=[share.as_share() for share in shares])
+        if broadcast is None:
+            broadcast = ShareBroadcast(shares, tracker)
+        compact = self.other_version >= self.COMPACT_SHARES_VERSION and broadcast.can_compact(shares)
+        for data in broadcast.get_frames(shares, self._message_prefix, self._max_payload_length, compact):
+            self.sendFrame(data)
 
         if hashes_to_send:
             self.send_forget_tx(tx_hashes=hashes_to_send)
@@ -415,10 +548,36 @@ class Protocol(p2protocol.Protocol):
     class ShareReplyError(Exception): pass
     def handle_sharereply(self, id, result, shares):
         if result == 'good':
-            res = [p2pool_data.load_share(share, self.node.net, self.addr) for share in shares if share['type'] >= p2pool_data.Share.VERSION]
+            d = self.node.share_verifier.load_shares([share for share in shares if share['type'] >= p2pool_data.Share.VERSION], self.addr)
+            d.addErrback(self._share_load_failed)
         else:
-            res = failure.Failure(self.ShareReplyError(result))
-        self.get_shares.got_response(id, res)
+            d = defer.fail(self.ShareReplyError(result))
+        d.addBoth(lambda res: self.get_shares.got_response(id, res))
+    
+    message_gethashes = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('hash', pack.IntType(256)),
+        ('count', pack.VarIntType()),
+        ('stops', pack.ListType(pack.IntType(256))),
+    ])
+    def handle_gethashes(self, id, hash, count, stops):
+        self.send_hashes(id=id, hashes=self.node.handle_get_share_hashes(hash, count, stops, self))
+    
+    message_hashes = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('hashes', pack.ListType(pack.IntType(256))),
+    ])
+    def handle_hashes(self, id, hashes):
+        self.get_share_hashes.got_response(id, hashes)
+    
+    def _share_load_failed(self, fail):
+        if fail.check(PeerMisbehavingError):
+            print('Peer %s:%i misbehaving, will drop and ban. Reason:' % self.addr, fail.value)
+            self.badPeerHappened()
+        else:
+            log.err(fail, 'Error loading shares from %s:%i:' % self.addr)
+            self.disconnect()
+        return fail
     
     
     message_bestblock = pack.ComposedType([
@@ -450,7 +609,7 @@ class Protocol(p2protocol.Protocol):
     
     message_remember_tx = pack.ComposedType([
         ('tx_hashes', pack.ListType(pack.IntType(256))),
-        ('txs', pack.ListType(bitcoin_data.tx_type)),
+        ('txs', pack.ListType(bitcoin_data.stored_tx_type)),
     ])
     def handle_remember_tx(self, tx_hashes, txs):
         t0 = time.time()
@@ -478,7 +637,7 @@ class Protocol(p2protocol.Protocol):
         added_known_txs = {}
         warned = False
         for tx in txs:
-            tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
+            tx_hash = tx.hash
             if tx_hash in self.remembered_txs:
                 print('Peer referenced transaction twice, disconnecting', file=sys.stderr)
                 self.disconnect()
@@ -489,7 +648,7 @@ class Protocol(p2protocol.Protocol):
                 warned = True
             
             self.remembered_txs[tx_hash] = tx
-            self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
+            self.remembered_txs_size += 100 + tx.size
             added_known_txs[tx_hash] = tx
         self.node.known_txs_var.add(added_known_txs)
         if self.remembered_txs_size >= self.max_remembered_txs_size:
@@ -520,6 +679,7 @@ class Protocol(p2protocol.Protocol):
         if p2pool.DEBUG:
             print("Peer connection lost:", self.addr, reason)
         self.get_shares.respond_all(reason)
+        self.get_share_hashes.respond_all(reason)
     
     @defer.inlineCallbacks
     def do_ping(self):
@@ -671,7 +831,7 @@ class SingleClientFactory(protocol.ReconnectingClientFactory):
         self.node.lost_conn(proto, reason)
 
 class Node(object):
-    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=variable.VariableDict({}), mining_txs_var=variable.VariableDict({}), mining2_txs_var=variable.VariableDict({}), advertise_ip=True, external_ip=None):
+    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=variable.VariableDict({}), mining_txs_var=variable.VariableDict({}), mining2_txs_var=variable.VariableDict({}), advertise_ip=True, external_ip=None, share_verifier=None):
         self.best_share_hash_func = best_share_hash_func
         self.port = port
         self.net = net
@@ -681,8 +841,11 @@ class Node(object):
         self.known_txs_var = known_txs_var
         self.mining_txs_var = mining_txs_var
         self.mining2_txs_var = mining2_txs_var
+        self.known_txs_differ = TxSetDiffer(known_txs_var)
+        self.mining_txs_differ = TxSetDiffer(mining_txs_var)
         self.advertise_ip = advertise_ip
         self.external_ip = external_ip
+        self.share_verifier = share_verifier if share_verifier is not None else verifier.ShareVerifier(net)
         
         self.traffic_happened = variable.Event()
         self.nonce = random.randrange(2**64)
@@ -763,6 +926,12 @@ class Node(object):
             if len(self.addr_store) < 10000:
                 self.addr_store[host, port] = services, timestamp, timestamp
 
+    def have_share(self, share):
+        return False
+    
+    def get_share(self, share_hash):
+        return None
+    
     def handle_shares(self, shares, peer):
         print('handle_shares %s %s' % (shares, peer))
 
@@ -772,6 +941,9 @@ class Node(object):
     def handle_get_shares(self, hashes, parents, stops, peer):
         print('handle_get_shares %s %s %s %s' % (hashes, parents, stops, peer))
 
+    def handle_get_share_hashes(self, share_hash, count, stops, peer):
+        return []
+
     def handle_bestblock(self, header, peer):
         print('handle_bestblock %s' % header)
 
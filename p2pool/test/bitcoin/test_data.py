@@ -1,3 +1,6 @@
+import hashlib
+import random
+import threading
 import unittest
 import mock
 from random import randint
@@ -85,6 +88,158 @@ class Test(unittest.TestCase):
             0x67d76a64fa9b6c5d39fde87356282ef507b3dec1eead4b54e739c74e02e81db4,
         ]) == 0x37a43a3b812e4eb665975f46393b4360008824aab180f27d642de8c28073bc44
 
+    def test_merkle_tree(self):
+        def check(tree, hashes):
+            assert tree.hashes == hashes
+            assert tree.get_root() == data.merkle_hash([h or 0 for h in hashes])
+            for index in set([0, len(hashes) - 1, randint(0, len(hashes) - 1)]):
+                assert tree.get_link(index) == data.calculate_merkle_link(hashes, index)
+
+        hashes = [None] + [randint(0, 2**256 - 1) for i in range(100)]
+        tree = data.MerkleTree(hashes)
+        check(tree, hashes)
+        for i in range(200):
+            hashes = list(hashes)
+            action = randint(0, 4) if len(hashes) > 1 else 0
+            if action == 0: # new transactions
+                hashes.extend(randint(0, 2**256 - 1) for j in range(randint(1, 20)))
+            elif action == 1: # mined or evicted ones
+                for j in range(randint(1, min(10, len(hashes) - 1))):
+                    del hashes[randint(1, len(hashes) - 1)]
+            elif action == 2:
+                hashes[randint(1, len(hashes) - 1)] = randint(0, 2**256 - 1)
+            elif action == 3:
+                del hashes[randint(1, len(hashes)):]
+            else:
+                hashes.insert(randint(1, len(hashes)), randint(0, 2**256 - 1))
+            tree = data.MerkleTree(hashes, tree)
+            check(tree, hashes)
+        assert data.MerkleTree([]).get_root() == 0
+
+    def test_merkle_tree_cache(self):
+        cache = data.MerkleTreeCache(2)
+        a, b, c = [[None] + [randint(0, 2**256 - 1) for i in range(n)] for n in [10, 20, 30]]
+        tree_a = cache.get(a)
+        assert cache.get(list(a)) is tree_a
+        tree_b, tree_c = cache.get(b), cache.get(c)
+        assert cache.get(a) is not tree_a # evicted
+        tree = cache.get(a + [1])
+        assert tree.get_link(0) == data.calculate_merkle_link(a + [1], 0)
+        assert tree.levels[0][1] is cache.get(a).levels[0][1] # built from the cached tree for a
+
+class PoWCacheTest(unittest.TestCase):
+    def test_cache(self):
+        calls = []
+        def pow_func(header):
+            calls.append(header)
+            return data.hash256(header)
+        cache = data.PoWCache(pow_func, size=3)
+        headers = [bytes([i])*80 for i in range(4)]
+        for header in headers[:3] + headers[:3]:
+            assert cache(header) == data.hash256(header)
+        assert calls == headers[:3] and cache.get_stats() == dict(hits=3, misses=3, size=3)
+        cache(headers[0]) # most recently used now, so headers[1] goes next
+        cache(headers[3])
+        cache(memoryview(headers[0]))
+        cache(headers[1])
+        assert calls == headers + headers[1:2] and cache.get_stats() == dict(hits=5, misses=5, size=3)
+    
+    def test_threads(self):
+        cache = data.PoWCache(data.hash256, size=50)
+        headers = [bytes([i])*80 for i in range(100)]
+        errors = []
+        def run(seed):
+            rng = random.Random(seed)
+            for i in range(2000):
+                header = rng.choice(headers)
+                if cache(header) != data.hash256(header):
+                    errors.append(header)
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.get_stats()
+        assert not errors and stats['hits'] + stats['misses'] == 8*2000 and stats['size'] == 50
+    
+    def test_get_many(self):
+        batches = []
+        def batch_func(headers):
+            batches.append(headers)
+            return b''.join(data.hash256(header).to_bytes(32, 'little') for header in headers)
+        cache = data.PoWCache(lambda header: 1/0, batch_func)
+        headers = [bytes([i])*80 for i in range(4)]
+        cache.get_many(headers[:2])
+        assert cache.get_many(headers[1:] + [bytearray(headers[3])]) == [data.hash256(header) for header in headers[1:] + headers[3:]]
+        assert batches == [headers[:2], headers[2:]] and cache(headers[3]) == data.hash256(headers[3])
+        assert cache.get_stats() == dict(hits=2, misses=4, size=4)
+        
+        cache = data.PoWCache(data.hash256)
+        assert cache.get_many(headers) == [data.hash256(header) for header in headers]
+    
+    def test_networks(self):
+        assert all(isinstance(net.POW_FUNC, data.PoWCache) for net in networks.nets.values())
+    
+    def test_scrypt_batch(self):
+        try:
+            import ltc_scrypt
+        except ImportError:
+            raise unittest.SkipTest('ltc_scrypt not built')
+        headers = [bytes([i])*80 for i in range(5)]
+        digests = b''.join(hashlib.scrypt(header, salt=header, n=1024, r=1, p=1, dklen=32) for header in headers)
+        assert [ltc_scrypt.getPoWHash(header) for header in headers] == [digests[i*32:i*32 + 32] for i in range(5)]
+        for threads in [1, 4, 16]:
+            assert ltc_scrypt.getPoWHashes(headers, threads) == ltc_scrypt.getPoWHashes(b''.join(headers), threads) == digests
+        assert ltc_scrypt.getPoWHashes([]) == b''
+        self.assertRaises(ValueError, ltc_scrypt.getPoWHashes, b'\0'*81)
+
+class TxTest(unittest.TestCase):
+    def make_txs(self):
+        tx_in = dict(previous_output=dict(hash=0x1234, index=1), script=b'\x51'*30, sequence=None)
+        tx_outs = [dict(value=5000, script=b'\x00'*22), dict(value=7000, script=b'\x00'*25)]
+        return [
+            dict(version=1, tx_ins=[tx_in], tx_outs=tx_outs, lock_time=0),
+            dict(version=2, marker=0, flag=1, tx_ins=[tx_in, tx_in], tx_outs=tx_outs, witness=[[b'\x01'*72, b'\x02'*33], []], lock_time=5),
+            dict(version=2, marker=0, flag=1, tx_ins=[tx_in], tx_outs=tx_outs, witness=[[]], lock_time=0),
+        ]
+    
+    def test_precomputed(self):
+        for record in self.make_txs():
+            packed = data.tx_type.pack(record)
+            tx = data.Tx(packed)
+            assert tx.raw == packed and tx.hash == data.hash256(packed) and tx.size == len(packed)
+            assert tx.txid == data.get_txid(record) and data.get_txid(tx) == tx.txid
+            assert data.get_wtxid(tx) == tx.wtxid == data.get_wtxid(record)
+            assert tx.segwit == data.is_segwit_tx(tx) == data.is_segwit_tx(record)
+            assert tx.stripped_size == data.tx_id_type.packed_size(record) == data.get_stripped_size(tx)
+            assert data.get_size(tx) == data.get_size(dict(record))
+            assert tx.weight == 3*tx.stripped_size + tx.size
+            assert tx == record and tx.decode() == record and tx['tx_outs'] == record['tx_outs'] and tx.get('marker') == record.get('marker')
+            assert data.tx_type.pack(tx) == packed and data.tx_type.packed_size(tx) == len(packed)
+            assert data.tx_type.pack(dict(version=1, tx_ins=[], tx_outs=[], lock_time=0)) != packed
+    
+    def test_store(self):
+        store = data.TxStore()
+        records = self.make_txs()
+        txs = [store.add(record) for record in records]
+        assert len(store) == 3 and all(tx.hash in store for tx in txs)
+        assert store.add(records[0]) is txs[0] and store.add_packed(txs[1].raw) is txs[1] and store.add(data.Tx(txs[2].raw)) is txs[2]
+        assert store.get(txs[0].hash) is txs[0]
+        kept = {txs[1].hash: txs[1]}
+        del txs
+        assert len(store) == 1 and store.get(list(kept)[0]) is list(kept.values())[0]
+        kept.clear()
+        assert len(store) == 0
+    
+    def test_stored_tx_type(self):
+        records = self.make_txs()
+        packed = pack.ListType(data.tx_type).pack(records)
+        for txs in [pack.ListType(data.stored_tx_type).unpack(packed), pack.ListType(data.stored_tx_type).unpack(memoryview(packed))]:
+            assert [type(tx) for tx in txs] == [data.Tx]*3 and txs == records
+            assert [data.tx_store.get(tx.hash) for tx in txs] == txs
+            assert pack.ListType(data.stored_tx_type).pack(txs) == pack.ListType(data.stored_tx_type).pack(records) == packed
+        assert pack.ListType(data.stored_tx_type).unpack(packed)[0] is pack.ListType(data.stored_tx_type).unpack(packed)[0]
+
 class UnitTests(unittest.TestCase):
 
     class btcnet(object):
@@ -6,20 +6,25 @@ import random
 
 from p2pool.bitcoin import sha256
 
+try:
+    from sha256_midstate import process as midstate_process
+except ImportError:
+    midstate_process = None
+
 class Test(unittest.TestCase):
     def test_all(self):
-        for test in ['', 'a', 'b', 'abc', 'abc'*50, 'hello world']:
+        for test in [b'', b'a', b'b', b'abc', b'abc'*50, b'hello world']:
             #print test
             #print sha256.sha256(test).hexdigest()
             #print hashlib.sha256(test).hexdigest()
             #print
             assert sha256.sha256(test).hexdigest() == hashlib.sha256(test).hexdigest().encode('ascii')
         def random_str(l):
-            return ''.join(chr(random.randrange(256)) for i in range(l))
+            return bytes(random.randrange(256) for i in range(l))
         for length in range(150):
             test = random_str(length)
             a = sha256.sha256(test).hexdigest()
-            b = hashlib.sha256(test).hexdigest()encode('ascii')
+            b = hashlib.sha256(test).hexdigest().encode('ascii')
             assert a == b
         for i in range(100):
             test = random_str(int(random.expovariate(1/100)))
@@ -33,5 +38,12 @@ class Test(unittest.TestCase):
             b = hashlib.sha256(test)
             b = b.copy()
             b.update(test2)
-            b = b.hexdigest()encode('ascii')
+            b = b.hexdigest().encode('ascii')
             assert a == b
+    
+    @unittest.skipUnless(midstate_process is not None, 'sha256_midstate extension not installed (python setup.py install in sha256_midstate/)')
+    def test_process(self):
+        for i in range(100):
+            state = bytes(random.randrange(256) for i in range(32))
+            data = bytes(random.randrange(256) for i in range(64*random.randrange(4)))
+            assert midstate_process(state, data) == sha256.py_process(state, data)
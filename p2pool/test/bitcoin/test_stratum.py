@@ -0,0 +1,141 @@
+import json
+import unittest
+
+from twisted.internet import defer
+
+from p2pool.bitcoin import data as bitcoin_data, stratum
+from p2pool.util import variable
+
+class FakeNet(object):
+    DUMB_SCRYPT_DIFF = 1
+    SANE_TARGET_RANGE = (2**200, 2**256 - 1)
+
+class FakePoWQueue(object):
+    def __init__(self):
+        self.full = False
+        self.room_waiters = []
+    
+    def is_full(self):
+        return self.full
+    
+    def wait_for_room(self):
+        d = defer.Deferred()
+        self.room_waiters.append(d)
+        return d
+
+class FakeWorkerBridge(object):
+    COINBASE_NONCE_LENGTH = 8
+    net = FakeNet()
+    share_rate = 10
+    
+    def __init__(self):
+        self.new_work_event = variable.Event()
+        self.hash_rates = {}
+        self.works = []
+        self.responses = []
+        self.pow_queue = FakePoWQueue()
+        self.verdicts = None # if set, got_response returns Deferreds from it, fired by the test
+    
+    def preprocess_request(self, username):
+        return username, username.split('.')[0], None, None
+    
+    def get_local_rates(self):
+        return self.hash_rates, {}
+    
+    def get_work(self, user, address, desired_share_target, desired_pseudoshare_target):
+        self.works.append(address)
+        x = dict(previous_block=len(self.works), coinb1=address.encode('ascii'), coinb2=b'\0'*4, merkle_link=dict(branch=[1, 2], index=0),
+            version=0x20000000, bits=bitcoin_data.FloatingInteger(0x1d00ffff), timestamp=1600000000, share_target=2**240, min_share_target=2**250)
+        def got_response(header, user, coinbase_nonce, pseudoshare_target):
+            self.responses.append((user, coinbase_nonce))
+            if self.verdicts is not None:
+                self.verdicts.append(defer.Deferred())
+                return self.verdicts[-1]
+        return x, got_response
+
+class FakeTransport(object):
+    def __init__(self, log):
+        self.log = log
+    
+        self.paused = False
+    
+    def write(self, data):
+        self.log.append((self, data))
+    
+    def pauseProducing(self):
+        assert not self.paused
+        self.paused = True
+    
+    def resumeProducing(self):
+        assert self.paused
+        self.paused = False
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.wb = FakeWorkerBridge()
+        self.notifier = stratum.StratumNotifier(self.wb)
+        self.written = []
+    
+    def connect(self, username):
+        provider = stratum.StratumRPCMiningProvider(self.wb, None, FakeTransport(self.written), self.notifier)
+        provider.username = username
+        provider.desired_pseudoshare_target = None
+        return provider
+    
+    def get_messages(self):
+        res = []
+        for transport, data in self.written:
+            res.extend((transport, line, json.loads(line)) for line in data.splitlines())
+        del self.written[:]
+        return res
+    
+    def test_notify_all(self):
+        a1, a2, b = self.connect('a.1'), self.connect('a.2'), self.connect('b')
+        self.wb.hash_rates.update({'a.1': 1, 'a.2': 3, 'b': 2})
+        self.wb.new_work_event.happened()
+        
+        assert sorted(self.wb.works) == ['a', 'b'] # one job per distinct address
+        notifies = [(transport, line, msg) for transport, line, msg in self.get_messages() if msg['method'] == 'mining.notify']
+        assert [transport for transport, line, msg in notifies] == [a2.transport, b.transport, a1.transport] # biggest first
+        assert notifies[0][1] == notifies[2][1] != notifies[1][1]
+        assert all(msg['id'] is None and msg['params'][-1] is True for transport, line, msg in notifies)
+        assert sorted(self.notifier.get_notify_latency()) == ['a.1', 'a.2', 'b']
+        
+        self.notifier.remove(b)
+        a1.username = 'c' # re-authorized under another name
+        self.wb.new_work_event.happened()
+        assert len([msg for transport, line, msg in self.get_messages() if msg['method'] == 'mining.notify']) == 2
+        assert sorted(self.notifier.get_notify_latency()) == ['a.2', 'c']
+    
+    def test_extranonce1(self):
+        a1, a2 = self.connect('a.1'), self.connect('a.2')
+        assert a1.extranonce1 != a2.extranonce1
+        extranonce2_size = self.wb.COINBASE_NONCE_LENGTH - stratum.StratumNotifier.EXTRANONCE1_LENGTH
+        
+        self.wb.new_work_event.happened()
+        jobid = self.get_messages()[1][2]['params'][0]
+        for provider in [a1, a2]:
+            provider.rpc_submit(provider.username, jobid, '00'*extranonce2_size, '00'*4, '00'*4)
+        assert self.wb.responses == [('a.1', a1.extranonce1 + b'\0'*extranonce2_size), ('a.2', a2.extranonce1 + b'\0'*extranonce2_size)]
+    
+    def test_backpressure(self):
+        a = self.connect('a')
+        self.wb.verdicts = []
+        self.wb.new_work_event.happened()
+        jobid = self.get_messages()[1][2]['params'][0]
+        def submit():
+            return a.rpc_submit(a.username, jobid, '00'*4, '00'*4, '00'*4)
+        
+        results = [submit() for i in range(a.MAX_PENDING_SUBMITS)]
+        assert a.transport.paused and a.pending_submits == a.MAX_PENDING_SUBMITS
+        self.wb.verdicts[0].callback(True)
+        assert not a.transport.paused and results[0].result is True
+        
+        # a full queue pauses every connection until it has room
+        self.wb.pow_queue.full = True
+        results.append(submit())
+        self.wb.verdicts[1].callback(True)
+        assert a.transport.paused and len(self.wb.pow_queue.room_waiters) == 1
+        self.wb.pow_queue.full = False
+        self.wb.pow_queue.room_waiters.pop().callback(None)
+        assert not a.transport.paused and a.pending_submits == a.MAX_PENDING_SUBMITS - 1
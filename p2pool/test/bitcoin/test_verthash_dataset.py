@@ -0,0 +1,67 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from p2pool.bitcoin import verthash_dataset
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'verthash.dat')
+        self.contents = os.urandom(2**16)
+        with open(self.filename, 'wb') as f:
+            f.write(self.contents)
+        self.checksum = hashlib.sha256(self.contents).hexdigest().encode('ascii')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lazy(self):
+        dataset = verthash_dataset.VerthashDataset(os.path.join(self.dir, 'missing.dat'))
+        self.assertRaises(IOError, dataset.hash, b'\0'*80)
+
+    def test_hash(self):
+        dataset = verthash_dataset.VerthashDataset(self.filename)
+        res = dataset.hash(b'\0'*80)
+        assert len(res) == 32
+        assert dataset.hash(b'\0'*80) == res
+        assert dataset.hash(b'\1'*80) != res
+
+    def test_hash_many(self):
+        dataset = verthash_dataset.VerthashDataset(self.filename)
+        headers = [bytes([i])*80 for i in range(5)]
+        digests = b''.join(dataset.hash(header) for header in headers)
+        for threads in [1, 2, 16]:
+            assert dataset.hash_many(headers, threads) == dataset.hash_many(b''.join(headers), threads) == digests
+        assert dataset.hash_many([]) == b''
+        self.assertRaises(ValueError, dataset.hash_many, b'\0'*81)
+
+    def test_checksum_sidecar(self):
+        dataset = verthash_dataset.VerthashDataset(self.filename)
+        assert dataset.checksum() == self.checksum
+        assert os.path.exists(dataset.sidecar_filename)
+
+        # a stale sidecar (different size/mtime) is ignored
+        with open(dataset.sidecar_filename, 'wb') as f:
+            f.write(b'1 2 %s\n' % (b'0'*64,))
+        assert verthash_dataset.VerthashDataset(self.filename).checksum() == self.checksum
+
+        # a matching one is trusted without rehashing
+        st = os.stat(self.filename)
+        with open(dataset.sidecar_filename, 'wb') as f:
+            f.write(b'%i %i %s\n' % (st.st_size, st.st_mtime_ns, b'0'*64))
+        assert verthash_dataset.VerthashDataset(self.filename).checksum() == b'0'*64
+
+    def test_required_checksum(self):
+        dataset = verthash_dataset.VerthashDataset(self.filename)
+        dataset.require_checksum(self.checksum)
+        dataset.hash(b'\0'*80)
+
+        dataset = verthash_dataset.VerthashDataset(self.filename)
+        dataset.require_checksum(b'0'*64)
+        self.assertRaises(ValueError, dataset.hash, b'\0'*80)
+
+    def test_shared(self):
+        assert verthash_dataset.get_dataset(self.filename) is verthash_dataset.get_dataset(os.path.join(self.dir, '.', 'verthash.dat'))
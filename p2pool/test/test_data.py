@@ -1,6 +1,12 @@
+import binascii
+import os
 import random
+import shutil
+import tempfile
 import unittest
 
+import mock
+
 from p2pool import data
 from p2pool.bitcoin import data as bitcoin_data
 from p2pool.test.util import test_forest
@@ -9,6 +15,20 @@ from p2pool.util import forest
 def random_bytes(length):
     return ''.join(chr(random.randrange(2**8)) for i in range(length))
 
+class FakeStoredShare(object):
+    def __init__(self, hash, contents, known_hashes=None):
+        self.hash = hash
+        self.contents = contents
+        self.gentx_hash, self.pow_hash = hash + 1, hash + 2
+        self.header = dict(merkle_root=hash + 3)
+        self.known_hashes = known_hashes
+    
+    def as_share(self):
+        return dict(type=data.PaddingBugfixShare.VERSION, contents=self.contents)
+
+def load_fake_share(share, net, peer_addr, known_hashes=None):
+    return FakeStoredShare(int(share['contents'][:8].hex(), 16), share['contents'], known_hashes)
+
 class Test(unittest.TestCase):
     def test_hashlink1(self):
         for i in range(100):
@@ -39,3 +59,565 @@ class Test(unittest.TestCase):
         for i in range(200):
             a = random.randrange(200)
             d(a, random.randrange(a + 1), 1000000*65535)[1]
+
+@mock.patch.object(data, 'load_share', load_fake_share)
+class ShareStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.dir, 'shares.')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def make_share(self, i):
+        contents = b'%08x' % (i,) + os.urandom(random.randrange(100, 1000))
+        return FakeStoredShare(int(contents[:8].hex(), 16), contents)
+    
+    def load(self):
+        shares, verified = {}, set()
+        ss = data.ShareStore(self.prefix, None, lambda share: shares.__setitem__(share.hash, share), verified.add)
+        return ss, shares, verified
+    
+    def test_roundtrip(self):
+        ss, shares, verified = self.load()
+        assert not shares and not verified
+        stored = [self.make_share(i) for i in range(300)]
+        for share in stored:
+            ss.add_share(share)
+            ss.add_share(share)
+        for share in stored[::3]:
+            ss.add_verified_hash(share.hash)
+        
+        ss, shares, verified = self.load()
+        assert sorted(shares) == sorted(share.hash for share in stored)
+        assert all(shares[share.hash].contents == share.contents for share in stored)
+        assert verified == set(share.hash for share in stored[::3])
+        for share in stored:
+            if share.hash in verified:
+                assert shares[share.hash].known_hashes == (share.hash + 1, share.hash + 3, share.hash + 2, share.hash)
+            else:
+                assert shares[share.hash].known_hashes is None
+    
+    def test_forget(self):
+        ss, shares, verified = self.load()
+        ss.max_segment_size = 10000
+        stored = [self.make_share(i) for i in range(300)]
+        for share in stored:
+            ss.add_share(share)
+            ss.add_verified_hash(share.hash)
+        segments_before = len(ss.get_segment_filenames_and_next()[0])
+        for share in stored[:150]:
+            ss.forget_share(share.hash)
+            ss.forget_verified_share(share.hash)
+        assert len(ss.get_segment_filenames_and_next()[0]) < segments_before
+        
+        ss, shares, verified = self.load()
+        assert set(share.hash for share in stored[150:]) <= set(shares)
+        assert set(shares) == verified
+        assert len(ss.index) == len(shares)
+    
+    def test_migrate(self):
+        stored = [self.make_share(i) for i in range(50)]
+        with open(self.prefix + '0', 'wb') as f:
+            for share in stored:
+                f.write(b'%i %s\n' % (5, binascii.hexlify(data.share_type.pack(share.as_share()))))
+            for share in stored[:10]:
+                f.write(b'%i %x\n' % (2, share.hash))
+        
+        ss, shares, verified = self.load()
+        assert sorted(shares) == sorted(share.hash for share in stored)
+        assert verified == set(share.hash for share in stored[:10])
+        assert not ss.get_filenames_and_next()[0]
+        
+        ss, shares, verified = self.load()
+        assert sorted(shares) == sorted(share.hash for share in stored)
+        assert verified == set(share.hash for share in stored[:10])
+
+class FakeHydratedShare(object):
+    def __init__(self, hash, previous_hash, corrupt=False):
+        self.hash, self.previous_hash = hash, previous_hash
+        self.target = self.max_target = 2**240
+        self.peer_addr = None
+        self.hydrated = True
+        self.corrupt = corrupt
+    
+    def reverify(self):
+        if self.corrupt:
+            raise ValueError('bad hash link')
+        self.hydrated = False
+        return True
+
+class ReverifyTest(unittest.TestCase):
+    def test_corrupt_stored_share(self):
+        from twisted.internet import defer
+        from p2pool import networks, node
+        n = node.Node(None, None, [], [], networks.nets['vertcoin'])
+        # a chain 0-5 where 3 is corrupt, and a fork 6-7 off 1 checked after it
+        shares = [FakeHydratedShare(i, i - 1 if i else None, corrupt=i == 3) for i in range(6)] + [FakeHydratedShare(6, 1), FakeHydratedShare(7, 6)]
+        for share in shares:
+            n.tracker.add(share)
+            n.tracker.verified.add(share)
+        n.best_share_var.set(5)
+        
+        best_share_valid = []
+        def set_best_share():
+            n.best_share_var.set(max(n.tracker.verified.heads, key=n.tracker.verified.get_height))
+        n.set_best_share = set_best_share
+        def sleep(t):
+            best_share_valid.append(n.best_share_var.value in n.tracker.items)
+            return defer.succeed(None)
+        
+        with mock.patch.object(node.deferral, 'sleep', sleep):
+            d = n.reverify_hydrated_shares(batch_size=2)
+        assert d.called
+        assert sorted(n.tracker.items) == [0, 1, 2, 6, 7]
+        assert not any(share.hydrated for share in n.tracker.items.values())
+        assert all(best_share_valid) and n.best_share_var.value == 7
+
+class FakePrunerNet(object):
+    CHAIN_LENGTH = 3
+
+def old_clean_tracker(tracker, best_heads, now):
+    # clean_tracker's scans before TrackerPruner, to compare against
+    if best_heads:
+        while True:
+            to_remove = set()
+            for share_hash, tail in tracker.heads.items():
+                if share_hash in best_heads or tracker.items[share_hash].time_seen > now - 300:
+                    continue
+                if share_hash not in tracker.verified.items and max(tracker.items[h].time_seen for h in tracker.reverse.get(tail)) > now - 120:
+                    continue
+                to_remove.add(share_hash)
+            if not to_remove:
+                break
+            for share_hash in to_remove:
+                if share_hash in tracker.verified.items:
+                    tracker.verified.remove(share_hash)
+                tracker.remove(share_hash)
+    while True:
+        to_remove = set()
+        for tail, heads in tracker.tails.items():
+            if min(tracker.get_height(head) for head in heads) >= 2*tracker.net.CHAIN_LENGTH + 10:
+                to_remove.update(tracker.reverse.get(tail, set()))
+        if not to_remove:
+            break
+        for share_hash in to_remove:
+            if share_hash in tracker.verified.items:
+                tracker.verified.remove(share_hash)
+            tracker.remove(share_hash)
+
+class TrackerPrunerTest(unittest.TestCase):
+    def make_trackers(self, rng):
+        from p2pool import node
+        shape = data.OkayTracker(FakePrunerNet())
+        shares = []
+        roots = []
+        for i in range(rng.choice([20, 50, 100])):
+            # mostly extending the longest chain or a random head, sometimes branching off
+            # anywhere, starting a separate chain, or forking right at the bottom of one
+            r = rng.random()
+            if not shares or r < .03:
+                previous_hash = 1000 + i if shares else None
+                roots.append(previous_hash)
+            elif r < .06:
+                previous_hash = rng.choice(roots)
+            elif r < .15:
+                previous_hash = rng.choice(shares)[0]
+            elif r < .4:
+                previous_hash = rng.choice(sorted(shape.heads))
+            else:
+                previous_hash = max(shape.heads, key=shape.get_height)
+            shape.add(FakeThinkShare(i, previous_hash))
+            shares.append((i, previous_hash, 1000 - rng.choice([0, 100, 200, 250, 400, 600]) + i, rng.random() < .8))
+        
+        old, new = data.OkayTracker(FakePrunerNet()), data.OkayTracker(FakePrunerNet())
+        pruner = node.TrackerPruner(new) if rng.random() < .5 else None # follows the adds, or starts from the result
+        if rng.random() < .5:
+            rng.shuffle(shares) # so shares also arrive under and between others
+        for tracker in [old, new]:
+            for hash, previous_hash, time_seen, verified in shares:
+                tracker.add(FakeThinkShare(hash, previous_hash, time_seen=time_seen))
+                if verified:
+                    tracker.verified.add(tracker.items[hash])
+        return old, new, pruner or node.TrackerPruner(new)
+    
+    def check_pruner(self, pruner):
+        tracker = pruner.tracker
+        assert set(pruner._tail_heads) == set(tracker.tails) and set(pruner._depth) == set(tracker.items)
+        for share_hash, share in tracker.items.items():
+            if share.previous_hash in tracker.items:
+                assert pruner._depth[share_hash] == pruner._depth[share.previous_hash] + 1
+        for tail, heads in tracker.tails.items():
+            assert pruner._get_min_height(tail) == min(tracker.get_height(head) for head in heads)
+    
+    def test_matches_scans(self):
+        rng = random.Random(0)
+        for i in range(200):
+            old, new, pruner = self.make_trackers(random.Random(i))
+            self.check_pruner(pruner)
+            for now in [1000, 1100, 1300]:
+                best_heads = set(rng.sample(sorted(old.verified.heads), min(len(old.verified.heads), rng.choice([0, 1, 5]))))
+                before = len(old.items)
+                old_clean_tracker(old, best_heads, now)
+                pruner.prune(best_heads, now)
+                assert sorted(new.items) == sorted(old.items) and sorted(new.verified.items) == sorted(old.verified.items)
+                assert pruner.last_pass['heads'] + pruner.last_pass['tails'] == before - len(old.items)
+                self.check_pruner(pruner)
+
+    def test_fork_at_bottom(self):
+        from p2pool import node
+        # 0-4, then branches 5-29 and 30-59 on 4: the bottom is dropped past the fork,
+        # after which each branch is trimmed to its own 15 shares
+        trackers = [data.OkayTracker(FakePrunerNet()) for i in range(2)]
+        for tracker in trackers:
+            for hash, previous_hash in [(0, None)] + [(i, i - 1) for i in range(1, 60) if i not in (5, 30)] + [(5, 4), (30, 4)]:
+                tracker.add(FakeThinkShare(hash, previous_hash, time_seen=1000))
+        old, new = trackers
+        old_clean_tracker(old, set(), 1000)
+        pruner = node.TrackerPruner(new)
+        pruner.prune([], 1000)
+        assert sorted(new.items) == sorted(old.items)
+        assert sorted(new.tails) == [14, 44] and pruner.last_pass == dict(heads=0, tails=30, duration=pruner.last_pass['duration'])
+
+class FakeWeightsShare(object):
+    def __init__(self, hash, previous_hash, rng):
+        self.hash, self.previous_hash = hash, previous_hash
+        self.target = rng.choice([2**256//rng.randrange(1, 2**20), 2**256//rng.randrange(2**20, 2**30)])
+        self.address = rng.choice([b'a', b'b', b'c', b'd', b'e'])
+        self.share_data = dict(donation=rng.choice([0, 0, 1, 50, 65535, rng.randrange(65536)]))
+
+class WeightsAccumulatorTest(unittest.TestCase):
+    def test_matches_skiplist(self):
+        rng = random.Random(0)
+        for ii in range(10):
+            tracker = forest.Tracker()
+            skiplist, accumulator = data.WeightsSkipList(tracker), data.WeightsAccumulator(tracker)
+            hashes = [None]
+            for i in range(500):
+                # mostly a growing chain, with some forks off recent shares
+                previous_hash = hashes[-1] if rng.random() < .9 or len(hashes) < 3 else rng.choice(hashes[-20:])
+                share = FakeWeightsShare(i, previous_hash, rng)
+                tracker.add(share)
+                hashes.append(share.hash)
+                
+                for j in range(rng.choice([1, 1, 3])):
+                    start = share.hash if rng.random() < .5 else rng.choice(hashes[1:])
+                    height = tracker.get_height(start)
+                    max_shares = rng.choice([height, min(height, 100), rng.randrange(height + 1)])
+                    desired_weight = 65535*rng.choice([2**256, rng.randrange(2**20, 2**35), rng.randrange(1, 2**22)])
+                    assert accumulator(start, max_shares, desired_weight) == skiplist(start, max_shares, desired_weight)
+
+class FakeChainShare(object):
+    def __init__(self, hash, previous_share, address):
+        self.hash, self.previous_hash = hash, previous_share.hash if previous_share is not None else None
+        self.target = self.max_target = 2**240
+        self.address = address
+        self.share_data = dict(previous_share_hash=self.previous_hash, donation=random.randrange(2**15))
+        self.timestamp = 1600000000 + 15*hash
+        self.absheight = hash + 1
+        self.abswork = (previous_share.abswork if previous_share is not None else 0) + bitcoin_data.target_to_average_attempts(self.target)
+
+class TransactionTemplateTest(unittest.TestCase):
+    def test_template_matches_generate_transaction(self):
+        from p2pool import networks
+        net = networks.nets['vertcoin']
+        addresses = [bitcoin_data.pubkey_hash_to_address(random.getrandbits(160), net.PARENT.ADDRESS_VERSION, -1, net.PARENT) for i in range(8)]
+        # a chain paying the first 5 addresses in turn, shorter than TARGET_LOOKBEHIND so the share target stays at MAX_TARGET
+        tracker = data.OkayTracker(net)
+        share = None
+        for i in range(60):
+            share = FakeChainShare(i, share, addresses[i % 5])
+            tracker.add(share)
+        txs = [dict(version=1, tx_ins=[dict(previous_output=dict(hash=random.getrandbits(256), index=0), script=b'\x00'*100, sequence=None)],
+            tx_outs=[dict(value=random.getrandbits(40), script=b'\x00'*25)], lock_time=0) for i in range(50)]
+        known_txs = dict((bitcoin_data.get_txid(tx), tx) for tx in txs)
+        hashes_and_fees = [(tx_hash, random.randrange(10**6)) for tx_hash in known_txs]
+        for previous_share_hash in [None, share.hash]:
+            template = data.PaddingBugfixShare.generate_transaction_template(tracker, previous_share_hash, 2**240, 25*10**8, hashes_and_fees, net, known_txs)
+            if previous_share_hash is not None:
+                assert len(template['ranked_payees']) == 5
+            # finders who already have weight (moved within ranked_payees) and new ones (inserted)
+            for address in addresses:
+                kwargs = dict(
+                    tracker=tracker,
+                    share_data=dict(
+                        previous_share_hash=previous_share_hash,
+                        coinbase=b'\x01\x02',
+                        nonce=random.getrandbits(32),
+                        address=address,
+                        subsidy=25*10**8,
+                        donation=random.randrange(2**16),
+                        stale_info=None,
+                        desired_version=35,
+                    ),
+                    block_target=2**240,
+                    desired_timestamp=1600001000,
+                    desired_target=2**250,
+                    ref_merkle_link=dict(branch=[], index=0),
+                    net=net,
+                )
+                res = data.PaddingBugfixShare.generate_transaction(desired_other_transaction_hashes_and_fees=hashes_and_fees, known_txs=known_txs, **kwargs)
+                res2 = data.PaddingBugfixShare.generate_transaction(desired_other_transaction_hashes_and_fees=None, template=template, **kwargs)
+                assert res[0] == res2[0] and res[1] == res2[1] and res[2] == res2[2]
+                assert sum(tx_out['value'] for tx_out in res[1]['tx_outs']) == 25*10**8
+
+def generate_share(net, address):
+    '''a real share without parents, paying to address, and its header'''
+    txs = [dict(version=1, tx_ins=[dict(previous_output=dict(hash=random.getrandbits(256), index=0), script=b'\x00'*100, sequence=None)],
+        tx_outs=[dict(value=random.getrandbits(40), script=b'\x00'*25)], lock_time=0) for i in range(20)]
+    known_txs = dict((bitcoin_data.get_txid(tx), tx) for tx in txs)
+    share_info, gentx, other_transaction_hashes, get_share = data.PaddingBugfixShare.generate_transaction(
+        tracker=data.OkayTracker(net),
+        share_data=dict(previous_share_hash=None, coinbase=b'\x01\x02', nonce=random.getrandbits(32), address=address, subsidy=25*10**8, donation=0, stale_info=None, desired_version=35),
+        block_target=2**240,
+        desired_timestamp=1600001000,
+        desired_target=2**250,
+        ref_merkle_link=dict(branch=[], index=0),
+        desired_other_transaction_hashes_and_fees=[(tx_hash, 0) for tx_hash in known_txs],
+        net=net,
+        known_txs=known_txs,
+    )
+    header = dict(version=0x20000000, previous_block=random.getrandbits(256), timestamp=1600001000, bits=share_info['bits'], nonce=0,
+        merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.get_txid(gentx), share_info['segwit_data']['txid_merkle_link']))
+    with mock.patch.object(net.PARENT, 'POW_FUNC', lambda header: 0):
+        return get_share(header), header
+
+def generate_child_share(share):
+    '''a share like share, built on it, with made-up hashes'''
+    share_info = dict(share.share_info, share_data=dict(share.share_data, previous_share_hash=share.hash))
+    return share.__class__(share.net, None, dict(share.contents, share_info=share_info),
+        known_hashes=(random.getrandbits(256), random.getrandbits(256), 0, random.getrandbits(256)))
+
+class ShareLayoutTest(unittest.TestCase):
+    def test_compact_share(self):
+        from p2pool import networks
+        from p2pool.util import pack
+        net = networks.nets['vertcoin']
+        address = bitcoin_data.pubkey_hash_to_address(random.getrandbits(160), net.PARENT.ADDRESS_VERSION, -1, net.PARENT)
+        share, header = generate_share(net, address)
+        with mock.patch.object(net.PARENT, 'POW_FUNC', lambda header: 0):
+            shares = [data.load_share(share.as_share(), net, None) for i in range(2)]
+        
+        for s in [share] + shares:
+            assert not hasattr(s, '__dict__')
+            assert s.header == header and s.header_hash == s.hash == share.hash
+            assert s.new_script == bitcoin_data.address_to_script2(address, net.PARENT)
+            assert s.as_share() == share.as_share()
+        # what's unpacked is kept compact, and shared between shares where it's the same
+        assert isinstance(shares[0].merkle_link['branch'], pack.PackedIntList) and shares[0].merkle_link == share.merkle_link
+        assert shares[0].address is shares[1].address is shares[0].share_data['address']
+        assert shares[0].share_info['bits'] is shares[1].share_info['bits']
+    
+    def test_as_share_cached(self):
+        from p2pool import networks
+        net = networks.nets['vertcoin']
+        share, header = generate_share(net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')
+        raw_share = share.as_share()
+        assert share.as_share()['contents'] is raw_share['contents'] # packed once
+        raw_share = dict(raw_share, contents=bytes(bytearray(raw_share['contents'])))
+        with mock.patch.object(net.PARENT, 'POW_FUNC', lambda header: 0):
+            loaded = data.load_share(raw_share, net, None)
+        assert loaded.as_share()['contents'] is raw_share['contents'] # not packed at all
+
+class ShareContentsIndexTest(unittest.TestCase):
+    def test_get(self):
+        from p2pool import networks
+        net = networks.nets['vertcoin']
+        tracker = data.OkayTracker(net)
+        shares = [generate_share(net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')[0] for i in range(3)]
+        tracker.add(shares[0])
+        index = data.ShareContentsIndex(tracker)
+        tracker.add(shares[1])
+        for share in shares[:2]:
+            raw_share = share.as_share()
+            assert index.get(dict(raw_share, contents=bytes(bytearray(raw_share['contents'])))) == share.hash
+            assert index.get(dict(raw_share, type=34)) is None
+        assert index.get(shares[2].as_share()) is None
+        tracker.remove(shares[0].hash)
+        assert index.get(shares[0].as_share()) is None and index.get(shares[1].as_share()) == shares[1].hash
+
+class CompactShareTest(unittest.TestCase):
+    def test_round_trip(self):
+        from p2pool import networks
+        net = networks.nets['vertcoin']
+        share = generate_share(net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')[0]
+        child = generate_child_share(share)
+        shares = {share.hash: share}
+        
+        compact = data.get_compact_share(share, None)
+        assert compact['type'] == share.VERSION and compact['hash'] == share.hash
+        assert compact['omitted'] == data.COMPACT_MERKLE_LINK_IS_TXID_LINK
+        assert len(compact['contents']) < len(share.as_share()['contents'])
+        assert data.decompact_share(compact, net, {}.get) == share.as_share()
+        
+        compact = data.get_compact_share(child, share)
+        assert compact['omitted'] == data.COMPACT_MERKLE_LINK_IS_TXID_LINK | data.COMPACT_TXID_LINK_FROM_PARENT
+        assert len(compact['contents']) == len(child.as_share()['contents']) - 2*32*len(child.merkle_link['branch'])
+        assert data.decompact_share(compact, net, shares.get) == child.as_share()
+        assert data.decompact_share(compact, net, {}.get) is None # parent needed
+        
+        # packing it makes no difference
+        packed = data.compact_share_type.pack(compact)
+        assert data.decompact_share(data.compact_share_type.unpack(packed), net, shares.get) == child.as_share()
+    
+    def test_bad(self):
+        from p2pool import networks
+        net = networks.nets['vertcoin']
+        share = generate_share(net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')[0]
+        compact = data.get_compact_share(share, None)
+        self.assertRaises(ValueError, data.decompact_share, dict(compact, omitted=8), net, {}.get)
+        self.assertRaises(ValueError, data.decompact_share, dict(compact, type=17), net, {}.get)
+        self.assertRaises(ValueError, data.decompact_share, dict(compact, type=1000), net, {}.get)
+
+class FakeThinkShare(object):
+    VERSION = 35
+    
+    def __init__(self, hash, previous_hash, target=2**240, time_seen=0):
+        self.hash, self.previous_hash = hash, previous_hash
+        self.target = self.max_target = target
+        self.time_seen = time_seen
+        self.timestamp = 1600000000
+        self.peer_addr = None
+        self.naughty = 0
+        self.punish = 0
+        self.punish_calls = 0
+    
+    def should_punish_reason(self, previous_block, bits, tracker, known_txs):
+        self.punish_calls += 1
+        return (self.punish, 'testing' if self.punish else None)
+
+class ThinkTest(unittest.TestCase):
+    def setUp(self):
+        from p2pool import networks
+        self.tracker = data.OkayTracker(networks.nets['vertcoin'])
+        self.add(FakeThinkShare(0, None))
+        for i in range(1, 20):
+            self.add(FakeThinkShare(i, i - 1))
+        # competing heads: 20 and 24 (seen later) on 19, 22 on 21 (twice the work) on 18, 23 on 17
+        for hash, previous_hash, target, time_seen in [(20, 19, 2**240, 1), (21, 18, 2**239, 1), (22, 21, 2**240, 1), (23, 17, 2**240, 1), (24, 19, 2**240, 2)]:
+            self.add(FakeThinkShare(hash, previous_hash, target, time_seen))
+    
+    def add(self, share):
+        self.tracker.add(share)
+        self.tracker.verified.add(share)
+    
+    def think(self, previous_block=1):
+        return self.tracker.think(lambda block_hash: 0, lambda block_hash: 0, previous_block, None, {}, None)
+    
+    def check_scores(self, decorated_heads):
+        # the head score is the work of its verified ancestor 5 back, less a share's worth if it's punished
+        verified = self.tracker.verified
+        expected = sorted(((
+            verified.get_work(verified.get_nth_parent_hash(h, min(5, verified.get_height(h)))) -
+                min(self.tracker.items[h].punish, 1) * bitcoin_data.target_to_average_attempts(self.tracker.items[h].target),
+            -self.tracker.items[h].punish,
+            -self.tracker.items[h].time_seen,
+        ), h) for h in verified.heads)
+        assert decorated_heads == expected, (decorated_heads, expected)
+    
+    def test_best(self):
+        best, desired, decorated_heads, bad_peer_addresses, punish_aggressively = self.think()
+        self.check_scores(decorated_heads)
+        # 20, 22 and 24 have the same work 5 back; 24 was seen later, and the rest is down to hash order
+        assert best == 22 and not desired and not bad_peer_addresses and not punish_aggressively
+        
+        self.tracker.items[22].punish = 1
+        self.tracker.head_scores._punish.clear()
+        best, desired, decorated_heads, bad_peer_addresses, punish_aggressively = self.think()
+        self.check_scores(decorated_heads)
+        assert best == 20 # 22 is punished
+        
+        self.add(FakeThinkShare(25, 23, 2**230))
+        best, desired, decorated_heads, bad_peer_addresses, punish_aggressively = self.think()
+        self.check_scores(decorated_heads)
+        assert best == 20 # 25 is a new head, but its work isn't counted until it's 5 deep
+        for i in range(26, 30):
+            self.add(FakeThinkShare(i, i - 1))
+        best, desired, decorated_heads, bad_peer_addresses, punish_aggressively = self.think()
+        self.check_scores(decorated_heads)
+        assert best == 29 # and now 23's chain is the longest
+    
+    def test_punish_cache(self):
+        self.think()
+        calls = dict((h, self.tracker.items[h].punish_calls) for h in self.tracker.verified.heads)
+        assert all(calls.values())
+        self.think()
+        assert all(self.tracker.items[h].punish_calls == calls[h] for h in calls) # same block, verdicts reused
+        self.think(previous_block=2)
+        assert all(self.tracker.items[h].punish_calls > calls[h] for h in calls)
+        
+        self.tracker.verified.remove(24)
+        self.tracker.remove(24)
+        assert 24 not in self.tracker.head_scores._punish
+        best, desired, decorated_heads, bad_peer_addresses, punish_aggressively = self.think(previous_block=2)
+        self.check_scores(decorated_heads)
+
+class FakeStatsShare(object):
+    def __init__(self, hash, previous_share, rng):
+        self.hash, self.previous_hash = hash, previous_share.hash if previous_share is not None else None
+        self.VERSION = rng.choice([33, 35, 35, 35])
+        self.target = self.max_target = 2**256//rng.randrange(1, 2**20)
+        self.timestamp = previous_share.timestamp + rng.randrange(1, 30) if previous_share is not None else 1600000000
+        self.desired_version = rng.choice([35, 35, 36])
+        self.share_data = dict(stale_info=rng.choice([None, None, None, 'orphan', 'doa', 'doa', 'unk7']))
+        if self.VERSION >= 34:
+            self.share_data['address'] = rng.choice([b'a', b'b', b'c'])
+        else:
+            self.share_data['pubkey_hash'] = rng.choice([1, 2])
+
+def walk_stale_counts(tracker, share_hash, lookbehind):
+    res = {}
+    for share in tracker.get_chain(share_hash, lookbehind - 1):
+        res['good'] = res.get('good', 0) + bitcoin_data.target_to_average_attempts(share.target)
+        s = share.share_data['stale_info']
+        if s is not None:
+            res[s] = res.get(s, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    return res
+
+def walk_user_stale_props(tracker, share_hash, lookbehind, net):
+    res = {}
+    for share in tracker.get_chain(share_hash, lookbehind - 1):
+        if share.VERSION < 34:
+            key = bitcoin_data.pubkey_hash_to_address(share.share_data['pubkey_hash'], net.ADDRESS_VERSION, -1, net)
+        else:
+            key = share.share_data['address']
+        stale, total = res.get(key, (0, 0))
+        total += 1
+        if share.share_data['stale_info'] is not None:
+            stale += 1
+            total += 1
+        res[key] = stale, total
+    return dict((key, stale/total) for key, (stale, total) in res.items())
+
+class ChainStatsTest(unittest.TestCase):
+    def test_matches_walks(self):
+        from p2pool import networks
+        net = networks.nets['vertcoin']
+        rng = random.Random(0)
+        tracker = data.OkayTracker(net)
+        shares = [None]
+        for i in range(600):
+            # mostly a growing chain, with some forks off recent shares
+            previous_share = shares[-1] if rng.random() < .9 or len(shares) < 3 else rng.choice(shares[-20:])
+            share = FakeStatsShare(i, previous_share, rng)
+            tracker.add(share)
+            shares.append(share)
+            if i == 300: # the bottom goes, as clean_tracker would drop it
+                for share in shares[1:51]:
+                    tracker.remove(share.hash)
+                shares = [None] + shares[51:]
+            
+            for j in range(rng.choice([1, 1, 3])):
+                start = share.hash if rng.random() < .5 else rng.choice(shares[1:]).hash
+                height = tracker.get_height(start)
+                lookbehind = rng.choice([height, min(height, 100), rng.randrange(height + 1)])
+                stales = sum(1 for s in tracker.get_chain(start, lookbehind) if s.share_data['stale_info'] is not None)
+                if lookbehind:
+                    assert data.get_average_stale_prop(tracker, start, lookbehind) == stales/(lookbehind + stales)
+                assert data.get_stale_counts(tracker, start, lookbehind) == walk_stale_counts(tracker, start, lookbehind)
+                if lookbehind > 1:
+                    assert data.get_user_stale_props(tracker, start, lookbehind, net.PARENT) == walk_user_stale_props(tracker, start, lookbehind, net.PARENT)
+                versions = {}
+                for s in tracker.get_chain(start, lookbehind):
+                    versions[s.desired_version] = versions.get(s.desired_version, 0) + bitcoin_data.target_to_average_attempts(s.target)
+                assert data.get_desired_version_counts(tracker, start, lookbehind) == versions
@@ -1,11 +1,15 @@
 import random
 
+import mock
+
 from twisted.internet import defer, endpoints, protocol, reactor
 from twisted.trial import unittest
 
-from p2pool import networks, p2p
+from p2pool import data as p2pool_data, networks, node, p2p
 from p2pool.bitcoin import data as bitcoin_data
-from p2pool.util import deferral
+from p2pool.test.test_data import generate_child_share, generate_share
+from p2pool.test.util.test_forest import FakeShare
+from p2pool.util import deferral, forest, p2protocol, variable
 
 
 class Test(unittest.TestCase):
@@ -77,3 +81,247 @@ class Test(unittest.TestCase):
             yield n.stop()
         finally:
             p2p.Protocol.max_remembered_txs_size //= 10
+
+class FakeP2PNode(object):
+    def __init__(self, net):
+        self.net = net
+        self.traffic_happened = variable.Event()
+        self.shares = {}
+        self.requested = []
+    
+    def get_share(self, share_hash):
+        return self.shares.get(share_hash)
+    
+    def handle_share_hashes(self, hashes, peer):
+        self.requested.extend(hashes)
+
+class FakeTransport(object):
+    def __init__(self):
+        self.written = []
+    
+    def write(self, data):
+        self.written.append(data)
+
+def unframe(prefix, data, command='shares'):
+    assert data.startswith(prefix)
+    command2, length, checksum = p2protocol.Protocol._header.unpack_from(data, len(prefix))
+    payload = data[len(prefix) + p2protocol.Protocol._header.size:]
+    assert command2.rstrip(b'\0') == command.encode('ascii') and length == len(payload) and bitcoin_data.hash256d(payload)[:4] == checksum
+    return getattr(p2p.Protocol, 'message_' + command).unpack(payload)['shares']
+
+class ShareBroadcastTest(unittest.TestCase):
+    def test_frames(self):
+        net = networks.nets['vertcoin']
+        shares = [generate_share(net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')[0] for i in range(4)]
+        broadcast = p2p.ShareBroadcast(shares)
+        
+        frames = broadcast.get_frames(shares, net.PREFIX, 32000000)
+        assert frames == [p2protocol.frame_message(net.PREFIX, 'shares', p2p.Protocol.message_shares.pack(dict(shares=[share.as_share() for share in shares])))]
+        assert broadcast.get_frames(list(shares), net.PREFIX, 32000000)[0] is frames[0] # framed once
+        assert unframe(net.PREFIX, broadcast.get_frames(shares[1:], net.PREFIX, 32000000)[0]) == [share.as_share() for share in shares[1:]]
+        
+        # too long for one message, so split in halves
+        frames = broadcast.get_frames(shares, net.PREFIX, len(frames[0])//2)
+        assert [unframe(net.PREFIX, frame) for frame in frames] == [[share.as_share() for share in shares[:2]], [share.as_share() for share in shares[2:]]]
+        self.assertRaises(p2protocol.TooLong, broadcast.get_frames, shares[:1], net.PREFIX, 10)
+    
+    def test_send_shares(self):
+        net = networks.nets['vertcoin']
+        shares = [generate_share(net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')[0] for i in range(2)]
+        broadcast = p2p.ShareBroadcast(shares)
+        peers = []
+        for i in range(3):
+            peer = p2p.Protocol(FakeP2PNode(net), False)
+            peer.transport = FakeTransport()
+            peer.other_version = 3501
+            peer.sendShares(shares, None, {}, broadcast=broadcast)
+            peers.append(peer)
+        alone = p2p.Protocol(FakeP2PNode(net), False)
+        alone.transport = FakeTransport()
+        alone.other_version = 3501
+        alone.sendShares(shares, None, {})
+        assert all(len(peer.transport.written) == 1 and peer.transport.written[0] is peers[0].transport.written[0] for peer in peers)
+        assert alone.transport.written == peers[0].transport.written
+
+class CompactSharesTest(unittest.TestCase):
+    def test_send(self):
+        net = networks.nets['vertcoin']
+        share = generate_share(net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')[0]
+        child = generate_child_share(share)
+        tracker = p2pool_data.OkayTracker(net)
+        tracker.add(share)
+        tracker.add(child)
+        broadcast = p2p.ShareBroadcast([child, share], tracker)
+        peers = {}
+        for version in [3501, 3502]:
+            peer = peers[version] = p2p.Protocol(FakeP2PNode(net), False)
+            peer.transport = FakeTransport()
+            peer.other_version = version
+            peer.sendShares([child, share], tracker, {}, broadcast=broadcast)
+        
+        assert unframe(net.PREFIX, peers[3501].transport.written[0]) == [child.as_share(), share.as_share()] # old peers get whole shares
+        compact = unframe(net.PREFIX, peers[3502].transport.written[0], 'cmpctshares')
+        assert compact == [p2pool_data.get_compact_share(child, share), p2pool_data.get_compact_share(share, None)]
+        assert len(peers[3502].transport.written[0]) < len(peers[3501].transport.written[0])
+    
+    def test_receive(self):
+        net = networks.nets['vertcoin']
+        share = generate_share(net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')[0]
+        missing = generate_share(net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')[0]
+        child, orphan = generate_child_share(share), generate_child_share(missing)
+        peer = p2p.Protocol(FakeP2PNode(net), False)
+        peer.node.shares[share.hash] = share
+        received = []
+        peer.handle_shares = received.extend
+        
+        peer.handle_cmpctshares(shares=[p2pool_data.get_compact_share(x, parent) for x, parent in [(share, None), (child, share), (orphan, missing)]])
+        assert received == [child.as_share()] # share is known already
+        assert peer.node.requested == [orphan.hash] # built on a share we don't have, so it's fetched whole
+        
+        self.assertRaises(p2p.PeerMisbehavingError, peer.handle_cmpctshares, shares=[dict(p2pool_data.get_compact_share(child, share), contents=b'x')])
+
+class FakeSyncPeer(object):
+    def __init__(self, i, chain, version=p2p.Protocol.VERSION):
+        self.addr = '127.0.0.%i' % (i,), 9346
+        self.chain = chain
+        self.other_version = version
+        self.requests = [] # (kind, args, deferred), answered by answer()
+        self.has_shares = True
+    
+    def get_shares(self, hashes, parents, stops):
+        d = defer.Deferred()
+        self.requests.append(('shares', (hashes, parents, stops), d))
+        return d
+    
+    def get_share_hashes(self, share_hash, count, stops):
+        d = defer.Deferred()
+        self.requests.append(('hashes', (share_hash, count, stops), d))
+        return d
+    
+    def badPeerHappened(self, bantime=3600):
+        pass
+    
+    def answer(self):
+        requests, self.requests = self.requests, []
+        for kind, args, d in requests:
+            share_hash, count, stops = args[0][0] if kind == 'shares' else args[0], args[1] + 1 if kind == 'shares' else args[1], set(args[2])
+            res = []
+            if (self.has_shares or kind == 'hashes') and share_hash in self.chain.items:
+                for share in self.chain.get_chain(share_hash, min(count, self.chain.get_height(share_hash))):
+                    if share.hash in stops:
+                        break
+                    res.append(share if kind == 'shares' else share.hash)
+            d.callback(res)
+        return requests
+
+class FakeSyncNode(object):
+    def __init__(self, chain_length, peers):
+        self.net = FakeShare(CHAIN_LENGTH=chain_length)
+        self.tracker = forest.Tracker()
+        self.desired_var = variable.Variable([])
+        self.peers = dict(enumerate(peers))
+        self.node = self
+    
+    def handle_shares(self, shares, peer):
+        for share, new_txs in shares:
+            if share.hash not in self.tracker.items:
+                self.tracker.add(share)
+        tip = max(self.tracker.heads, key=self.tracker.get_height)
+        height, last = self.tracker.get_height_and_last(tip)
+        self.desired_var.set([(None, last)] if height < 2*self.net.CHAIN_LENGTH + 10 and last is not None else [])
+
+class ShareDownloaderTest(unittest.TestCase):
+    def make(self, peer_versions, chain_length=100):
+        chain = forest.Tracker(FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None) for i in range(1000))
+        peers = [FakeSyncPeer(i, chain, version) for i, version in enumerate(peer_versions)]
+        p2p_node = FakeSyncNode(chain_length, peers)
+        p2p_node.handle_shares([(chain.items[999], None)], None) # as if it came with the peer's best share hash
+        return p2p_node, node.ShareDownloader(p2p_node), peers
+    
+    def test_parallel(self):
+        p2p_node, downloader, peers = self.make([3503]*3)
+        downloader._think()
+        # one peer is asked for the hashes of the chain, 209 of them below 999
+        assert sum(len(peer.requests) for peer in peers) == 1
+        hashes_peer, = [peer for peer in peers if peer.requests]
+        assert hashes_peer.answer()[0][:2] == ('hashes', (998, 209, [999]))
+        
+        # then the chain is requested a range at a time from all of them at once
+        requests = [(args[0][0], args[1]) for peer in peers for kind, args, d in peer.requests]
+        assert sorted(requests) == [(798, 8), (898, 99), (998, 99)]
+        assert all(len(peer.requests) == 1 for peer in peers)
+        for peer in peers:
+            peer.answer()
+        assert p2p_node.tracker.get_height(999) == 210 and not p2p_node.desired_var.value
+        assert not downloader.queue and not downloader.pending and all(rate > 0 for rate in downloader.rates.values())
+    
+    def test_retry(self):
+        p2p_node, downloader, peers = self.make([3503]*2)
+        peers[0].has_shares = False
+        downloader._think()
+        # either peer may be asked for the hashes, and then the three ranges go two to one peer, one to the other
+        hashes_peer, = [peer for peer in peers if peer.requests]
+        assert hashes_peer.answer()[0][0] == 'hashes'
+        assert sorted(len(peer.requests) for peer in peers) == [1, 2]
+        while any(peer.requests for peer in peers):
+            for peer in peers:
+                peer.answer()
+        # what peers[0] didn't have came from peers[1]
+        assert p2p_node.tracker.get_height(999) == 210
+        assert downloader.rates[peers[1]] > 0 and downloader.rates.get(peers[0], 0) == 0
+        
+        # a range nobody has is given up on until RETRY_DELAY passes
+        peers[1].has_shares = False
+        p2p_node.desired_var.set([(None, 500)])
+        downloader._think()
+        while any(peer.requests for peer in peers):
+            for peer in peers:
+                peer.answer()
+        assert 500 in downloader.failed and not downloader.queue
+    
+    def test_old_peers(self):
+        p2p_node, downloader, peers = self.make([3502]*2)
+        downloader._think()
+        requests = [args for peer in peers for kind, args, d in peer.requests]
+        assert [kind for peer in peers for kind, args, d in peer.requests] == ['shares']
+        assert requests[0][0] == [998] and requests[0][1] == 99
+        # each range continues where the last one ended
+        while any(peer.requests for peer in peers):
+            for peer in peers:
+                peer.answer()
+        assert p2p_node.tracker.get_height(999) == 210
+
+    def test_stop(self):
+        p2p_node, downloader, peers = self.make([3503]*2)
+        downloader.start()
+        peers[0].requests, peers[1].requests = [], []
+        downloader.stop()
+        p2p_node.desired_var.set([(None, 500)])
+        assert not any(peer.requests for peer in peers)
+
+class TxSetDifferTest(unittest.TestCase):
+    def test_diff(self):
+        txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=i, script=b'\x00'*i)], lock_time=0) for i in range(4)]
+        tx_hashes = [bitcoin_data.get_txid(tx) for tx in txs]
+        var = variable.Variable(dict(zip(tx_hashes[:2], txs[:2])))
+        differ = p2p.TxSetDiffer(var)
+        diffs = [[], []] # two peers, given the same diffs
+        for peer_diffs in diffs:
+            differ.diffed.watch(peer_diffs.append)
+        size = lambda tx: 100 + bitcoin_data.tx_type.packed_size(tx)
+        total_size = size(txs[0]) + size(txs[1])
+        
+        with mock.patch.object(bitcoin_data.tx_type, 'packed_size', wraps=bitcoin_data.tx_type.packed_size) as packed_size:
+            assert differ.get_total_size() == total_size
+            var.set(dict(zip(tx_hashes[1:], txs[1:])))
+            var.set(dict(zip(tx_hashes[1:], txs[1:]))) # no transition
+            var.set(dict(zip(tx_hashes[2:], txs[2:])))
+            # sized once each
+            assert sorted(call[0][0]['tx_outs'][0]['value'] for call in packed_size.call_args_list) == [0, 1, 2, 3]
+        
+        assert diffs[0] == diffs[1] and len(diffs[0]) == 2 and all(a is b for a, b in zip(*diffs))
+        first, second = diffs[0]
+        assert first.added == tx_hashes[2:] and first.removed == tx_hashes[:1] and first.removed_txs == {tx_hashes[0]: txs[0]}
+        assert first.added_size == size(txs[2]) + size(txs[3]) and first.removed_size == size(txs[0])
+        assert second.added == [] and second.removed == tx_hashes[1:2] and second.removed_size == size(txs[1])
+        assert sorted(differ._sizes) == sorted(tx_hashes[2:]) # forgotten with the txs
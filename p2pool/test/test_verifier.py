@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+
+from twisted.internet import defer, threads
+from twisted.trial import unittest
+
+from p2pool import data as p2pool_data, networks, verifier
+from p2pool.bitcoin import data as bitcoin_data, verthash_dataset
+from p2pool.test.test_data import generate_share
+from p2pool.util import pack
+
+class FakeLoadedShare(object):
+    def __init__(self, contents):
+        self.contents = contents
+
+class ShareVerifierTest(unittest.TestCase):
+    timeout = 60
+
+    def setUp(self):
+        # workers can't parse these, so they hand back None and the reactor
+        # side does the (patched) load itself
+        patcher = mock.patch.object(verifier.p2pool_data, 'load_share',
+            lambda share, net, peer_addr, known_hashes=None: FakeLoadedShare(share['contents']))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.verifier = verifier.ShareVerifier(networks.nets['vertcoin'], workers=2)
+        self.addCleanup(self.verifier.stop)
+
+    @defer.inlineCallbacks
+    def test_order_with_workers(self):
+        def make_batch(name, n):
+            return [dict(type=p2pool_data.PaddingBugfixShare.VERSION, contents=b'%s-%i' % (name, i)) for i in range(n)]
+        order = []
+        # the first batch is much larger, so its hashes finish after the second's
+        ds = [self.verifier.load_shares(make_batch(b'first', 200), None), self.verifier.load_shares(make_batch(b'second', 1), None)]
+        for name, d in zip([b'first', b'second'], ds):
+            d.addCallback(lambda shares, name=name: order.append((name, [share.contents for share in shares])))
+        yield defer.DeferredList(ds, fireOnOneErrback=True)
+        self.assertEqual([name for name, contents in order], [b'first', b'second'])
+        self.assertEqual(order[0][1], [b'first-%i' % i for i in range(200)])
+        self.assertEqual(order[1][1], [b'second-0'])
+
+class WorkerHashesTest(unittest.TestCase):
+    timeout = 120
+
+    def setUp(self):
+        # a small stand-in verthash.dat, with a sidecar vouching for it, which
+        # worker processes started from this directory hash with too
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        filename = os.path.join(self.dir, 'verthash.dat')
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(2**16))
+        st = os.stat(filename)
+        with open(filename + '.sha256', 'wb') as f:
+            f.write(b'%i %i a55531e843cd56b010114aaf6325b0d529ecf88f8ad47639b6ededafd721aa48\n' % (st.st_size, st.st_mtime_ns))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.dir)
+        dataset = verthash_dataset.VerthashDataset(filename)
+        self.net = networks.nets['vertcoin']
+        for patcher in [
+            mock.patch.object(self.net.PARENT, 'POW_FUNC', bitcoin_data.PoWCache(lambda header: pack.IntType(256).unpack(dataset.hash(header)), dataset.hash_many)),
+            mock.patch.object(p2pool_data.BaseShare, '_check_pow', lambda self: None), # no share would meet its target
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.shares = [generate_share(self.net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')[0].as_share() for i in range(5)]
+        self.inline = [p2pool_data.load_share(share, self.net, None) for share in self.shares]
+
+    def get_hashes(self, shares):
+        return [(share.gentx_hash, share.merkle_root, share.pow_hash, share.hash) for share in shares]
+
+    @defer.inlineCallbacks
+    def test_workers(self):
+        share_verifier = verifier.ShareVerifier(self.net, workers=2)
+        self.addCleanup(share_verifier.stop)
+        with mock.patch.object(share_verifier._executor, 'submit', wraps=share_verifier._executor.submit) as submit, \
+                mock.patch.object(verifier.p2pool_data, 'load_share', wraps=p2pool_data.load_share) as load_share, \
+                mock.patch.object(self.net.PARENT, 'POW_FUNC', bitcoin_data.PoWCache(lambda header: 1/0, lambda headers: 1/0)):
+            loaded = yield share_verifier.load_shares(self.shares, ('127.0.0.1', 9346))
+        self.assertEqual(submit.call_count, 2) # a chunk of shares for each worker
+        # every share's hashes came from a worker, and were trusted as known_hashes
+        self.assertEqual([call[0][3] for call in load_share.call_args_list], self.get_hashes(self.inline))
+        self.assertEqual(self.get_hashes(loaded), self.get_hashes(self.inline))
+        assert all(share.pow_hash for share in loaded) # hashed with the dataset, not the 0 they were made with
+        assert not any(share.hydrated for share in loaded) and all(share.peer_addr == ('127.0.0.1', 9346) for share in loaded)
+
+    @defer.inlineCallbacks
+    def test_inline(self):
+        with mock.patch.object(verifier.p2pool_data, 'load_share', wraps=p2pool_data.load_share) as load_share:
+            loaded = yield verifier.ShareVerifier(self.net).load_shares(self.shares, None)
+        self.assertEqual(load_share.call_count, 5) # each share parsed once
+        self.assertEqual(self.get_hashes(loaded), self.get_hashes(self.inline))
+        assert not any(share.hydrated for share in loaded)
+
+class BatchPoWTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_inline(self):
+        net = networks.nets['vertcoin']
+        shares = [generate_share(net, b'VfDCvk4oVuHMZJE2AchAFXu2BmjnYvMnHJ')[0] for i in range(3)]
+        batches = []
+        def batch_func(headers):
+            batches.append(len(headers))
+            return b'\0'*32*len(headers)
+        with mock.patch.object(net.PARENT, 'POW_FUNC', bitcoin_data.PoWCache(lambda header: 1/0, batch_func)):
+            loaded = yield verifier.ShareVerifier(net).load_shares([share.as_share() for share in shares] + [shares[0].as_share()], None)
+        self.assertEqual([share.hash for share in loaded], [share.hash for share in shares + shares[:1]])
+        self.assertEqual(batches, [3]) # every header in one call, the repeated one once
+        assert not any(share.hydrated or share.pow_hash for share in loaded)
+
+class FakePoW(object):
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+    
+    def get_many(self, headers):
+        self.started.set()
+        if headers[0] == b'slow':
+            self.release.wait(10)
+        if b'bad' in headers:
+            raise ValueError('bad header')
+        return [len(header) for header in headers]
+    
+    def __call__(self, header):
+        return self.get_many([header])[0]
+
+class PoWQueueTest(unittest.TestCase):
+    timeout = 30
+    
+    @defer.inlineCallbacks
+    def test_order(self):
+        pow_func = FakePoW()
+        queue = verifier.PoWQueue(pow_func, threads=2, max_depth=3)
+        self.addCleanup(queue.stop)
+        results = []
+        def submit(header):
+            queue.submit(header).addCallbacks(lambda res: results.append((header, res)), lambda fail: results.append((header, fail.value.args[0])))
+        submit(b'slow')
+        yield threads.deferToThread(pow_func.started.wait, 10)
+        for header in [b'x', b'bad', b'yy']: # the other worker takes these while the first is busy
+            submit(header)
+        room = queue.wait_for_room()
+        assert queue.is_full() and queue.depth == 4 and not room.called
+        while queue.headers < 3:
+            yield threads.deferToThread(lambda: None)
+        assert results == [] # held back until b'slow' is done
+        pow_func.release.set()
+        yield room
+        self.assertEqual(results, [(b'slow', 4), (b'x', 1), (b'bad', 'bad header'), (b'yy', 2)])
+        stats = queue.get_stats()
+        assert stats['depth'] == 0 and stats['headers'] == 4 and 2 <= stats['batches'] <= 4
+    
+    def test_inline(self):
+        queue = verifier.PoWQueue(FakePoW(), threads=0)
+        results = []
+        queue.submit(b'abc').addCallback(results.append)
+        assert results == [3]
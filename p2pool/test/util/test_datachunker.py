@@ -1,27 +1,18 @@
-import random
 import unittest
 
 from p2pool.util import datachunker
 
-def random_bytes(length):
-    return ''.join(chr(random.randrange(2**8)) for i in range(length))
-
 class Test(unittest.TestCase):
-    def test_stringbuffer(self):
-        for i in range(100):
-            sb = datachunker.StringBuffer()
-            
-            r = random_bytes(random.randrange(1000))
-            
-            amount_inserted = 0
-            while amount_inserted < len(r):
-                x = random.randrange(10)
-                sb.add(r[amount_inserted:amount_inserted+x])
-                amount_inserted += x
-            
-            amount_removed = 0
-            while amount_removed < len(r):
-                x = random.randrange(min(10, len(r) - amount_removed) + 1)
-                this = sb.get(x)
-                assert r[amount_removed:amount_removed+x] == this
-                amount_removed += x
+    def test_bytebuffer(self):
+        b = datachunker.ByteBuffer()
+        b.add(b'abcdef')
+        assert b.find(b'cd') == 2
+        b.discard(3)
+        assert len(b) == 3 and b.find(b'cd') == -1 and b.find(b'ef') == 1
+        view = b.view(1, 2)
+        b.add(b'ghi' * 10) # view keeps the old buffer alive, so this has to reallocate
+        assert bytes(view) == b'ef'
+        assert bytes(b.view(0, 4)) == b'defg'
+        self.assertRaises(IndexError, b.view, 30, 4)
+        b.discard(100)
+        assert len(b) == 0
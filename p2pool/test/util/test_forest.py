@@ -98,6 +98,9 @@ def test_tracker(self):
         
         length = random.randrange(a[0])
         assert list(self.get_chain(start, length)) == list(t.get_chain(start, length))
+        
+        n = random.randrange(a[0] + 1)
+        assert self.get_nth_parent_hash(start, n) == t.get_nth_parent_hash(start, n)
 
 def generate_tracker_simple(n):
     t = forest.Tracker(math.shuffled(FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None) for i in range(n)))
@@ -132,6 +135,19 @@ class Test(unittest.TestCase):
             res = t.get_nth_parent_hash(a, b)
             assert res == a - b, (a, b, res)
     
+    def test_get_nth_parent_hash_random(self):
+        for ii in range(10):
+            t = generate_tracker_random(random.randrange(1, 300))
+            for i in range(random.randrange(len(t.items))):
+                try:
+                    t.remove(random.choice(list(t.items)))
+                except NotImplementedError:
+                    pass
+            t2 = DumbTracker(iter(t.items.values()))
+            for item_hash in t.items:
+                for n in range(t2.get_height(item_hash) + 1):
+                    assert t.get_nth_parent_hash(item_hash, n) == t2.get_nth_parent_hash(item_hash, n)
+    
     def test_tracker2(self):
         for ii in range(20):
             t = generate_tracker_random(random.randrange(100))
@@ -55,3 +55,10 @@ class Test(unittest.TestCase):
         self.assertListEqual([3, 82, 34, 218, 40], math.convertbits([0, 13, 9, 2, 5, 22, 17, 8], 5, 8, False))
         self.assertListEqual([0, 13, 9, 2, 5, 22, 17, 8], math.convertbits([3, 82, 34, 218, 40], 8, 5, True))
         self.assertListEqual([0, 13, 9, 2, 5, 22, 17, 8], math.convertbits([3, 82, 34, 218, 40], 8, 5, False))
+    
+    def test_histogram(self):
+        h = math.Histogram([1, 10, 100])
+        for x in [0, 1, 2, 10, 50, 1000, 1000]:
+            h.add(x)
+        assert h.counts == [2, 2, 1, 2]
+        assert h.to_dict()['mean'] == 2063/7
@@ -0,0 +1,77 @@
+import random
+import unittest
+
+from twisted.internet import address
+
+from p2pool.util import p2protocol, pack
+
+class FakeTransport(object):
+    def __init__(self):
+        self.written = []
+        self.aborted = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def abortConnection(self):
+        self.aborted = True
+
+    def getPeer(self):
+        return address.IPv4Address('TCP', '127.0.0.1', 9346)
+
+class DummyProtocol(p2protocol.Protocol):
+    message_ping = pack.ComposedType([
+        ('nonce', pack.IntType(64)),
+        ('data', pack.VarStrType()),
+    ])
+
+    def __init__(self):
+        p2protocol.Protocol.__init__(self, b'\xfa\xbf\xb5\xda', 1000)
+        self.makeConnection(FakeTransport())
+        self.received = []
+        self.bad_peer = 0
+
+    def handle_ping(self, nonce, data):
+        self.received.append((nonce, data))
+
+    def badPeerHappened(self):
+        self.bad_peer += 1
+
+def get_message(nonce, data):
+    p = DummyProtocol()
+    p.send_ping(nonce=nonce, data=data)
+    return b''.join(p.transport.written)
+
+class Test(unittest.TestCase):
+    def test_chunked(self):
+        messages = [(i, bytes(random.randrange(256) for j in range(random.randrange(300)))) for i in range(50)]
+        stream = b''.join(get_message(*m) for m in messages)
+        for i in range(20):
+            p = DummyProtocol()
+            pos = 0
+            while pos < len(stream):
+                x = random.choice([1, 2, 3, random.randrange(1, 100), random.randrange(1, 1000)])
+                p.dataReceived(stream[pos:pos + x])
+                pos += x
+            assert p.received == messages
+            assert len(p._buf) == 0
+
+    def test_resync(self):
+        good = get_message(1, b'hello')
+        bad_checksum = good[:20] + bytes([good[20] ^ 1]) + good[21:]
+        too_long = b'\xfa\xbf\xb5\xdaping\0\0\0\0\0\0\0\0' + pack.IntType(32).pack(1001)
+
+        p = DummyProtocol()
+        p.dataReceived(b'junk\xfa\xbf' + too_long + bad_checksum + b'\xfa\xbf\xb5' + good + get_message(2, b''))
+        assert p.received == [(1, b'hello'), (2, b'')]
+        assert p.bad_peer == 1
+
+    def test_unknown_and_malformed(self):
+        p = DummyProtocol()
+        p.dataReceived(get_message(1, b'x').replace(b'ping', b'pong', 1)) # no message_pong; checksum only covers the payload
+        assert p.received == [] and not p.transport.aborted
+
+        msg = get_message(1, b'x')
+        p.message_ping = pack.ComposedType([('nonce', pack.IntType(64))])
+        p.dataReceived(msg) # trailing payload is an error
+        assert p.received == [] and p.transport.aborted
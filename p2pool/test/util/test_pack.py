@@ -9,3 +9,64 @@ class Test(unittest.TestCase):
             assert t.unpack(t.pack(i)) == i
         for i in range(2**36, 2**36+25):
             assert t.unpack(t.pack(i)) == i
+
+    def test_compiled(self):
+        t = pack.ComposedType([
+            ('a', pack.IntType(8)),
+            ('b', pack.IntType(256)),
+            ('c', pack.IntType(16, 'big')),
+            ('d', pack.IntType(32)),
+            ('e', pack.PossiblyNoneType(0, pack.IntType(64))),
+            ('f', pack.ListType(pack.IntType(256))),
+            ('g', pack.VarStrType()),
+            ('h', pack.IntType(160, 'big')),
+            ('i', pack.EnumType(pack.IntType(8), {1: 'x', 2: 'y'})),
+            ('j', pack.FixedStrType(3)),
+            ('k', pack.PackedIntListType(pack.IntType(256))),
+        ])
+        item = dict(a=1, b=2**255 + 5, c=0x1234, d=7, e=None, f=[1, 2**256 - 1], g=b'hello', h=2**159, i='y', j=b'abc', k=[3, 2**256 - 2])
+        packed = t.pack(item)
+
+        # same bytes as the file-based read/write path
+        f = pack.BytesIO()
+        t.write(f, item)
+        assert f.getvalue() == packed
+        assert t.read(pack.BytesIO(packed)) == item
+
+        assert t.unpack(packed) == item
+        assert t.unpack(memoryview(packed)) == item
+        assert t.unpack(pack.BytesIO(packed)) == item
+        assert t.unpack(packed + b'x', ignore_trailing=True) == item
+        self.assertRaises(pack.LateEnd, t.unpack, packed + b'x')
+        for i in range(len(packed)):
+            self.assertRaises(pack.EarlyEnd, t.unpack, packed[:i])
+
+        self.assertRaises(ValueError, t.pack, dict(item, b=2**256))
+        self.assertRaises(ValueError, t.pack, dict(item, h=-1))
+        self.assertRaises(ValueError, t.pack, dict(item, e=0))
+        self.assertRaises(ValueError, t.pack, dict(item, i='z'))
+        self.assertRaises(ValueError, t.pack, dict(item, k=[2**256]))
+
+    def test_packed_int_list(self):
+        t = pack.PackedIntListType(pack.IntType(256))
+        values = [0, 1, 2**255 + 5, 2**256 - 1]
+        x = t.unpack(t.pack(values))
+        assert isinstance(x, pack.PackedIntList) and len(x.data) == 4*32
+        assert len(x) == 4 and list(x) == values and x[2] == values[2] and x[-1] == values[-1] and x[1:3] == values[1:3]
+        self.assertRaises(IndexError, lambda: x[4])
+        assert x == values and values == x and not (x != values) and x != values[:3] and values[:3] != x
+        assert x == t.unpack(t.pack(values)) and x != None and x != 5
+        assert t.pack(x) == t.pack(values) and pack.ListType(pack.IntType(256)).pack(x) == t.pack(values)
+        assert t.unpack(t.pack([])) == []
+
+    def test_compiled_not_leaked(self):
+        # compiled functions live on the type, so throwaway types (like the
+        # FloatingIntegerType helper.getwork builds per poll) can be freed
+        import gc, weakref
+        from p2pool.bitcoin import data as bitcoin_data
+        t = bitcoin_data.FloatingIntegerType()
+        assert t.unpack(t.pack(bitcoin_data.FloatingInteger(0x1d00ffff))).bits == 0x1d00ffff
+        ref = weakref.ref(t)
+        del t
+        gc.collect()
+        assert ref() is None
@@ -1,50 +1,43 @@
-import collections
-
-class StringBuffer(object):
-    'Buffer manager with great worst-case behavior'
-    def __init__(self, data=''):
-        self.buf = collections.deque([data])
-        self.buf_len = len(data)
+class ByteBuffer(object):
+    '''Contiguous buffer for parsing in place: data is copied once, when it's
+    added, and can then be searched and unpacked from or sliced as memoryviews
+    without joining. Offsets are relative to the start of unconsumed data.'''
+    def __init__(self):
+        self.buf = bytearray()
         self.pos = 0
 
     def __len__(self):
-        return self.buf_len - self.pos
+        return len(self.buf) - self.pos
 
     def add(self, data):
-        self.buf.append(data)
-        self.buf_len += len(data)
+        if self.pos and 2*self.pos >= len(self.buf):
+            self._compact()
+        try:
+            self.buf += data
+        except BufferError: # a memoryview from view() is still alive, so leave the old buffer to it
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
 
-    def get(self, wants):
-        if self.buf_len - self.pos < wants:
-            raise IndexError('not enough data')
-        data = []
-        while wants:
-            seg = self.buf[0][self.pos:self.pos+wants]
-            self.pos += len(seg)
-            while self.buf and self.pos >= len(self.buf[0]):
-                x = self.buf.popleft()
-                self.buf_len -= len(x)
-                self.pos -= len(x)
+    def _compact(self):
+        try:
+            del self.buf[:self.pos]
+        except BufferError:
+            self.buf = self.buf[self.pos:]
+        self.pos = 0
 
-            if seg:
-                data.append(seg)
-            wants -= len(seg)
-        return b''.join(data)
+    def find(self, sub):
+        res = self.buf.find(sub, self.pos)
+        return res if res == -1 else res - self.pos
 
-def _DataChunker(receiver):
-    wants = next(receiver)
-    buf = StringBuffer()
+    def unpack_from(self, struct_, offset=0):
+        if offset + struct_.size > len(self):
+            raise IndexError('not enough data')
+        return struct_.unpack_from(self.buf, self.pos + offset)
+
+    def view(self, offset, length):
+        if offset + length > len(self):
+            raise IndexError('not enough data')
+        return memoryview(self.buf)[self.pos + offset:self.pos + offset + length]
 
-    while True:
-        if len(buf) >= wants:
-            wants = receiver.send(buf.get(wants))
-        else:
-            buf.add((yield))
-def DataChunker(receiver):
-    '''
-    Produces a function that accepts data that is input into a generator
-    (receiver) in response to the receiver yielding the size of data to wait on
-    '''
-    x = _DataChunker(receiver)
-    next(x)
-    return x.send
+    def discard(self, length):
+        self.pos += min(length, len(self))
@@ -47,6 +47,47 @@ class DistanceSkipList(TrackerSkipList):
         assert dist_hash[0] == n[0]
         return dist_hash[1]
 
+class AncestorIndex(object):
+    '''get_nth_parent_hash(item_hash, n) by binary lifting: each item keeps
+    jumps[k], the hash of its 2**k-th parent. An item's ancestry never
+    changes, so entries stay valid until the item itself is removed. Tables
+    are filled as far as possible when an item is added and, when parents
+    arrive after their children, extended the first time a query needs
+    them.'''
+    
+    def __init__(self, tracker):
+        self._tracker = tracker
+        self._jumps = {} # item_hash -> [parent, grandparent, 4th parent, ...]
+        
+        self._tracker.added.watch_weakref(self, lambda self, item: self._handle_added(item))
+        self._tracker.removed.watch_weakref(self, lambda self, item: self._jumps.pop(self._tracker._delta_type.get_head(item), None))
+    
+    def _handle_added(self, item):
+        jumps = [self._tracker._delta_type.get_tail(item)]
+        while True:
+            k = len(jumps) - 1
+            parent_jumps = self._jumps.get(jumps[k])
+            if parent_jumps is None or len(parent_jumps) <= k:
+                break
+            jumps.append(parent_jumps[k])
+        self._jumps[self._tracker._delta_type.get_head(item)] = jumps
+    
+    def _jump(self, item_hash, k):
+        jumps = self._jumps[item_hash]
+        while len(jumps) <= k:
+            j = len(jumps) - 1
+            jumps.append(self._jump(jumps[j], j))
+        return jumps[k]
+    
+    def __call__(self, item_hash, n):
+        k = 0
+        while n:
+            if n & 1:
+                item_hash = self._jump(item_hash, k)
+            n >>= 1
+            k += 1
+        return item_hash
+
 def get_attributedelta_type(attrs): # attrs: {name: func}
     class ProtoAttributeDelta(object):
         __slots__ = ['head', 'tail'] + list(attrs.keys())
@@ -207,6 +248,11 @@ class TrackerView(object):
     
     def get_delta_to_last(self, item_hash):
         assert isinstance(item_hash, (int, type(None)))
+        if item_hash in self._deltas:
+            delta1, ref = self._deltas[item_hash]
+            delta2 = self._delta_refs[ref]
+            if delta2.tail not in self._tracker.items: # already points at the last item, nothing to update
+                return delta1 + delta2
         delta = self._delta_type.get_none(item_hash)
         updates = []
         while delta.tail in self._tracker.items:
@@ -234,7 +280,7 @@ class Tracker(object):
         self.remove_special2 = variable.Event()
         self.removed = variable.Event()
         
-        self.get_nth_parent_hash = DistanceSkipList(self)
+        self.get_nth_parent_hash = AncestorIndex(self)
         
         self._delta_type = delta_type
         self._default_view = TrackerView(self, delta_type)
@@ -146,11 +146,11 @@ class HTTPServer(deferred_resource.DeferredResource):
         request.setHeader('Content-Length', len(data))
         request.write(data)
 
-class LineBasedPeer(basic.LineOnlyReceiver):
-    delimiter = '\n'
+class LineBasedPeer(basic.LineReceiver): # not LineOnlyReceiver, so that pauseProducing also holds back lines already read
+    delimiter = b'\n'
 
     def __init__(self):
-        #basic.LineOnlyReceiver.__init__(self)
+        #basic.LineReceiver.__init__(self)
         self._matcher = deferral.GenericDeferrer(max_id=2**30, func=lambda id, method, params: self.sendLine(json.dumps({
             'jsonrpc': '2.0',
             'method': method,
@@ -1,3 +1,4 @@
+import bisect
 import builtins
 import math
 import random
@@ -237,6 +238,27 @@ class RateMonitor(object):
         else:
             self.datums.append((t, datum))
 
+class Histogram(object):
+    '''Counts of values falling under each of a sorted list of upper bounds,
+    plus one overflow bucket.'''
+    
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.total = 0
+    
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+    
+    def to_dict(self):
+        n = sum(self.counts)
+        return dict(
+            bounds=self.bounds,
+            counts=self.counts,
+            mean=self.total/n if n else None,
+        )
+
 def merge_dicts(*dicts):
     res = {}
     for d in dicts: res.update(d)
@@ -16,58 +16,84 @@ from p2pool.util import datachunker, variable
 class TooLong(Exception):
     pass
 
+def frame_message(message_prefix, command, payload):
+    '''The bytes that go on the wire for a message: prefix, command, length,
+    checksum, payload. Built once, they can be written to any number of
+    peers with the same prefix.'''
+    if len(command) >= 12:
+        raise ValueError('command too long')
+    return message_prefix + struct.pack('<12sI', command.encode('ascii'), len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
+
 class Protocol(protocol.Protocol):
+    _header = struct.Struct('<12sI4s') # command, length, checksum; follows the message prefix
+
     def __init__(self, message_prefix, max_payload_length, traffic_happened=variable.Event(), ignore_trailing_payload=False):
         self._message_prefix = message_prefix
         self._max_payload_length = max_payload_length
-        self.dataReceived2 = datachunker.DataChunker(self.dataReceiver())
+        self._buf = datachunker.ByteBuffer()
+        self._wants = 0 # bytes needed before the message at the start of _buf is complete
         self.traffic_happened = traffic_happened
         self.ignore_trailing_payload = ignore_trailing_payload
 
     def dataReceived(self, data):
         self.traffic_happened.happened('p2p/in', len(data))
-        self.dataReceived2(data)
-
-    def dataReceiver(self):
+        buf = self._buf
+        buf.add(data)
+        if len(buf) < self._wants:
+            return
+        self._wants = 0
+        prefix_length = len(self._message_prefix)
+        header_length = prefix_length + self._header.size
         while True:
-            start = b''
-            while start != self._message_prefix:
-                start = (start + (yield 1))[-len(self._message_prefix):]
-
-            command = (yield 12).rstrip(b'\0').decode('ascii')
-            length, = struct.unpack('<I', (yield 4))
+            start = buf.find(self._message_prefix)
+            if start == -1:
+                buf.discard(max(0, len(buf) - (prefix_length - 1))) # keep what could be the start of a split prefix
+                return
+            buf.discard(start)
+            if len(buf) < header_length:
+                return
+
+            command, length, checksum = buf.unpack_from(self._header, prefix_length)
             if length > self._max_payload_length:
                 print('length too large')
+                buf.discard(header_length - 4) # resync right after the length, like a bad prefix
                 continue
-            checksum = yield 4
-            payload = yield length
-
-            payload_hash = bitcoin_data.hash256d(payload)
-            if payload_hash[:4] != checksum:
-                print('invalid hash for %s %s %s %s' % (
-                    self.transport.getPeer().host, repr(command), length,
-                    checksum.encode('hex')))
-                if p2pool.DEBUG:
-                    print("%s %s" % (
-                        payload_hash[:4].encode('hex'), payload.encode('hex')))
-                self.badPeerHappened()
-                continue
+            if len(buf) < header_length + length:
+                self._wants = header_length + length
+                return
+
+            # the payload is unpacked straight out of the receive buffer
+            payload = buf.view(header_length, length)
+            buf.discard(header_length + length)
+            self.messageReceived(command.rstrip(b'\0').decode('ascii', 'replace'), checksum, payload)
+
+    def messageReceived(self, command, checksum, payload):
+        payload_hash = bitcoin_data.hash256d(payload)
+        if payload_hash[:4] != checksum:
+            print('invalid hash for %s %s %s %s' % (
+                self.transport.getPeer().host, repr(command), len(payload),
+                binascii.hexlify(checksum)))
+            if p2pool.DEBUG:
+                print("%s %s" % (
+                    binascii.hexlify(payload_hash[:4]), binascii.hexlify(payload)))
+            self.badPeerHappened()
+            return
 
-            type_ = getattr(self, 'message_' + command, None)
-            if type_ is None:
-                if p2pool.DEBUG:
-                    print('no type for %s' % repr(command))
-                continue
+        type_ = getattr(self, 'message_' + command, None)
+        if type_ is None:
+            if p2pool.DEBUG:
+                print('no type for %s' % repr(command))
+            return
 
-            try:
-                self.packetReceived(command, type_.unpack(
-                    payload, self.ignore_trailing_payload))
-            except:
-                print('RECV %s %s%s' % (
-                    command, binascii.hexlify(payload[:100]),
-                    '...' if len(payload) > 100 else ''))
-                log.err(None, 'Error handling message: (see RECV line)')
-                self.disconnect()
+        try:
+            self.packetReceived(command, type_.unpack(
+                payload, self.ignore_trailing_payload))
+        except:
+            print('RECV %s %s%s' % (
+                command, binascii.hexlify(payload[:100]),
+                '...' if len(payload) > 100 else ''))
+            log.err(None, 'Error handling message: (see RECV line)')
+            self.disconnect()
 
     def packetReceived(self, command, payload2):
         handler = getattr(self, 'handle_' + command, None)
@@ -100,7 +126,10 @@ class Protocol(protocol.Protocol):
         payload = type_.pack(payload2)
         if len(payload) > self._max_payload_length:
             raise TooLong('payload too long')
-        data = self._message_prefix + struct.pack('<12sI', command.encode('ascii'), len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
+        self.sendFrame(frame_message(self._message_prefix, command, payload))
+
+    def sendFrame(self, data):
+        # data is a whole message from frame_message, possibly shared with other peers
         self.traffic_happened.happened('p2p/out', len(data))
         self.transport.write(data)
 
@@ -20,8 +20,41 @@ def remaining(sio):
     sio.seek(here)
     return end - here
 
+class _Reader(object):
+    # minimal file-like view of data starting at pos, for types that only implement read
+    __slots__ = ['data', 'pos']
+
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+
+    def read(self, length):
+        res = bytes(self.data[self.pos:self.pos + length])
+        self.pos += len(res)
+        return res
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.pos = pos
+        elif whence == os.SEEK_CUR:
+            self.pos += pos
+        elif whence == os.SEEK_END:
+            self.pos = len(self.data) + pos
+        else:
+            raise ValueError(whence)
+        return self.pos
+
+def _take(data, pos, length):
+    end = pos + length
+    if end > len(data):
+        raise EarlyEnd()
+    return bytes(data[pos:end]), end
+
 class Type(object):
-    __slots__ = []
+    __slots__ = ['_reader', '_writer'] # compiled functions, kept out of __dict__ so they don't affect __eq__/__hash__
 
     def __hash__(self):
         rval = getattr(self, '_hash', None)
@@ -39,6 +72,39 @@ class Type(object):
     def __ne__(self, other):
         return not (self == other)
 
+    # read(file)/write(file, item) define a type. unpack/pack go through
+    # compiled functions instead: a reader is reader(data, pos) -> (obj, pos)
+    # over bytes or a memoryview, a writer is writer(parts, item) and appends
+    # bytes to the list parts. Types that don't compile their own are wrapped
+    # around read/write.
+
+    def _compile_reader(self):
+        def reader(data, pos):
+            f = _Reader(data, pos)
+            return self.read(f), f.pos
+        return reader
+
+    def _compile_writer(self):
+        def writer(parts, item):
+            f = BytesIO()
+            self.write(f, item)
+            parts.append(f.getvalue())
+        return writer
+
+    def _get_reader(self):
+        try:
+            return self._reader
+        except AttributeError:
+            self._reader = self._compile_reader()
+            return self._reader
+
+    def _get_writer(self):
+        try:
+            return self._writer
+        except AttributeError:
+            self._writer = self._compile_writer()
+            return self._writer
+
     def _unpack(self, data, ignore_trailing=False):
         obj = self.read(data)
         if not ignore_trailing and remaining(data):
@@ -46,20 +112,30 @@ class Type(object):
         return obj
 
     def _pack(self, obj):
-        f = BytesIO()
-        self.write(f, obj)
-        return f.getvalue()
+        parts = []
+        try:
+            self._get_writer()(parts, obj)
+        except OverflowError as e: # from int.to_bytes
+            raise ValueError('invalid int value - %s' % (e,))
+        return b''.join(parts)
 
     def unpack(self, data, ignore_trailing=False):
-        if not isinstance(data, BytesIO):
-            data = BytesIO(data)
-        obj = self._unpack(data, ignore_trailing)
+        if isinstance(data, BytesIO):
+            obj = self._unpack(data, ignore_trailing)
+            data = data.getvalue()
+        else:
+            try:
+                obj, end = self._get_reader()(data, 0)
+            except (IndexError, struct.error): # data[pos] and unpack_from past the end
+                raise EarlyEnd()
+            if not ignore_trailing and end != len(data):
+                raise LateEnd()
 
         if p2pool.DEBUG:
             packed = self._pack(obj)
-            good = data.getvalue().startswith(packed) if ignore_trailing else data.getvalue() == packed
+            good = data[:len(packed)] == packed if ignore_trailing else data == packed
             if not good:
-                raise AssertionError(ignore_trailing, packed, data.getvalue())
+                raise AssertionError(ignore_trailing, packed, bytes(data))
 
         return obj
 
@@ -80,6 +156,20 @@ class Type(object):
 
         return packed_size
 
+_varint_cache = [bytes([i]) for i in range(0xfd)]
+
+def _pack_varint(item):
+    if 0 <= item < 0xfd:
+        return _varint_cache[item]
+    elif 0 <= item <= 0xffff:
+        return struct.pack('<BH', 0xfd, item)
+    elif 0 <= item <= 0xffffffff:
+        return struct.pack('<BI', 0xfe, item)
+    elif 0 <= item <= 0xffffffffffffffff:
+        return struct.pack('<BQ', 0xff, item)
+    else:
+        raise ValueError('int too large for varint')
+
 class VarIntType(Type):
     def read(self, file):
         data = file.read(1)
@@ -112,6 +202,26 @@ class VarIntType(Type):
         else:
             raise ValueError('int too large for varint')
 
+    def _compile_reader(self):
+        unpack_H, unpack_I, unpack_Q = struct.Struct('<H').unpack_from, struct.Struct('<I').unpack_from, struct.Struct('<Q').unpack_from
+        def reader(data, pos):
+            first = data[pos]
+            if first < 0xfd:
+                return first, pos + 1
+            if first == 0xfd:
+                (res,), pos, minimum = unpack_H(data, pos + 1), pos + 3, 0xfd
+            elif first == 0xfe:
+                (res,), pos, minimum = unpack_I(data, pos + 1), pos + 5, 2**16
+            else:
+                (res,), pos, minimum = unpack_Q(data, pos + 1), pos + 9, 2**32
+            if res < minimum:
+                raise AssertionError('VarInt not canonically packed')
+            return res, pos
+        return reader
+
+    def _compile_writer(self):
+        return lambda parts, item: parts.append(_pack_varint(item))
+
 class VarStrType(Type):
     _inner_size = VarIntType()
 
@@ -125,6 +235,21 @@ class VarStrType(Type):
         self._inner_size.write(file, len(item))
         file.write(item)
 
+    def _compile_reader(self):
+        read_size = self._inner_size._get_reader()
+        def reader(data, pos):
+            length, pos = read_size(data, pos)
+            return _take(data, pos, length)
+        return reader
+
+    def _compile_writer(self):
+        def writer(parts, item):
+            if not isinstance(item, (bytes, bytearray)):
+                raise ValueError("Can only pack a string in bytes() or bytearray().")
+            parts.append(_pack_varint(len(item)))
+            parts.append(item)
+        return writer
+
 class EnumType(Type):
     def __init__(self, inner, pack_to_unpack):
         self.inner = inner
@@ -147,6 +272,23 @@ class EnumType(Type):
             raise ValueError('enum item (%r) not in unpack_to_pack (%r)' % (item, self.unpack_to_pack))
         self.inner.write(file, self.unpack_to_pack[item])
 
+    def _compile_reader(self):
+        read_inner, pack_to_unpack = self.inner._get_reader(), self.pack_to_unpack
+        def reader(data, pos):
+            value, pos = read_inner(data, pos)
+            if value not in pack_to_unpack:
+                raise ValueError('enum data (%r) not in pack_to_unpack (%r)' % (value, pack_to_unpack))
+            return pack_to_unpack[value], pos
+        return reader
+
+    def _compile_writer(self):
+        write_inner, unpack_to_pack = self.inner._get_writer(), self.unpack_to_pack
+        def writer(parts, item):
+            if item not in unpack_to_pack:
+                raise ValueError('enum item (%r) not in unpack_to_pack (%r)' % (item, unpack_to_pack))
+            write_inner(parts, unpack_to_pack[item])
+        return writer
+
 class ListType(Type):
     _inner_size = VarIntType()
 
@@ -166,6 +308,111 @@ class ListType(Type):
         for subitem in item:
             self.type.write(file, subitem)
 
+    def _compile_reader(self):
+        read_size, mul = self._inner_size._get_reader(), self.mul
+        if isinstance(self.type, _IntType) and self.type.bytes:
+            # fixed-size ints (hashes, mostly) are sliced straight out of the buffer
+            size, byteorder = self.type.bytes, self.type.byteorder
+            def reader(data, pos):
+                length, pos = read_size(data, pos)
+                end = pos + length*mul*size
+                if end > len(data):
+                    raise EarlyEnd()
+                return [int.from_bytes(data[i:i + size], byteorder) for i in range(pos, end, size)], end
+            return reader
+        read_inner = self.type._get_reader()
+        def reader(data, pos):
+            length, pos = read_size(data, pos)
+            res = [None]*(length*mul)
+            for i in range(length*mul):
+                res[i], pos = read_inner(data, pos)
+            return res, pos
+        return reader
+
+    def _compile_writer(self):
+        mul, write_inner = self.mul, self.type._get_writer()
+        def writer(parts, item):
+            assert len(item) % mul == 0
+            parts.append(_pack_varint(len(item)//mul))
+            for subitem in item:
+                write_inner(parts, subitem)
+        return writer
+
+class PackedIntList(object):
+    '''A read-only list of fixed-size ints kept as the bytes they were
+    unpacked from, for long-lived data (the merkle branches in shares).
+    Compares equal to a list of the same ints.'''
+    __slots__ = ['data', 'type']
+
+    def __init__(self, data, type):
+        self.data = data
+        self.type = type
+
+    def __len__(self):
+        return len(self.data)//self.type.bytes
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('list index out of range')
+        size = self.type.bytes
+        return int.from_bytes(self.data[index*size:(index + 1)*size], self.type.byteorder)
+
+    def __iter__(self):
+        data, size, byteorder = self.data, self.type.bytes, self.type.byteorder
+        for i in range(0, len(data), size):
+            yield int.from_bytes(data[i:i + size], byteorder)
+
+    def __eq__(self, other):
+        if isinstance(other, PackedIntList) and other.type is self.type:
+            return other.data == self.data
+        if not isinstance(other, (list, tuple, PackedIntList)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        return res if res is NotImplemented else not res
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'PackedIntList(%r)' % (list(self),)
+
+class PackedIntListType(ListType):
+    '''ListType of fixed-size ints that unpacks to a PackedIntList.'''
+
+    def __init__(self, type):
+        assert isinstance(type, _IntType) and type.bytes
+        ListType.__init__(self, type)
+
+    def read(self, file):
+        length = self._inner_size.read(file)
+        return PackedIntList(file.read(length*self.type.bytes), self.type)
+
+    def _compile_reader(self):
+        read_size, int_type = self._inner_size._get_reader(), self.type
+        size = int_type.bytes
+        def reader(data, pos):
+            length, pos = read_size(data, pos)
+            packed, pos = _take(data, pos, length*size)
+            return PackedIntList(packed, int_type), pos
+        return reader
+
+    def _compile_writer(self):
+        write_list, int_type = ListType._compile_writer(self), self.type
+        def writer(parts, item):
+            if isinstance(item, PackedIntList) and item.type is int_type:
+                parts.append(_pack_varint(len(item)))
+                parts.append(item.data)
+            else:
+                write_list(parts, item)
+        return writer
+
 class StructType(Type):
     __slots__ = 'desc length'.split(' ')
 
@@ -180,9 +427,18 @@ class StructType(Type):
     def write(self, file, item):
         file.write(struct.pack(self.desc, item))
 
-@memoize.fast_memoize_multiple_args
-class IntType(Type):
-    __slots__ = 'bytes step format_str max'.split(' ')
+    def _compile_reader(self):
+        unpack_from, length = struct.Struct(self.desc).unpack_from, self.length
+        def reader(data, pos):
+            return unpack_from(data, pos)[0], pos + length
+        return reader
+
+    def _compile_writer(self):
+        pack = struct.Struct(self.desc).pack
+        return lambda parts, item: parts.append(pack(item))
+
+class _IntType(Type):
+    __slots__ = 'bytes step format_str max byteorder'.split(' ')
 
     def __new__(cls, bits, endianness='little'):
         assert bits % 8 == 0
@@ -199,6 +455,7 @@ class IntType(Type):
         self.step = -1 if endianness == 'little' else 1
         self.format_str = b'%%0%ix' % (2*self.bytes)
         self.max = 2**bits
+        self.byteorder = endianness
 
     def read(self, file, hexlify=binascii.hexlify):
         if self.bytes == 0:
@@ -213,6 +470,29 @@ class IntType(Type):
             raise ValueError('invalid int value - %r' % item)
         file.write(unhexlify(self.format_str % item)[::self.step])
 
+    def _compile_reader(self):
+        size, byteorder = self.bytes, self.byteorder
+        if size == 0:
+            return lambda data, pos: (0, pos)
+        def reader(data, pos):
+            end = pos + size
+            if end > len(data):
+                raise EarlyEnd()
+            return int.from_bytes(data[pos:end], byteorder), end
+        return reader
+
+    def _compile_writer(self):
+        size, byteorder, max_ = self.bytes, self.byteorder, self.max
+        if size == 0:
+            return lambda parts, item: None
+        def writer(parts, item):
+            if not 0 <= item < max_:
+                raise ValueError('invalid int value - %r' % item)
+            parts.append(item.to_bytes(size, byteorder))
+        return writer
+
+IntType = memoize.fast_memoize_multiple_args(_IntType)
+
 class IPV6AddressType(Type):
     def read(self, file):
         data = file.read(16)
@@ -288,6 +568,74 @@ class ComposedType(Type):
         for key, type_ in self.fields:
             type_.write(file, item[key])
 
+    def _get_runs(self):
+        # splits fields into runs of consecutive fixed-size fields that can
+        # share one struct.Struct, as (byte order, [(key, type_, code)]), and
+        # (None, [(key, type_)]) for everything else. IntTypes go in as raw
+        # bytes, so they fit a run of either byte order
+        runs = []
+        for key, type_ in self.fields:
+            if isinstance(type_, StructType):
+                order, code = type_.desc[:1], type_.desc[1:]
+            elif isinstance(type_, _IntType):
+                order, code = '', '%is' % (type_.bytes,)
+            else:
+                runs.append((None, [(key, type_)]))
+                continue
+            last_order = runs[-1][0] if runs else None
+            if last_order is not None and (order == '' or last_order == '' or order == last_order):
+                runs[-1] = (last_order or order, runs[-1][1] + [(key, type_, code)])
+            else:
+                runs.append((order, [(key, type_, code)]))
+        return runs
+
+    def _compile_reader(self):
+        if not all(key.isidentifier() for key, type_ in self.fields):
+            return Type._compile_reader(self)
+        ns = dict(Record=self.record_type, from_bytes=int.from_bytes)
+        lines = ['def reader(data, pos):', '    item = Record()']
+        for i, (order, fields) in enumerate(self._get_runs()):
+            if order is None:
+                (key, type_), = fields
+                ns['read%i' % i] = type_._get_reader()
+                lines.append('    item.%s, pos = read%i(data, pos)' % (key, i))
+                continue
+            s = ns['struct%i' % i] = struct.Struct((order or '<') + ''.join(code for key, type_, code in fields))
+            names = ['v%i_%i' % (i, j) for j in range(len(fields))]
+            lines.append('    %s, = struct%i.unpack_from(data, pos)' % (', '.join(names), i))
+            lines.append('    pos += %i' % (s.size,))
+            for name, (key, type_, code) in zip(names, fields):
+                if isinstance(type_, StructType):
+                    lines.append('    item.%s = %s' % (key, name))
+                elif type_.bytes == 0:
+                    lines.append('    item.%s = 0' % (key,))
+                else:
+                    lines.append('    item.%s = from_bytes(%s, %r)' % (key, name, type_.byteorder))
+        lines.append('    return item, pos')
+        exec('\n'.join(lines), ns)
+        return ns['reader']
+
+    def _compile_writer(self):
+        ns = {}
+        lines = ['def writer(parts, item):', '    append = parts.append']
+        for i, (order, fields) in enumerate(self._get_runs()):
+            if order is None:
+                (key, type_), = fields
+                ns['write%i' % i] = type_._get_writer()
+                lines.append('    write%i(parts, item[%r])' % (i, key))
+                continue
+            ns['struct%i' % i] = struct.Struct((order or '<') + ''.join(code for key, type_, code in fields))
+            args = []
+            for key, type_, code in fields:
+                if isinstance(type_, StructType):
+                    args.append('item[%r]' % (key,))
+                else:
+                    # to_bytes raises OverflowError for negative/too large values, turned into ValueError by pack
+                    args.append('item[%r].to_bytes(%i, %r)' % (key, type_.bytes, type_.byteorder) if type_.bytes else 'b""')
+            lines.append('    append(struct%i.pack(%s))' % (i, ', '.join(args)))
+        exec('\n'.join(lines), ns)
+        return ns['writer']
+
 class PossiblyNoneType(Type):
     def __init__(self, none_value, inner):
         self.none_value = none_value
@@ -303,6 +651,26 @@ class PossiblyNoneType(Type):
             raise ValueError('none_value used')
         self.inner.write(file, self.none_value if item is None else item)
 
+    def _compile_reader(self):
+        # packing is canonical, so comparing the raw bytes is the same as
+        # comparing the value, and cheaper for records
+        read_inner, none_packed = self.inner._get_reader(), self.inner.pack(self.none_value)
+        def reader(data, pos):
+            value, end = read_inner(data, pos)
+            return None if data[pos:end] == none_packed else value, end
+        return reader
+
+    def _compile_writer(self):
+        write_inner, none_value = self.inner._get_writer(), self.none_value
+        def writer(parts, item):
+            if item is None:
+                write_inner(parts, none_value)
+            elif item == none_value:
+                raise ValueError('none_value used')
+            else:
+                write_inner(parts, item)
+        return writer
+
 class FixedStrType(Type):
     def __init__(self, length):
         self.length = length
@@ -316,3 +684,17 @@ class FixedStrType(Type):
         if not isinstance(item, (bytes, bytearray)):
             raise ValueError("Can only pack a string in bytes() or bytearray().")
         file.write(item)
+
+    def _compile_reader(self):
+        length = self.length
+        return lambda data, pos: _take(data, pos, length)
+
+    def _compile_writer(self):
+        length = self.length
+        def writer(parts, item):
+            if len(item) != length:
+                raise ValueError('incorrect length item!')
+            if not isinstance(item, (bytes, bytearray)):
+                raise ValueError("Can only pack a string in bytes() or bytearray().")
+            parts.append(item)
+        return writer
@@ -0,0 +1,204 @@
+'''
+Offloads the CPU-heavy part of loading shares received from peers (the hash
+link, merkle root and PoW computed by BaseShare.get_hashes) to a pool of
+worker processes, and of checking pseudoshares submitted by miners (their
+PoW) to a thread, so Verthash doesn't run on the reactor thread.
+'''
+
+import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from p2pool import data as p2pool_data
+from p2pool.bitcoin import data as bitcoin_data
+
+PLACEHOLDER_HASHES = (0, 0, 0, 0) # known_hashes for loading a share to call get_packed_header on
+
+def _hash_headers(net, headers):
+    # all the headers' PoW in one call, which runs without the GIL
+    pow_hashes = iter(net.PARENT.POW_FUNC.get_many([header for gentx_hash, merkle_root, header in filter(None, headers)]))
+    return [None if x is None else (x[0], x[1], next(pow_hashes), bitcoin_data.hash256(x[2])) for x in headers]
+
+def _get_hashes(net_name, shares):
+    from p2pool import networks
+    net = networks.nets[net_name]
+    headers = []
+    for share in shares:
+        try:
+            headers.append(p2pool_data.load_share(share, net, None, PLACEHOLDER_HASHES).get_packed_header())
+        except Exception:
+            headers.append(None) # the reactor side repeats the load inline so that it raises the real error
+    return _hash_headers(net, headers)
+
+class ShareVerifier(object):
+    def __init__(self, net, workers=0):
+        self.net = net
+        self.workers = workers
+        self._executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) if workers else None
+        self._last = defer.succeed(None)
+
+    def _load_inline(self, shares, peer_addr):
+        # each share parsed once, and every header hashed in one batch
+        res = [p2pool_data.load_share(share, self.net, peer_addr, PLACEHOLDER_HASHES) for share in shares]
+        for share, hashes in zip(res, _hash_headers(self.net, [share.get_packed_header() for share in res])):
+            share.set_hashes(hashes)
+        return res
+
+    def _load(self, shares, peer_addr, hashes):
+        res = []
+        for share, known_hashes in zip(shares, hashes):
+            share = p2pool_data.load_share(share, self.net, peer_addr, known_hashes)
+            share.hydrated = False # computed by _get_hashes, nothing left to reverify
+            res.append(share)
+        return res
+
+    def get_hashes(self, shares):
+        '''Returns a Deferred that fires with get_hashes() of each share, or None
+        for shares that couldn't be loaded.'''
+
+        if self._executor is None:
+            return defer.succeed(_get_hashes(self.net.NAME, shares))
+
+        # one job per worker, so each pays one round trip and one batched PoW call
+        chunk_size = max(1, -(-len(shares)//self.workers))
+        chunks = [shares[i:i + chunk_size] for i in range(0, len(shares), chunk_size)]
+        futures = [self._executor.submit(_get_hashes, self.net.NAME, chunk) for chunk in chunks]
+        d = defer.Deferred()
+        def future_done(_):
+            if all(f.done() for f in futures) and not d.called:
+                d.callback([x for chunk, f in zip(chunks, futures) for x in
+                    ([None]*len(chunk) if f.cancelled() or f.exception() is not None else f.result())])
+        for f in futures:
+            f.add_done_callback(lambda f: reactor.callFromThread(future_done, f))
+        if not futures:
+            d.callback([])
+        return d
+
+    def load_shares(self, shares, peer_addr):
+        '''Returns a Deferred that fires with the loaded shares, or fails with
+        whatever load_share raised. Results fire in the order load_shares was
+        called, so callers see shares in the same order as without workers.'''
+
+        if self._executor is None:
+            return defer.execute(self._load_inline, shares, peer_addr)
+
+        hashes_d = self.get_hashes(shares)
+        d = defer.Deferred()
+        def deliver(_):
+            delivered = defer.Deferred()
+            def fire(res):
+                d.callback(res)
+                delivered.callback(None)
+            hashes_d.addCallback(lambda hashes: self._load(shares, peer_addr, hashes)).addBoth(fire)
+            return delivered
+        self._last = self._last.addCallback(deliver)
+        return d
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+class PoWQueue(object):
+    '''Computes the PoW of headers off the reactor thread. submit returns a
+    Deferred that fires with the header's pow_hash, in the order submit was
+    called. Each worker thread takes everything queued since its last pass,
+    up to BATCH_SIZE headers, and hashes it with one POW_FUNC.get_many call,
+    which runs without the GIL. With threads=0, submit hashes inline.'''
+
+    BATCH_SIZE = 256
+
+    def __init__(self, pow_func, threads=1, max_depth=1024):
+        self.pow_func = pow_func
+        self.threads = threads
+        self.max_depth = max_depth
+        self._queue = queue.Queue() # (header, entry) or None to stop a worker
+        self._pending = collections.deque() # entries [deferred, done, result], in submission order
+        self._room_waiters = []
+        self._workers = []
+        self.batches = 0
+        self.headers = 0
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def is_full(self):
+        return len(self._pending) >= self.max_depth
+
+    def wait_for_room(self):
+        '''Returns a Deferred that fires once the queue is no longer full.'''
+        if not self.is_full():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._room_waiters.append(d)
+        return d
+
+    def submit(self, header):
+        if not self.threads:
+            return defer.execute(self.pow_func, header)
+        if not self._workers:
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._work, name='PoWQueue-%i' % (i,))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        entry = [defer.Deferred(), False, None]
+        self._pending.append(entry)
+        self._queue.put((header, entry))
+        return entry[0]
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            items = [item]
+            while len(items) < self.BATCH_SIZE:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None) # stop after this batch
+                    break
+                items.append(item)
+            try:
+                results = self.pow_func.get_many([header for header, entry in items])
+            except Exception:
+                # hash them one by one, so that only the bad header fails
+                results = []
+                for header, entry in items:
+                    try:
+                        results.append(self.pow_func(header))
+                    except Exception:
+                        results.append(failure.Failure())
+            reactor.callFromThread(self._got_results, items, results)
+
+    def _got_results(self, items, results):
+        self.batches += 1
+        self.headers += len(items)
+        for (header, entry), result in zip(items, results):
+            entry[1], entry[2] = True, result
+        while self._pending and self._pending[0][1]:
+            d, done, result = self._pending.popleft()
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        if not self.is_full():
+            waiters, self._room_waiters = self._room_waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def get_stats(self):
+        return dict(depth=self.depth, max_depth=self.max_depth, batches=self.batches, headers=self.headers)
+
+    def stop(self):
+        for worker in self._workers:
+            self._queue.put(None)
+        self._workers = []
@@ -46,7 +46,7 @@ def _atomic_write(filename, data):
         os.rename(file_, filename)
 
 def get_web_root(wb, datadir_path, bitcoind_getinfo_var,
-                 stop_event=variable.Event(), static_dir=None):
+                 stop_event=variable.Event(), static_dir=None, stratum_notifier=None):
     node = wb.node
     start_time = time.time()
 
@@ -307,6 +307,12 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var,
     web_root.putChild(b'users', WebInterface(get_users))
     web_root.putChild(b'user_stales', WebInterface(get_user_stales))
     web_root.putChild(b'fee', WebInterface(lambda: wb.worker_fee))
+    web_root.putChild(b'work_stats', WebInterface(wb.get_work_stats))
+    web_root.putChild(b'prune_stats', WebInterface(node.pruner.get_stats))
+    web_root.putChild(b'pow_cache_stats', WebInterface(node.net.PARENT.POW_FUNC.get_stats))
+    web_root.putChild(b'pow_queue_stats', WebInterface(wb.pow_queue.get_stats))
+    if stratum_notifier is not None:
+        web_root.putChild(b'notify_latency', WebInterface(stratum_notifier.get_notify_latency))
     web_root.putChild(b'current_payouts', WebInterface(get_current_payouts))
     web_root.putChild(b'patron_sendmany', WebInterface(get_patron_sendmany))
     web_root.putChild(b'global_stats', WebInterface(get_global_stats))
@@ -320,20 +326,21 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var,
         lambda: dict(('%s:%i' % (peer.transport.getPeer().host,
             peer.transport.getPeer().port), peer.remembered_txs_size) for \
                     peer in node.p2p_node.peers.values())))
-    web_root.putChild(b'pings', WebInterface(defer.inlineCallbacks(
-        lambda: defer.returnValue(
-            dict([(a, (yield b)) for a, b in
-                [(
-                    '%s:%i' % (peer.transport.getPeer().host,
-                               peer.transport.getPeer().port),
-                    defer.inlineCallbacks(lambda peer=peer: defer.returnValue(
-                        min([(yield peer.do_ping().addCallback(
-                            lambda x: x / 0.001).addErrback(
-                                lambda fail: None)) for i in xrange(3)])
-                    ))()
-                ) for peer in list(node.p2p_node.peers.values())]
-            ])
-        ))))
+    @defer.inlineCallbacks
+    def get_ping(peer):
+        pings = []
+        for i in range(3):
+            pings.append((yield peer.do_ping().addCallback(
+                lambda x: x / 0.001).addErrback(lambda fail: None)))
+        pings = [ping for ping in pings if ping is not None]
+        defer.returnValue(min(pings) if pings else None)
+    @defer.inlineCallbacks
+    def get_pings():
+        res = {}
+        for peer in list(node.p2p_node.peers.values()):
+            res['%s:%i' % (peer.transport.getPeer().host, peer.transport.getPeer().port)] = yield get_ping(peer)
+        defer.returnValue(res)
+    web_root.putChild(b'pings', WebInterface(get_pings))
     web_root.putChild(b'peer_versions', WebInterface(get_peer_versions))
     web_root.putChild(b'payout_addr', WebInterface(lambda: wb.address))
     web_root.putChild(b'payout_addrs', WebInterface(
@@ -15,6 +15,7 @@ import p2pool.bitcoin.data as bitcoin_data
 from p2pool.bitcoin import helper, script, worker_interface
 from p2pool.util import forest, jsonrpc, variable, deferral, math, pack
 import p2pool, p2pool.data as p2pool_data
+from p2pool import verifier
 
 print_throttle = 0.0
 
@@ -42,6 +43,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
         self.share_received = variable.Event()
         self.local_rate_monitor = math.RateMonitor(10*60)
         self.local_addr_rate_monitor = math.RateMonitor(10*60)
+        self.pow_queue = verifier.PoWQueue(self.node.net.PARENT.POW_FUNC)
         
         self.removed_unstales_var = variable.Variable((0, 0, 0))
         self.removed_doa_unstales_var = variable.Variable(0)
@@ -132,16 +134,29 @@ class WorkerBridge(worker_interface.WorkerBridge):
         
         self.new_work_event = variable.Event()
 
+        # job statistics: get_work rate, and how long after a new block the
+        # last job for it was handed out (the new_work_event handlers, like
+        # stratum's notify, run synchronously)
+        self.job_rate_monitor = math.RateMonitor(60)
+        self.new_block_work = None # (new_work_event.times, time) for the last new block
+        self.new_block_jobs = 0
+        self.new_block_job_latency = None
+        self._template = None
+
         @self.current_work.transitioned.watch
         def _(before, after):
             # trigger LP if version/previous_block/bits changed or transactions changed from nothing
             if any(before[x] != after[x] for x in ['version', 'previous_block', 'bits']) or (not before['transactions'] and after['transactions']):
+                if before['previous_block'] != after['previous_block']:
+                    self.new_block_work = self.new_work_event.times + 1, time.time()
+                    self.new_block_jobs = 0
                 self.new_work_event.happened()
         self.merged_work.changed.watch(lambda _: self.new_work_event.happened())
         self.node.best_share_var.changed.watch(lambda _: self.new_work_event.happened())
     
     def stop(self):
         self.running = False
+        self.pow_queue.stop()
     
     def get_stale_counts(self):
         '''Returns (orphans, doas), total, (orphans_recorded_in_chain, doas_recorded_in_chain)'''
@@ -272,6 +287,74 @@ class WorkerBridge(worker_interface.WorkerBridge):
                     addr_hash_rates.get(datum['address'], 0) + datum['work']/dt
         return addr_hash_rates
  
+    def get_work_stats(self):
+        jobs, dt = self.job_rate_monitor.get_datums_in_last()
+        return dict(
+            jobs_per_second=len(jobs)/dt if dt else None,
+            mean_job_time=sum(job['time'] for job in jobs)/len(jobs) if jobs else None,
+            new_block_jobs=self.new_block_jobs,
+            new_block_to_last_job=self.new_block_job_latency,
+        )
+
+    def _get_template(self):
+        '''The miner-independent part of get_work, shared by all jobs until
+        bitcoind's work or the best share changes.'''
+        current_work, best_share_hash = self.current_work.value, self.node.best_share_var.value
+        template = self._template
+        if template is not None and template['current_work'] is current_work and template['best_share_hash'] == best_share_hash:
+            return template
+
+        tx_hashes = current_work['transaction_hashes']
+        tx_map = dict(list(zip(tx_hashes, current_work['transactions'])))
+
+        self.node.mining2_txs_var.set(tx_map) # let node.py know not to evict these transactions
+        
+        previous_share = self.node.tracker.items[best_share_hash] if best_share_hash is not None else None
+        if previous_share is None:
+            share_type = p2pool_data.Share
+        else:
+            previous_share_type = type(previous_share)
+            
+            if previous_share_type.SUCCESSOR is None or self.node.tracker.get_height(previous_share.hash) < self.node.net.CHAIN_LENGTH:
+                share_type = previous_share_type
+            else:
+                successor_type = previous_share_type.SUCCESSOR
+                
+                counts = p2pool_data.get_desired_version_counts(self.node.tracker,
+                    self.node.tracker.get_nth_parent_hash(previous_share.hash, self.node.net.CHAIN_LENGTH*9//10), self.node.net.CHAIN_LENGTH//10)
+                upgraded = counts.get(successor_type.VERSION, 0)/sum(counts.values())
+                if upgraded > .65:
+                    print('Switchover imminent. Upgraded: %.3f%% Threshold: %.3f%%' % (upgraded*100, 95))
+                # Share -> NewShare only valid if 95% of hashes in [net.CHAIN_LENGTH*9//10, net.CHAIN_LENGTH] for new version
+                if counts.get(successor_type.VERSION, 0) > sum(counts.values())*95//100:
+                    share_type = successor_type
+                else:
+                    share_type = previous_share_type
+
+        lookbehind = 3600//self.node.net.SHARE_PERIOD
+        transaction_template = share_type.generate_transaction_template(
+            tracker=self.node.tracker,
+            previous_share_hash=best_share_hash,
+            block_target=current_work['bits'].target,
+            subsidy=current_work['subsidy'],
+            desired_other_transaction_hashes_and_fees=list(zip(tx_hashes, current_work['transaction_fees'])),
+            net=self.node.net,
+            known_txs=tx_map,
+            base_subsidy=self.node.net.PARENT.SUBSIDY_FUNC(current_work['height']),
+        )
+        self._template = template = dict(
+            current_work=current_work,
+            best_share_hash=best_share_hash,
+            tx_map=tx_map,
+            previous_share=previous_share,
+            share_type=share_type,
+            pool_attempts_per_second=p2pool_data.get_pool_attempts_per_second(self.node.tracker, best_share_hash, lookbehind)
+                if previous_share is not None and self.node.tracker.get_height(previous_share.hash) > lookbehind else None,
+            transaction_template=transaction_template,
+            other_transactions=[tx_map[tx_hash] for tx_hash in transaction_template['other_transaction_hashes']],
+        )
+        return template
+
     def get_work(self, user, address, desired_share_target,
                  desired_pseudoshare_target, worker_ip=None):
         global print_throttle
@@ -299,32 +382,10 @@ class WorkerBridge(worker_interface.WorkerBridge):
             mm_data = ''
             mm_later = []
         
-        tx_hashes = self.current_work.value['transaction_hashes']
-        tx_map = dict(list(zip(tx_hashes, self.current_work.value['transactions'])))
-
-        self.node.mining2_txs_var.set(tx_map) # let node.py know not to evict these transactions
-        
-        previous_share = self.node.tracker.items[self.node.best_share_var.value] if self.node.best_share_var.value is not None else None
-        if previous_share is None:
-            share_type = p2pool_data.Share
-        else:
-            previous_share_type = type(previous_share)
-            
-            if previous_share_type.SUCCESSOR is None or self.node.tracker.get_height(previous_share.hash) < self.node.net.CHAIN_LENGTH:
-                share_type = previous_share_type
-            else:
-                successor_type = previous_share_type.SUCCESSOR
-                
-                counts = p2pool_data.get_desired_version_counts(self.node.tracker,
-                    self.node.tracker.get_nth_parent_hash(previous_share.hash, self.node.net.CHAIN_LENGTH*9//10), self.node.net.CHAIN_LENGTH//10)
-                upgraded = counts.get(successor_type.VERSION, 0)/sum(counts.values())
-                if upgraded > .65:
-                    print('Switchover imminent. Upgraded: %.3f%% Threshold: %.3f%%' % (upgraded*100, 95))
-                # Share -> NewShare only valid if 95% of hashes in [net.CHAIN_LENGTH*9//10, net.CHAIN_LENGTH] for new version
-                if counts.get(successor_type.VERSION, 0) > sum(counts.values())*95//100:
-                    share_type = successor_type
-                else:
-                    share_type = previous_share_type
+        template = self._get_template()
+        tx_map = template['tx_map']
+        previous_share = template['previous_share']
+        share_type = template['share_type']
         
         if desired_share_target is None:
             desired_share_target = 2**256-1
@@ -336,11 +397,10 @@ class WorkerBridge(worker_interface.WorkerBridge):
             if self.node.punish:
                 print("trying to punish a share by mining a low-diff share")
                 desired_share_target = bitcoin_data.difficulty_to_target(1.)
-            local_addr_rates = self.get_local_addr_rates()
-            lookbehind = 3600//self.node.net.SHARE_PERIOD
+            local_addr_rates = self.get_local_addr_rates() # per job, miners' rates move between best shares
             block_subsidy = self.node.bitcoind_work.value['subsidy']
-            if previous_share is not None and self.node.tracker.get_height(previous_share.hash) > lookbehind:
-                expected_payout_per_block = local_addr_rates.get(address, 0)/p2pool_data.get_pool_attempts_per_second(self.node.tracker, self.node.best_share_var.value, lookbehind) \
+            if template['pool_attempts_per_second'] is not None:
+                expected_payout_per_block = local_addr_rates.get(address, 0)/template['pool_attempts_per_second'] \
                     * block_subsidy*(1-self.donation_percentage/100) # XXX doesn't use global stale rate to compute pool hash
                 if expected_payout_per_block < self.node.net.PARENT.DUST_THRESHOLD:
                     desired_share_target = min(desired_share_target,
@@ -371,16 +431,14 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 desired_timestamp=int(time.time() + 0.5),
                 desired_target=desired_share_target,
                 ref_merkle_link=dict(branch=[], index=0),
-                desired_other_transaction_hashes_and_fees=list(zip(tx_hashes, self.current_work.value['transaction_fees'])),
+                desired_other_transaction_hashes_and_fees=None,
                 net=self.node.net,
-                known_txs=tx_map,
-                base_subsidy=self.node.net.PARENT.SUBSIDY_FUNC(self.current_work.value['height']),
+                template=template['transaction_template'],
             )
         
         packed_gentx = bitcoin_data.tx_id_type.pack(gentx) # stratum miners work with stripped transactions
-        other_transactions = [tx_map[tx_hash] for tx_hash in other_transaction_hashes]
+        other_transactions = template['other_transactions']
 
-        del tx_hashes
         if self.node.cur_share_ver >= 34:
             tx_map = {} # we can free up this memory now
         
@@ -410,7 +468,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
         
         getwork_time = time.time()
         lp_count = self.new_work_event.times
-        merkle_link = bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0) if share_info.get('segwit_data', None) is None else share_info['segwit_data']['txid_merkle_link']
+        merkle_link = bitcoin_data.merkle_tree_cache.get([None] + other_transaction_hashes).get_link(0) if share_info.get('segwit_data', None) is None else share_info['segwit_data']['txid_merkle_link']
         del other_transaction_hashes
 
         if print_throttle is 0.0:
@@ -444,7 +502,14 @@ class WorkerBridge(worker_interface.WorkerBridge):
         received_header_hashes = set()
         
         def got_response(header, username, coinbase_nonce, pseudoshare_target):
+            # the PoW is computed by pow_queue; got_pow does the rest once it's
+            # back, for each job's submissions in the order they came in
             t0 = time.time()
+            on_time = self.new_work_event.times == lp_count
+            packed_header = bitcoin_data.block_header_type.pack(header)
+            return self.pow_queue.submit(packed_header).addCallback(got_pow, t0, on_time, header, packed_header, username, coinbase_nonce, pseudoshare_target)
+        
+        def got_pow(pow_hash, t0, on_time, header, packed_header, username, coinbase_nonce, pseudoshare_target):
             assert len(coinbase_nonce) == self.COINBASE_NONCE_LENGTH
             new_packed_gentx = packed_gentx[:-self.COINBASE_NONCE_LENGTH-4] + coinbase_nonce + packed_gentx[-4:] if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else packed_gentx
             new_gentx = bitcoin_data.tx_type.unpack(new_packed_gentx) if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else gentx
@@ -453,8 +518,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 new_gentx['flag'] = gentx['flag']
                 new_gentx['witness'] = gentx['witness']
             
-            header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(header))
-            pow_hash = self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(header))
+            header_hash = bitcoin_data.hash256(packed_header)
             try:
                 if pow_hash <= header['bits'].target or p2pool.DEBUG:
                     if pow_hash <= header['bits'].target:
@@ -470,8 +534,6 @@ class WorkerBridge(worker_interface.WorkerBridge):
             assert header['merkle_root'] == bitcoin_data.check_merkle_link(bitcoin_data.hash256(new_packed_gentx), merkle_link)
             assert header['bits'] == ba['bits']
             
-            on_time = self.new_work_event.times == lp_count
-            
             for aux_work, index, hashes in mm_later:
                 try:
                     if pow_hash <= aux_work['target'] or p2pool.DEBUG:
@@ -564,9 +626,13 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 self.local_rate_monitor.add_datum(dict(work=bitcoin_data.target_to_average_attempts(pseudoshare_target), dead=not on_time, user=username, share_target=share_info['bits'].target))
                 self.local_addr_rate_monitor.add_datum(dict(work=bitcoin_data.target_to_average_attempts(pseudoshare_target), address=address))
             t1 = time.time()
-            if p2pool.BENCH and (t1-t0) > .01: print("%8.3f ms for work.py:got_response(%s)" % ((t1-t0)*1000., username))
+            if p2pool.BENCH and (t1-t0) > .01: print("%8.3f ms for work.py:got_response(%s), queue included" % ((t1-t0)*1000., username))
 
             return on_time
         t1 = time.time()
         if p2pool.BENCH: print("%8.3f ms for work.py:get_work(%s, %s)" % ((t1-t0)*1000., user, address))
+        self.job_rate_monitor.add_datum(dict(time=t1-t0))
+        if self.new_block_work is not None and self.new_block_work[0] == self.new_work_event.times:
+            self.new_block_jobs += 1
+            self.new_block_job_latency = t1 - self.new_block_work[1]
         return ba, got_response
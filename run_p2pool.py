@@ -2,4 +2,5 @@
 
 from p2pool import main
 
-main.run()
+if __name__ == '__main__':
+    main.run()
@@ -0,0 +1,9 @@
+from setuptools import setup, Extension
+
+sha256_midstate_module = Extension('sha256_midstate',
+                                   sources = ['sha256module.c'])
+
+setup (name = 'sha256_midstate',
+       version = '1.0',
+       description = 'SHA-256 compression function with exposed state, for p2pool hash links and getwork midstates',
+       ext_modules = [sha256_midstate_module])
@@ -0,0 +1,92 @@
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+
+static const uint32_t k[64] = {
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+};
+
+#define ROTR(x, n) (((x) >> (n)) | ((x) << (32 - (n))))
+
+static uint32_t be32dec(const unsigned char *p)
+{
+    return ((uint32_t)p[0] << 24) | ((uint32_t)p[1] << 16) | ((uint32_t)p[2] << 8) | (uint32_t)p[3];
+}
+
+static void be32enc(unsigned char *p, uint32_t x)
+{
+    p[0] = x >> 24; p[1] = x >> 16; p[2] = x >> 8; p[3] = x;
+}
+
+static void sha256_transform(uint32_t state[8], const unsigned char block[64])
+{
+    uint32_t w[64], a, b, c, d, e, f, g, h, t1, t2;
+    int i;
+
+    for (i = 0; i < 16; i++)
+        w[i] = be32dec(block + 4*i);
+    for (i = 16; i < 64; i++)
+        w[i] = w[i-16] + (ROTR(w[i-15], 7) ^ ROTR(w[i-15], 18) ^ (w[i-15] >> 3)) +
+               w[i-7] + (ROTR(w[i-2], 17) ^ ROTR(w[i-2], 19) ^ (w[i-2] >> 10));
+
+    a = state[0]; b = state[1]; c = state[2]; d = state[3];
+    e = state[4]; f = state[5]; g = state[6]; h = state[7];
+    for (i = 0; i < 64; i++) {
+        t1 = h + (ROTR(e, 6) ^ ROTR(e, 11) ^ ROTR(e, 25)) + ((e & f) ^ (~e & g)) + k[i] + w[i];
+        t2 = (ROTR(a, 2) ^ ROTR(a, 13) ^ ROTR(a, 22)) + ((a & b) ^ (a & c) ^ (b & c));
+        h = g; g = f; f = e; e = d + t1;
+        d = c; c = b; b = a; a = t1 + t2;
+    }
+    state[0] += a; state[1] += b; state[2] += c; state[3] += d;
+    state[4] += e; state[5] += f; state[6] += g; state[7] += h;
+}
+
+static PyObject *sha256_process(PyObject *self, PyObject *args)
+{
+    Py_buffer state_buf, data_buf;
+    uint32_t state[8];
+    unsigned char output[32];
+    Py_ssize_t i;
+
+    if (!PyArg_ParseTuple(args, "y*y*", &state_buf, &data_buf))
+        return NULL;
+    if (state_buf.len != 32 || data_buf.len % 64) {
+        PyBuffer_Release(&state_buf);
+        PyBuffer_Release(&data_buf);
+        PyErr_SetString(PyExc_ValueError, "state must be 32 bytes and data a multiple of 64 bytes");
+        return NULL;
+    }
+
+    for (i = 0; i < 8; i++)
+        state[i] = be32dec((const unsigned char *)state_buf.buf + 4*i);
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < data_buf.len; i += 64)
+        sha256_transform(state, (const unsigned char *)data_buf.buf + i);
+    Py_END_ALLOW_THREADS
+    for (i = 0; i < 8; i++)
+        be32enc(output + 4*i, state[i]);
+
+    PyBuffer_Release(&state_buf);
+    PyBuffer_Release(&data_buf);
+    return PyBytes_FromStringAndSize((const char *)output, 32);
+}
+
+static PyMethodDef Sha256Methods[] = {
+    { "process", sha256_process, METH_VARARGS, "Runs the SHA-256 compression function over data (a multiple of 64 bytes) starting from a 32 byte state, and returns the new state" },
+    { NULL, NULL, 0, NULL }
+};
+
+static struct PyModuleDef sha256module = {
+    PyModuleDef_HEAD_INIT, "sha256_midstate", NULL, -1, Sha256Methods
+};
+
+PyMODINIT_FUNC PyInit_sha256_midstate(void) {
+    return PyModule_Create(&sha256module);
+}